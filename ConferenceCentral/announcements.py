@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+announcements.py -- announcement and featured speaker messages
+
+Kept free of the Endpoints stack so the cron and task handlers that maintain
+these messages can use it without loading the API modules.
+
+"""
+
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import cache
+import versions
+from models import Conference
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+MEMCACHE_ANNOUNCEMENTS_KEY = 'RECENT_ANNOUNCEMENTS'
+FEATURED_KEY = 'SPEAKER-{conf_key}'
+
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+
+
+def cache_announcement():
+    """
+    Create Announcement & assign to memcache; used by memcache cron job &
+     putAnnouncement().
+
+    :return: announcement string
+    """
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= 5,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    client = memcache.Client()
+
+    if confs:
+        # If there are almost sold out conferences,
+        # format announcement and set it in memcache
+        announcement = ANNOUNCEMENT_TPL % (
+            ', '.join(conf.name for conf in confs))
+        if client.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement):
+            versions.bump(versions.ANNOUNCEMENT_SCOPE)
+    else:
+        # If there are no sold out conferences,
+        # delete the memcache announcements entry
+        announcement = ""
+        if client.delete(MEMCACHE_ANNOUNCEMENTS_KEY) == \
+                memcache.DELETE_SUCCESSFUL:
+            versions.bump(versions.ANNOUNCEMENT_SCOPE)
+
+    return announcement
+
+
+def cached_announcement():
+    """
+    Current announcement, through the hot cache
+    :return: tuple of (etag, announcement string)
+    """
+    scope = versions.ANNOUNCEMENT_SCOPE
+    return cache.HOT.get(
+        scope, lambda: (versions.etag(scope),
+                        memcache.Client().get(
+                            MEMCACHE_ANNOUNCEMENTS_KEY) or ''))
+
+
+def set_featured(conf_key, speaker):
+    """
+    Update memcache with the new featured speaker message for the conference
+    :param conf_key: Conference key
+    :param speaker: Speaker instance
+    :return: announcement
+    """
+    s = 'Featured Speaker: %s' % speaker.name
+    if speaker.title:
+        s += ', ' + speaker.title
+
+    m_key = FEATURED_KEY.format(conf_key=conf_key.urlsafe())
+
+    logging.info('Setting announcement (%s) with key (%s)', s, m_key)
+
+    if memcache.Client().add(m_key, s):
+        versions.bump(versions.featured_scope(conf_key))
+
+    return s
+
+
+def cached_featured(conf_key):
+    """
+    Featured speaker message of a Conference, through the hot cache
+    :param conf_key: Conference key
+    :return: tuple of (etag, featured speaker string)
+    """
+    scope = versions.featured_scope(conf_key)
+    key = FEATURED_KEY.format(conf_key=conf_key.urlsafe())
+    return cache.HOT.get(
+        scope, lambda: (versions.etag(scope),
+                        memcache.Client().get(key) or ''))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""
+cache.py -- two-tier cache for hot read keys
+
+Values are kept in an instance-local, thread-safe LRU (bounded by size and
+TTL) in front of memcache. Instances notice each other's invalidations via a
+generation stamp per key in memcache. The stamps of every key held locally are
+polled in one batch at most once every GENERATION_CHECK_INTERVAL seconds, so a
+local hit costs no RPC at all, and invalidating one key only drops that key.
+Keys that embed the version of what they cache (e.g. a count keyed by the
+kind's version) are never invalidated, so they skip the stamp altogether.
+
+Only one thread per instance (and, via a short memcache lock, roughly one
+instance overall) reloads an expired key; the others keep serving the stale
+value or wait briefly for the reload to land. Memcache entries carry the
+generation they were loaded under, so a reload that races an invalidation
+can't leave a stale value behind for other instances to pick up.
+
+"""
+
+import collections
+import threading
+import time
+import uuid
+
+from google.appengine.api import memcache
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+GENERATION_KEY = 'HOT-GENERATION-{key}'
+GENERATION_CHECK_INTERVAL = 1.0  # seconds
+MEMCACHE_KEY = 'HOT-{key}'
+LOCK_KEY = 'HOT-LOCK-{key}'
+LOCK_TIME = 5  # seconds
+LOCK_POLLS = 5
+LOCK_POLL_INTERVAL = 0.05  # seconds
+LOAD_WAIT = 1.0  # seconds
+
+class HotCache(object):
+    """
+    HotCache -- instance-local LRU with TTL in front of memcache
+    """
+
+    def __init__(self, max_size=512, ttl=30, memcache_time=60):
+        """
+        :param max_size: max number of entries held in instance memory
+        :param ttl: seconds an entry may be served from instance memory
+        :param memcache_time: seconds an entry lives in memcache
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.memcache_time = memcache_time
+        self._entries = collections.OrderedDict()
+        self._generations = {}  # key -> generation stamp as last polled
+        self._checked = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def get(self, key, loader, versioned=False, cache_misses=True):
+        """
+        Get the value for key, calling loader() if neither tier has it
+        :param key: string cache key
+        :param loader: callable producing the value on a full miss
+        :param versioned: whether the key embeds the version of what it
+        caches, so it's never invalidated and needs no generation check
+        :param cache_misses: whether a None from loader() is cached too
+        :return: cached or loaded value
+        """
+        generation = None if versioned else self._generation(key)
+        now = time.time()
+        stale = None
+
+        with self._lock:
+            self._stats['requests'] += 1
+            entry = self._entries.pop(key, None)
+            if entry:
+                # re-insert to mark as most recently used
+                self._entries[key] = entry
+                expires, entry_generation, value = entry
+                if entry_generation == generation and expires > now:
+                    self._stats['local_hits'] += 1
+                    return value
+                stale = entry
+
+            event = self._loading.get(key)
+            leader = event is None
+            if leader:
+                event = self._loading[key] = threading.Event()
+            elif stale:
+                # someone else is already reloading this key
+                self._stats['stale_hits'] += 1
+                return stale[2]
+
+        if not leader:
+            event.wait(LOAD_WAIT)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[1] == generation:
+                    self._stats['local_hits'] += 1
+                    return entry[2]
+
+        try:
+            value = self._fill(key, loader, generation, cache_misses)
+        finally:
+            if leader:
+                with self._lock:
+                    self._loading.pop(key, None)
+                event.set()
+
+        if value is None and not cache_misses:
+            return value
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, generation, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+        return value
+
+    def _generation(self, key):
+        """
+        Generation stamp of key. Every GENERATION_CHECK_INTERVAL the stamps
+        of every key held locally are re-read from memcache in one batch; a
+        key not seen before is read on its own.
+        :param key: string cache key
+        :return: int generation, 0 if the key was never invalidated
+        """
+        now = time.time()
+        with self._lock:
+            poll = now - self._checked >= GENERATION_CHECK_INTERVAL
+            if not poll and key in self._generations:
+                return self._generations[key]
+
+            keys = set([key])
+            if poll:
+                self._checked = now
+                keys.update(k for k, entry in self._entries.items()
+                            if entry[1] is not None)
+
+        stamps = memcache.Client().get_multi(
+            [GENERATION_KEY.format(key=k) for k in keys])
+
+        with self._lock:
+            if poll:
+                # forget stamps of keys no longer held
+                self._generations = dict(
+                    (k, g) for k, g in self._generations.items()
+                    if k in self._entries)
+            for k in keys:
+                self._generations[k] = stamps.get(GENERATION_KEY.format(key=k),
+                                                  0)
+            return self._generations[key]
+
+    def _fill(self, key, loader, generation, cache_misses=True):
+        """
+        Read the value from memcache, loading and storing it on a miss
+        :param key: string cache key
+        :param loader: callable producing the value
+        :param generation: generation stamp of key, None if versioned
+        :param cache_misses: whether a None from loader() is stored too
+        :return: value
+        """
+        client = memcache.Client()
+        m_key = MEMCACHE_KEY.format(key=key)
+        l_key = LOCK_KEY.format(key=key)
+
+        cached = self._cached(client, m_key, generation)
+        token = None
+        if cached is None:
+            token = uuid.uuid4().hex
+            if not client.add(l_key, token, time=LOCK_TIME):
+                token = None
+                # another instance is loading; give it a moment to finish
+                for _ in range(LOCK_POLLS):
+                    time.sleep(LOCK_POLL_INTERVAL)
+                    cached = self._cached(client, m_key, generation)
+                    if cached is not None:
+                        break
+
+        if cached is not None:
+            self._count('memcache_hits')
+            return cached[1]
+
+        self._count('loads')
+        try:
+            value = loader()
+            if value is not None or cache_misses:
+                client.set(m_key, (generation, value), time=self.memcache_time)
+        finally:
+            if token:
+                self._release(client, l_key, token)
+        return value
+
+    @staticmethod
+    def _cached(client, m_key, generation):
+        """
+        Memcache entry for a key, if it was loaded under the current generation
+        :param client: memcache.Client
+        :param m_key: memcache key of the value
+        :param generation: generation stamp of key, None if versioned
+        :return: tuple of (generation, value), or None
+        """
+        cached = client.get(m_key)
+        if cached is None or len(cached) != 2 or cached[0] != generation:
+            return None
+        return cached
+
+    @staticmethod
+    def _release(client, l_key, token):
+        """
+        Release a fill lock, unless it expired and another request has taken
+        it since. Memcache can't delete conditionally, so the lock is swapped
+        for one expiring in a second instead.
+        :param client: memcache.Client
+        :param l_key: memcache key of the lock
+        :param token: value the lock was taken with
+        :return:
+        """
+        if client.gets(l_key) == token:
+            client.cas(l_key, '', time=1)
+
+    def _count(self, stat):
+        """
+        Thread-safe increment of a stats counter
+        :param stat: name of the counter
+        :return:
+        """
+        with self._lock:
+            self._stats[stat] += 1
+
+    def discard(self, key):
+        """
+        Drop key from instance memory
+        :param key: string cache key
+        :return:
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations.pop(key, None)
+
+    def clear(self):
+        """
+        Drop every entry held in instance memory
+        :return:
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Counters and per-tier hit ratios for this instance
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+
+        requests = stats.get('requests', 0)
+        local = stats.get('local_hits', 0) + stats.get('stale_hits', 0)
+        memcached = stats.get('memcache_hits', 0)
+        stats['local_hit_ratio'] = float(local) / requests if requests else 0.0
+        misses = requests - local
+        stats['memcache_hit_ratio'] = \
+            float(memcached) / misses if misses else 0.0
+        return stats
+
+
+def invalidate(key):
+    """
+    Invalidate key in memcache and, by bumping its generation stamp, in every
+    instance's local tier. Other keys are unaffected.
+    :param key: string cache key
+    :return:
+    """
+    client = memcache.Client()
+    client.delete(MEMCACHE_KEY.format(key=key))
+    # seeded from the clock so an evicted stamp never comes back to a value
+    # an instance still holds
+    client.incr(GENERATION_KEY.format(key=key),
+                initial_value=int(time.time() * 1000))
+    # this instance drops it right away
+    HOT.discard(key)
+
+
+HOT = HotCache()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+"""
+catalogue.py -- static JSON snapshot of the public Conference catalogue
+
+Anonymous visitors to the landing page ask for every Conference with no
+filters, the most expensive and least personal query there is. A cron job
+renders that answer instead: Conferences sorted by name, split into pages of
+PAGE_SIZE, each encoded like a queryConferences response, gzipped once and
+stored under a name derived from its content hash. A small manifest lists the
+current pages. Pages never change once written, so they're served with long
+cache lifetimes; only the manifest has to be re-fetched.
+
+Files live in a blob store: CatalogueBlob entities in production, or a local
+directory (CATALOGUE_BLOB_DIR) for development and tests.
+
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import re
+from cStringIO import StringIO
+
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+import cache
+from models import CatalogueBlob
+from models import Conference
+from models import ConferenceForms
+from models import Profile
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+PAGE_SIZE = 200
+MANIFEST = 'manifest.json'
+PAGE_NAME = re.compile(r'^[0-9a-f]{16}\.json$')
+HOT_KEY = 'catalogue-{name}'
+
+PAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MANIFEST_CACHE_CONTROL = 'public, max-age=300'
+
+
+class DatastoreBlobStore(object):
+    """
+    DatastoreBlobStore -- catalogue files as CatalogueBlob entities
+    """
+
+    def put(self, name, content):
+        """
+        Store a file, replacing any of the same name
+        :param name: file name
+        :param content: string
+        :return:
+        """
+        CatalogueBlob(id=name, content=content).put()
+
+    def get(self, name):
+        """
+        Content of a file
+        :param name: file name
+        :return: string, or None if there's no such file
+        """
+        blob = ndb.Key(CatalogueBlob, name).get()
+        return blob.content if blob else None
+
+    def delete(self, name):
+        """
+        Delete a file, if it exists
+        :param name: file name
+        :return:
+        """
+        ndb.Key(CatalogueBlob, name).delete()
+
+    def names(self):
+        """
+        Names of every stored file
+        :return: list of strings
+        """
+        return [key.id() for key in
+                CatalogueBlob.query().fetch(keys_only=True)]
+
+
+class FileBlobStore(object):
+    """
+    FileBlobStore -- catalogue files in a local directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def put(self, name, content):
+        """
+        Store a file, replacing any of the same name
+        :param name: file name
+        :param content: string
+        :return:
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(content)
+
+    def get(self, name):
+        """
+        Content of a file
+        :param name: file name
+        :return: string, or None if there's no such file
+        """
+        path = os.path.join(self.root, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def delete(self, name):
+        """
+        Delete a file, if it exists
+        :param name: file name
+        :return:
+        """
+        path = os.path.join(self.root, name)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def names(self):
+        """
+        Names of every stored file
+        :return: list of strings
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return os.listdir(self.root)
+
+
+def blob_store():
+    """
+    Blob store for catalogue files: a local directory if CATALOGUE_BLOB_DIR
+    is set, else the datastore
+    :return: DatastoreBlobStore or FileBlobStore
+    """
+    root = os.environ.get('CATALOGUE_BLOB_DIR')
+    if root:
+        return FileBlobStore(root)
+    return DatastoreBlobStore()
+
+
+def compress(content):
+    """
+    Gzip content reproducibly, i.e. without a timestamp in the header
+    :param content: string
+    :return: gzipped string
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def decompress(content):
+    """
+    Gunzip content
+    :param content: gzipped string
+    :return: string
+    """
+    with gzip.GzipFile(fileobj=StringIO(content), mode='rb') as f:
+        return f.read()
+
+
+def _forms():
+    """
+    ConferenceForms of every Conference, sorted by name, with organiser
+    display names
+    :return: list of ConferenceForm
+    """
+    conferences = Conference.query().order(Conference.name).fetch()
+    profiles = ndb.get_multi(
+        set(ndb.Key(Profile, conf.organizerUserId) for conf in conferences))
+    names = dict((profile.key.id(), profile.displayName or '')
+                 for profile in profiles if profile)
+    return [conf.to_form(names.get(conf.organizerUserId, ''))
+            for conf in conferences]
+
+
+def manifest(store=None):
+    """
+    The current catalogue manifest
+    :param store: blob store, defaults to blob_store()
+    :return: dict, or None if the catalogue hasn't been rendered
+    """
+    content = (store or blob_store()).get(MANIFEST)
+    return json.loads(decompress(content)) if content else None
+
+
+def render(store=None):
+    """
+    Render the catalogue pages and manifest. Pages whose content didn't
+    change keep their names, so clients' cached copies stay valid. Pages
+    listed by the previous manifest are kept for clients still holding it;
+    anything older is deleted.
+    :param store: blob store, defaults to blob_store()
+    :return: the new manifest
+    """
+    store = store or blob_store()
+    forms = _forms()
+
+    pages = []
+    for start in range(0, len(forms), PAGE_SIZE):
+        body = protojson.encode_message(
+            ConferenceForms(items=forms[start:start + PAGE_SIZE]))
+        name = '%s.json' % hashlib.sha1(body).hexdigest()[:16]
+        store.put(name, compress(body))
+        pages.append(name)
+
+    previous = manifest(store) or {}
+    current = {'generated': datetime.datetime.now().isoformat(),
+               'total': len(forms),
+               'pageSize': PAGE_SIZE,
+               'pages': pages}
+    store.put(MANIFEST, compress(json.dumps(current)))
+    cache.invalidate(HOT_KEY.format(name=MANIFEST))
+
+    keep = set(pages) | set(previous.get('pages', [])) | {MANIFEST}
+    for name in store.names():
+        if name not in keep:
+            store.delete(name)
+    return current
+
+
+def read(name):
+    """
+    Gzipped content of a catalogue file, through the hot cache
+    :param name: MANIFEST or a page name
+    :return: gzipped string, or None if there's no such file
+    """
+    if name != MANIFEST and not PAGE_NAME.match(name):
+        return None
+    # pages are named by their content hash, so only the manifest changes
+    # a missing file isn't cached, so one rendered later is found at once
+    return cache.HOT.get(HOT_KEY.format(name=name),
+                         lambda: blob_store().get(name),
+                         versioned=name != MANIFEST, cache_misses=False)
+
+
+def cache_control(name):
+    """
+    Cache-Control header value for a catalogue file
+    :param name: MANIFEST or a page name
+    :return: string
+    """
+    if name == MANIFEST:
+        return MANIFEST_CACHE_CONTROL
+    return PAGE_CACHE_CONTROL
@@ -10,10 +10,11 @@ created by wesc on 2014 apr 21
 
 """
 
+import collections
+import threading
 from datetime import datetime
 
 import endpoints
-from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from protorpc import message_types
@@ -21,31 +22,48 @@ from protorpc import messages
 from protorpc import remote
 from protorpc.message_types import VoidMessage
 
+import announcements
+import cache
+import counters
+import facets
+import idempotency
 import queryutil
+import stats
+import sync
+import transactions
+import versions
+import views
+from context import UserContext, require_oauth
 from models import BooleanMessage
+from models import ChangesForm
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceKeysForm
 from models import ConferenceQueryForms
+from models import ConferenceStats
+from models import ConferenceStatsForm
 from models import ConferenceWishlist
-from models import ConflictException
+from models import CountForm
+from models import FacetForm
+from models import FacetForms
 from models import Profile
+from models import QueryCountForm
+from models import Registration
 from models import Session
+from models import SessionForm
 from models import SessionForms
+from models import Speaker
 from models import StringMessage
-from profile import ProfileApi
+from models import Tombstone
 from settings import API
 from session import SessionApi
-from utils import get_user_id, require_oauth
+from utils import ConflictException, field_mask
 
 __author__ = 'voutilad@gmail.com (Dave Voutila)'
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = 'RECENT_ANNOUNCEMENTS'
-
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 CONF_DEFAULTS = {
@@ -55,9 +73,60 @@ CONF_DEFAULTS = {
     "topics": ["Default", "Topic"],
 }
 
+# ConferenceForm fields with no Conference property behind them, or that
+# only the server sets
+FORM_ONLY_FIELDS = ('websafeKey', 'organizerDisplayName', 'organizerUserId',
+                    'month', 'etag', 'notModified', 'notFound',
+                    'idempotencyKey')
+
+MAX_BATCH_KEYS = 500
+
+# Conference ids are allocated in blocks per organiser and handed out from
+# instance memory, so most creates skip the allocate_ids RPC
+ID_BLOCK_SIZE = 10
+MAX_ID_BLOCKS = 1000
+
+_id_lock = threading.Lock()
+_id_blocks = collections.OrderedDict()
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+CONF_KEY_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+)
+
+CONF_SESSIONS_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
+)
+
+CONF_WISHLIST_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+)
+
+REGISTER_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    idempotencyKey=messages.StringField(2),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CHANGES_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    token=messages.StringField(1),
 )
 
 CONF_POST_REQUEST = endpoints.ResourceContainer(
@@ -66,6 +135,67 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 )
 
 
+def _registration_busy(request, ctx, reg=True):
+    """
+    Fallback for registrations that keep colliding. Unlike wishlist changes
+    they aren't queued: the caller has to know whether they got a seat, so
+    they're told to retry instead (with the same idempotencyKey, if any).
+    :param request: RPC Message Request with a urlsafe Conference Key
+    :param ctx: UserContext for the requesting user
+    :param reg: whether to register or unregister
+    :raises ConflictException: always
+    """
+    raise ConflictException(
+        'Too many registrations for this conference at once, please retry')
+
+
+def _next_conference_id(p_key):
+    """
+    Next Conference id under an organiser's Profile, from this instance's
+    block of pre-allocated ids
+    :param p_key: Profile key
+    :return: int id
+    """
+    wspk = p_key.urlsafe()
+    with _id_lock:
+        ids = _id_blocks.pop(wspk, None)
+        if ids:
+            c_id = ids.pop()
+            if ids:
+                _id_blocks[wspk] = ids
+            return c_id
+
+    start, end = Conference.allocate_ids(size=ID_BLOCK_SIZE, parent=p_key)
+    ids = range(end, start, -1)  # pop() hands them out in ascending order
+    with _id_lock:
+        _id_blocks[wspk] = ids
+        while len(_id_blocks) > MAX_ID_BLOCKS:
+            _id_blocks.popitem(last=False)
+    return start
+
+
+def _conference_data(request):
+    """
+    Conference property values given in a ConferenceForm, with dates parsed
+    and the month derived from the start date
+    :param request: ConferenceForm or a request combining one
+    :return: dict of property name -> value
+    """
+    data = {}
+    for field in ConferenceForm.all_fields():
+        value = getattr(request, field.name)
+        # only copy fields where we get data
+        if field.name in FORM_ONLY_FIELDS or value in (None, []):
+            continue
+        # special handling for dates (convert string to Date)
+        if field.name in ('startDate', 'endDate'):
+            value = datetime.strptime(value[:10], "%Y-%m-%d").date()
+        data[field.name] = value
+    if 'startDate' in data:
+        data['month'] = data['startDate'].month
+    return data
+
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -80,35 +210,39 @@ class ConferenceApi(remote.Service):
 
     """
 
-    FEATURED_KEY = 'SPEAKER-{conf_key}'
-
     #
     # - - - Endpoints - - - - - - - - - - - - - - - - - - -
     #
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
     @require_oauth
-    def create(self, request):
+    def create(self, request, ctx=None):
         """
         Creates a new Conference object
-        :param request: ConferenceForm message with Conference details
+        :param request: ConferenceForm message with Conference details and
+        an optional idempotencyKey
+        :param ctx: UserContext for the requesting user
         :return: created ConferenceForm for new Conference
         """
-        return self._create(request)
+        return idempotency.run('createConference', ctx, request.idempotencyKey,
+                               ConferenceForm,
+                               lambda: self._create(request, ctx))
 
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT', name='updateConference')
     @require_oauth
-    def update(self, request):
+    def update(self, request, ctx=None):
         """
         Update conference w/provided fields & return w/updated info from given
          ConferenceForm
         :param request: Conference POST Request [ConferenceForm, conference
         key string]
+        :param ctx: UserContext for the requesting user
         :return: Updated ConferenceForm
         """
-        return self._update(request)
+        conf = self._update(request, ctx)
+        return conf.to_form(ctx.display_name)
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
@@ -117,19 +251,103 @@ class ConferenceApi(remote.Service):
         """
         Return requested conference (by websafeConferenceKey).
         :param request: Conference GET Request [Void, conference key in query
-        string]
-        :return: matching ConferenceForm
+        string, optional ETag]
+        :return: matching ConferenceForm, or an empty one flagged notModified
+        if the client's ETag is current
         """
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey
-            )
-        prof = conf.key.parent().get()
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag, conf, display_name = self.cached_conference(conf_key)
+        views.record(conf_key)
+        if request.ifNoneMatch == etag:
+            return ConferenceForm(etag=etag, notModified=True)
+
         # return ConferenceForm
-        return conf.to_form(getattr(prof, 'displayName'))
+        form = conf.to_form(display_name)
+        form.etag = etag
+        return form
+
+    @endpoints.method(ConferenceKeysForm, ConferenceForms,
+                      path='conferences/batch',
+                      http_method='POST', name='getConferencesBatch')
+    def get_batch(self, request):
+        """
+        Return many Conferences at once (by websafeConferenceKeys)
+        :param request: ConferenceKeysForm with up to MAX_BATCH_KEYS web-safe
+        Conference keys
+        :return: ConferenceForms in request order; keys that are malformed or
+        have no Conference get a ConferenceForm flagged notFound
+        """
+        wscks = request.websafeConferenceKeys
+        if len(wscks) > MAX_BATCH_KEYS:
+            raise endpoints.BadRequestException(
+                'At most %d conference keys per request' % MAX_BATCH_KEYS)
+
+        # decode and dedupe, skipping anything that isn't a Conference key
+        keys = {}
+        for wsck in set(wscks):
+            try:
+                key = ndb.Key(urlsafe=wsck)
+            except Exception:  # bad base64 or protocol buffer
+                continue
+            if key.kind() == Conference.__name__ and key.parent():
+                keys[wsck] = key
+
+        # one batch for the Conferences, one for their organisers' Profiles
+        conf_keys = list(set(keys.values()))
+        confs = dict(zip(conf_keys, ndb.get_multi(conf_keys)))
+        org_keys = list(set(key.parent() for key in conf_keys))
+        names = dict((key, getattr(prof, 'displayName', None))
+                     for key, prof in zip(org_keys, ndb.get_multi(org_keys)))
+
+        items = []
+        for wsck in wscks:
+            conf = confs.get(keys.get(wsck))
+            if conf:
+                items.append(conf.to_form(names[conf.key.parent()]))
+            else:
+                items.append(ConferenceForm(websafeKey=wsck, notFound=True))
+        return ConferenceForms(items=items)
+
+    @endpoints.method(CHANGES_REQUEST, ChangesForm, path='changes',
+                      http_method='GET', name='getChangesSince')
+    def get_changes(self, request):
+        """
+        Return the Conferences, Sessions and Speakers changed, and the keys of
+        those deleted, since a sync token, in pages
+        :param request: Changes request with the nextToken of the previous
+        page or sync; no token (or a token too old) starts a full sync
+        :return: ChangesForm with a page of changes and the token to continue
+        from. Clients keep paging while 'more' is set and keep the last
+        nextToken for their next sync; 'reset' means the pages hold every
+        live entity, so anything not in them is gone.
+        """
+        try:
+            entities, token, more, reset = sync.changes(request.token)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        by_kind = dict((kind._get_kind(), []) for kind in sync.KINDS)
+        for entity in entities:
+            by_kind[entity.key.kind()].append(entity)
+
+        conferences = by_kind[Conference._get_kind()]
+        org_keys = list(set(conf.key.parent() for conf in conferences))
+        names = dict((key, getattr(prof, 'displayName', None))
+                     for key, prof in zip(org_keys, ndb.get_multi(org_keys)))
+
+        speakers = by_kind[Speaker._get_kind()]
+        counts = counters.get_counts(
+            Speaker.counter_name(speaker.key) for speaker in speakers)
+
+        return ChangesForm(
+            conferences=[conf.to_form(names[conf.key.parent()])
+                         for conf in conferences],
+            sessions=SessionApi.populate_forms(by_kind[Session._get_kind()]),
+            speakers=[speaker.to_form(
+                counts[Speaker.counter_name(speaker.key)])
+                for speaker in speakers],
+            deleted=[tombstone.key.id()
+                     for tombstone in by_kind[Tombstone._get_kind()]],
+            nextToken=token, more=more, reset=reset)
 
     @endpoints.method(VoidMessage, ConferenceForms, path='conferences/created',
                       http_method='POST', name='getConferencesCreated')
@@ -142,54 +360,64 @@ class ConferenceApi(remote.Service):
         if not isinstance(request, message_types.VoidMessage):
             raise endpoints.BadRequestException()
 
-        # make sure user is auth'd
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = get_user_id(user)
+        # make sure user is auth'd; their Profile is fetched alongside
+        ctx = UserContext.current()
+        ctx.prefetch_profile()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = Conference.query(ancestor=ctx.profile_key).fetch_async()
+        display_name = ctx.display_name
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[conf.to_form(getattr(prof, 'displayName')) for conf in confs]
+            items=[conf.to_form(display_name) for conf in confs.get_result()]
         )
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_SESSIONS_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='getConferenceSessions')
     def get_sessions(self, request):
         """
         Given a conference, return all sessions.
-        :param request: Conference GET Request [Void, query string with
-        conference key]
-        :return: SessionForms with matching SessionForm's
+        :param request: Conference Sessions Request [Void, query string with
+        conference key, optional ETag, optional SessionForm field mask]
+        :return: SessionForms with matching SessionForm's, or flagged
+        notModified if the client's ETag is current
         """
         wsck = request.websafeConferenceKey
         conf_key = ndb.Key(urlsafe=wsck)
+        fields = field_mask(request.fields, SessionForm)
+        etag = versions.etag(versions.sessions_scope(conf_key),
+                             ','.join(sorted(fields)) if fields else None)
+        if request.ifNoneMatch == etag:
+            return SessionForms(etag=etag, notModified=True)
+
         if not conf_key.get():
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
-        sessions = Session.query(ancestor=conf_key)
+        sessions = Session.query(
+            ancestor=conf_key,
+            projection=queryutil.projection(Session, fields,
+                                            ancestor=conf_key))
 
-        return SessionForms(items=SessionApi.populate_forms(sessions))
+        return SessionForms(items=SessionApi.populate_forms(sessions, fields),
+                            etag=etag)
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(CONF_WISHLIST_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/wishlist',
                       http_method='GET', name='getSessionsInWishlist')
     def get_wishlist(self, request):
         """
         Gets the list of sessions wishlisted by a User given a Conference.
-        :param request: Conference GET Request [VoidMessage, conference key in
-        query string]
+        :param request: Conference Wishlist Request [VoidMessage, conference
+        key in query string, optional SessionForm field mask]
         :return: SessionForms
         """
-        prof = ProfileApi.profile_from_user()  # get user Profile
+        ctx = UserContext.current()
         conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        fields = field_mask(request.fields, SessionForm)
 
-        wishlist = ConferenceWishlist().query(ancestor=prof.key) \
+        wishlist = ConferenceWishlist().query(ancestor=ctx.profile_key) \
             .filter(ConferenceWishlist.conferenceKey == conf_key) \
             .get()
 
@@ -200,7 +428,7 @@ class ConferenceApi(remote.Service):
 
         sessions = ndb.get_multi(wishlist.sessionKeys)
 
-        return SessionForms(items=SessionApi.populate_forms(sessions))
+        return SessionForms(items=SessionApi.populate_forms(sessions, fields))
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='conferences/query',
@@ -209,19 +437,23 @@ class ConferenceApi(remote.Service):
         """
         Query Conferences in Datastore
         :param request: ConferenceQueryForms with one or many
-        ConferenceQueryForm's
-        :return: ConferenceForms with matching ConferenceForm's, if any
-        """
-        # convert message types for now until we fix the js client side logic
-        query_filters = [
-            queryutil.QueryFilter(
-                field=f.field,
-                operator=queryutil.QueryOperator.lookup_by_name(f.operator),
-                value=f.value) for f in request.filters]
-        query_form = queryutil.QueryForm(
-            target=queryutil.QueryTarget.CONFERENCE,
-            filters=query_filters)
-        conferences = queryutil.query(query_form)
+        ConferenceQueryForm's, an optional ConferenceForm field mask, an
+        optional sortBy and an optional numResults; without numResults every
+        match is returned
+        :return: ConferenceForms with matching ConferenceForm's, if any,
+        whether they were sorted by the datastore or in memory, and flagged
+        capped if an in-memory sort stopped reading at queryutil.MAX_SCAN
+        matches, so matches sorting earlier may be missing
+        """
+        fields = field_mask(request.fields, ConferenceForm)
+        conferences = queryutil.query(self._query_form(request), fields=fields)
+        sort_path = queryutil.sort_path(conferences)
+
+        if fields and 'organizerDisplayName' not in fields:
+            # no need to look up the organisers
+            items = [conf.to_form(fields=fields) for conf in conferences]
+            return ConferenceForms(items=items, sortPath=sort_path,
+                                   capped=queryutil.capped(conferences))
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -244,10 +476,53 @@ class ConferenceApi(remote.Service):
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-            items=[conf.to_form(names[conf.organizerUserId]) for conf in
-                   conferences]
+            items=[conf.to_form(names[conf.organizerUserId], fields)
+                   for conf in conferences],
+            sortPath=sort_path,
+            capped=queryutil.capped(conferences)
         )
 
+    @endpoints.method(ConferenceQueryForms, QueryCountForm,
+                      path='conferences/count',
+                      http_method='POST', name='countConferences')
+    def count(self, request):
+        """
+        Count the Conferences matching the filters, up to queryutil.MAX_COUNT
+        :param request: ConferenceQueryForms with one or many
+        ConferenceQueryForm's
+        :return: QueryCountForm, flagged capped if there may be more matches
+        """
+        n = queryutil.count(self._query_form(request))
+        return QueryCountForm(count=n, capped=n >= queryutil.MAX_COUNT)
+
+    @endpoints.method(ConferenceQueryForms, FacetForms,
+                      path='conferences/facets',
+                      http_method='POST', name='getConferenceFacets')
+    def get_facets(self, request):
+        """
+        Count Conferences by city, topic, month, max attendees and
+        availability, for the filter panel
+        :param request: ConferenceQueryForms; only EQ filters narrow the
+        counts, other operators are ignored
+        :return: FacetForms
+        """
+        filters = []
+        for f in request.filters:
+            if f.operator != 'EQ':
+                continue
+            if f.field not in facets.FIELDS:
+                raise endpoints.BadRequestException(
+                    'Unknown facet: %s' % f.field)
+            filters.append((f.field, f.value))
+
+        total, counts = facets.facet_counts(filters)
+        return FacetForms(total=total, items=[
+            FacetForm(field=field, values=[
+                CountForm(name=name, count=count) for name, count in
+                sorted(counts[field].items(),
+                       key=lambda item: item[1], reverse=True)])
+            for field in facets.FIELDS])
+
     @endpoints.method(VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
@@ -260,8 +535,12 @@ class ConferenceApi(remote.Service):
         if not isinstance(request, message_types.VoidMessage):
             raise endpoints.BadRequestException()
 
-        prof = ProfileApi.profile_from_user()  # get user Profile
-        conf_keys = prof.conferencesToAttend  # Changed from original code
+        # keys-only ancestor query on the user's Registrations; those still
+        # in the legacy conferencesToAttend list wouldn't be found by it, so
+        # they're migrated first
+        ctx = UserContext.current()
+        ctx.migrate_registrations()
+        conf_keys = Registration.attending_async(ctx.profile_key).get_result()
 
         if len(conf_keys) == 0:
             # user hasn't registered for anything, so bail out of this method
@@ -290,57 +569,86 @@ class ConferenceApi(remote.Service):
     def get_featured_speaker(self, request):
         """
         Checks Memcache for any featured speaker for the Conference
-        :param request:
-        :return:
+        :param request: Conference GET Request [Void, conference key in query
+        string, optional ETag]
+        :return: StringMessage, flagged notModified if the ETag is current
         """
-        key = self.FEATURED_KEY.format(conf_key=request.websafeConferenceKey)
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        etag, featured = announcements.cached_featured(conf_key)
+        if request.ifNoneMatch == etag:
+            return StringMessage(data='', etag=etag, notModified=True)
 
-        return StringMessage(data=memcache.Client().get(key) or '')
+        return StringMessage(data=featured, etag=etag)
+
+    @endpoints.method(CONF_KEY_REQUEST, ConferenceStatsForm,
+                      path='conference/{websafeConferenceKey}/stats',
+                      http_method='GET', name='getConferenceStats')
+    def get_stats(self, request):
+        """
+        Session, speaker, registration and wishlist totals for a Conference
+        :param request: Conference Key Request [Void, conference key in query
+        string]
+        :return: ConferenceStatsForm
+        """
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf_stats = ConferenceStats.key_for(conf_key).get()
+        if not conf_stats:
+            # nothing has happened at the Conference yet, if it exists
+            if not conf_key.get():
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' %
+                    request.websafeConferenceKey)
+            conf_stats = ConferenceStats(key=ConferenceStats.key_for(conf_key))
+
+        return conf_stats.to_form()
 
     # --- Registration ---
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(REGISTER_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}/register',
                       http_method='POST', name='registerForConference')
     @require_oauth
-    def register(self, request):
+    def register(self, request, ctx=None):
         """
         Register user for a given Conference
-        :param request: Conference GET Request [Void, Conference key in query
-        string]
+        :param request: Register Request [Void, Conference key in query
+        string, optional idempotencyKey]
+        :param ctx: UserContext for the requesting user
         :return: BooleanMessage with True if successful, False if failure
         """
-        return self._register(request)
+        return idempotency.run('registerForConference', ctx,
+                               request.idempotencyKey, BooleanMessage,
+                               lambda: self._register(request, ctx))
 
-    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+    @endpoints.method(CONF_KEY_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}/unregister',
                       http_method='DELETE', name='unregisterFromConference')
     @require_oauth
-    def unregister(self, request):
+    def unregister(self, request, ctx=None):
         """
         Unregister user for selected conference.
-        :param request: Conference GET Request [Void, Conference key in query
+        :param request: Conference Key Request [Void, Conference key in query
         string]
+        :param ctx: UserContext for the requesting user
         :return: BooleanMessage with True if successful deregistration, False
         if failure
         """
-        return self._register(request, reg=False)
+        return self._register(request, ctx, reg=False)
 
-    @endpoints.method(VoidMessage, StringMessage,
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
                       path='conferences/announcements',
                       http_method='GET', name='getAnnouncement')
     def get_announcement(self, request):
         """
         Get Announcement from Memcache
-        :param request: VoidMessage
-        :return:
+        :param request: Announcement GET Request [Void, optional ETag]
+        :return: StringMessage, flagged notModified if the ETag is current
         """
-        if not isinstance(request, message_types.VoidMessage):
-            raise endpoints.BadRequestException()
-
-        client = memcache.Client()
+        etag, announcement = announcements.cached_announcement()
+        if request.ifNoneMatch == etag:
+            return StringMessage(data='', etag=etag, notModified=True)
 
-        return StringMessage(data=client.get(MEMCACHE_ANNOUNCEMENTS_KEY) or '')
+        return StringMessage(data=announcement, etag=etag)
 
     @endpoints.method(VoidMessage, ConferenceForms,
                       path='conferences/filterPlayground',
@@ -372,104 +680,101 @@ class ConferenceApi(remote.Service):
     #
 
     @staticmethod
-    def cache_announcement():
+    def cached_conference(conf_key):
         """
-        Create Announcement & assign to memcache; used by memcache cron job &
-         putAnnouncement().
-
-        :return: announcement string
+        Conference and organiser display name, through the hot cache
+        :param conf_key: Conference key
+        :return: tuple of (etag, Conference, organiser display name)
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        client = memcache.Client()
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            client.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            client.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
+        scope = versions.conference_scope(conf_key)
+        return cache.HOT.get(
+            scope, lambda: ConferenceApi._load_conference(conf_key, scope))
 
     #
     # - - - Conference Private Methods - - - - - - - - - - - - - - - - - - -
     #
 
     @staticmethod
-    def _create(request):
+    def _load_conference(conf_key, scope):
+        """
+        Load a Conference and its organiser's display name for the hot cache.
+        The ETag is read first so it can never be newer than the data.
+        :param conf_key: Conference key
+        :param scope: version scope of the Conference
+        :return: tuple of (etag, Conference, organiser display name)
+        """
+        etag = versions.etag(scope)
+        conf, prof = ndb.get_multi([conf_key, conf_key.parent()])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % conf_key.urlsafe())
+        return etag, conf, getattr(prof, 'displayName', None)
+
+    @staticmethod
+    def _create(request, ctx):
         """
         Create or update Conference object, returning ConferenceForm/request.
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = get_user_id(user)
+        user_id = ctx.user_id
 
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in
-                request.all_fields()}
-        del data['websafeKey']
-        del data['organizerDisplayName']
+        data = _conference_data(request)
 
         # add default values for those missing (data model & outbound Message)
         for df in CONF_DEFAULTS:
-            if data[df] in (None, []):
+            if data.get(df) in (None, []):
                 data[df] = CONF_DEFAULTS[df]
                 setattr(request, df, CONF_DEFAULTS[df])
-
-        # convert dates from strs to Date objects; set month based on start_date
-        if data['startDate']:
-            data['startDate'] = datetime.strptime(data['startDate'][:10],
-                                                  "%Y-%m-%d").date()
-            data['month'] = data['startDate'].month
-        else:
-            data['month'] = 0
-        if data['endDate']:
-            data['endDate'] = datetime.strptime(data['endDate'][:10],
-                                                "%Y-%m-%d").date()
+        data.setdefault('month', 0)
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
-        # generate Profile Key based on user ID and Conference
-        # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
+        # Conference ID from the organiser's block of pre-allocated IDs,
+        # keyed under their Profile
+        p_key = ctx.profile_key
+        c_key = ndb.Key(Conference, _next_conference_id(p_key), parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                              'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        conf = Conference(**data)
+
+        @ndb.transactional()
+        def txn():
+            # issue both RPCs before waiting on either; the task is only
+            # enqueued if the put commits
+            put = conf.put_async()
+            task = taskqueue.Task(
+                params={'email': ctx.user.email(),
+                        'conferenceInfo': repr(request)},
+                url='/tasks/send_confirmation_email'
+            ).add_async(transactional=True)
+            versions.bump(versions.kind_scope(Conference))
+            put.get_result()
+            task.get_result()
+            facets.record(conf)
+
+        txn()
         return request
 
     @ndb.transactional()
-    def _update(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = get_user_id(user)
+    def _update(self, request, ctx):
+        """
+        Transaction applying the provided ConferenceForm fields to an existing
+        Conference
+        :param request: Conference POST Request
+        :param ctx: UserContext for the requesting user
+        :return: updated Conference
+        """
+        user_id = ctx.user_id
 
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
@@ -485,26 +790,14 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
-        # copy ConferenceForm/ProtoRPC Message into dict
-        # data = {field.name: getattr(request, field.name) for field in
-        # request.all_fields()}
-
         # Not getting all the fields, so don't create a new object; just
-        # copy relevant fields from ConferenceForm to Conference object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
-                # special handling for dates (convert string to Date)
-                if field.name in ('startDate', 'endDate'):
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
-                    if field.name == 'startDate':
-                        conf.month = data.month
-                # write to Conference object
-                setattr(conf, field.name, data)
+        # copy the given fields onto the Conference object
+        conf.populate(**_conference_data(request))
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return conf.to_form(getattr(prof, 'displayName'))
+        facets.record(conf)
+        versions.bump(versions.conference_scope(conf.key))
+        versions.bump(versions.kind_scope(Conference))
+        return conf
 
     @staticmethod
     def _query(request):
@@ -516,28 +809,59 @@ class ConferenceApi(remote.Service):
         return queryutil.query(request)
 
     @staticmethod
-    @ndb.transactional(xg=True)
-    def _register(request, reg=True):
+    def _query_form(request):
+        """
+        Convert ConferenceQueryForms into a queryutil.QueryForm
+        :param request: ConferenceQueryForms
+        :return: QueryForm targeting Conferences
+        """
+        # convert message types for now until we fix the js client side logic
+        query_filters = [
+            queryutil.QueryFilter(
+                field=f.field,
+                operator=queryutil.QueryOperator.lookup_by_name(f.operator),
+                value=f.value, values=f.values) for f in request.filters]
+        return queryutil.QueryForm(
+            target=queryutil.QueryTarget.CONFERENCE,
+            filters=query_filters, sort_by=request.sortBy,
+            num_results=request.numResults)
+
+    @staticmethod
+    @transactions.transactional(
+        name='register', xg=True, fallback=_registration_busy,
+        group=lambda request, ctx, reg=True: request.websafeConferenceKey)
+    def _register(request, ctx, reg=True):
         """
         Register or unregister user for selected conference.
         :param request: RPC Message Request with a urlsafe Conference Key
+        :param ctx: UserContext for the requesting user
         :param reg: whether to register (True) or unregister (False) the
         requesting User
         :return: BooleanMessage - True if successful, False if failure
+        :raises ConflictException: if already registered, there are no seats
+        or contention outlasted the retries
         """
-        prof = ProfileApi.profile_from_user()  # get user Profile
-
-        # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get conference, any existing registration and the Profile together
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
-        conf = c_key.get()
+        r_key = Registration.key_for(ctx.profile_key, c_key)
+        conf, registration, prof = ndb.get_multi(
+            [c_key, r_key, ctx.profile_key])
         if not conf:
             raise endpoints.NotFoundException('No conference found for key')
+        was_open = conf.seatsAvailable > 0
+
+        # registrations still in the legacy list count too, and move to
+        # Registration entities here; the Profile is in the same entity group
+        to_put = [conf]
+        if prof and prof.conferencesToAttend:
+            registration = registration or c_key in prof.conferencesToAttend
+            to_put += [r for r in Registration.from_legacy(prof)
+                       if r.key != r_key] + [prof]
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if c_key in prof.conferencesToAttend:
+            if registration:
                 raise ConflictException(
                     'Already registered for this conference')
 
@@ -546,25 +870,31 @@ class ConferenceApi(remote.Service):
                 raise ConflictException('There are no seats available.')
 
             # register user, take away one seat
-            prof.conferencesToAttend.append(c_key)
             conf.seatsAvailable -= 1
 
             # update datastore
-            prof.put()
-            conf.put()
+            to_put.append(Registration(key=r_key, conferenceKey=c_key))
+            ndb.put_multi(to_put)
+            stats.record_registration(c_key, 1)
 
         # un-register
         else:
             # check if user already registered
-            if c_key in prof.conferencesToAttend:
+            if registration:
                 # unregister user, add back one seat
-                prof.conferencesToAttend.remove(c_key)
                 conf.seatsAvailable += 1
 
                 # update datastore
-                prof.put()
-                conf.put()
+                ndb.put_multi(to_put)
+                r_key.delete()
+                stats.record_registration(c_key, -1)
             else:
                 return BooleanMessage(data=False)
 
+        # the Conference moves between the OPEN and FULL facets
+        if was_open != (conf.seatsAvailable > 0):
+            facets.record(conf)
+
+        # seat count changed, so cached copies of the Conference are stale
+        versions.bump(versions.conference_scope(c_key))
         return BooleanMessage(data=True)
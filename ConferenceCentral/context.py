@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+context.py -- per-request identity for ConferenceCentral endpoints
+
+A UserContext resolves the current endpoints user, their user id and their
+Profile at most once per request. The Profile is only read the first time an
+endpoint asks for it, so endpoints that only need the user id or Profile key
+cost no datastore read; those that do can call prefetch_profile() to overlap
+the read with their own.
+
+"""
+
+import endpoints
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Registration
+from models import TeeShirtSize
+from utils import get_user_id
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class UserContext(object):
+    """
+    UserContext -- the authenticated user behind the current request
+    """
+
+    def __init__(self, user):
+        """
+        Build the context; the Profile isn't read until it's needed
+        :param user: users.User from endpoints.get_current_user()
+        """
+        self.user = user
+        self.user_id = get_user_id(user)
+        self.profile_key = ndb.Key(Profile, self.user_id)
+        self._profile_future = None
+        self._profile = None
+
+    @classmethod
+    def current(cls):
+        """
+        Build a UserContext for the current endpoints user
+        :return: UserContext
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return cls(user)
+
+    def new_profile(self):
+        """
+        Create (but don't put) a default Profile for the user
+        :return: Profile
+        """
+        return Profile(
+            key=self.profile_key,
+            displayName=self.user.nickname(),
+            mainEmail=self.user.email(),
+            teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+        )
+
+    def prefetch_profile(self):
+        """
+        Start reading the user's Profile, if it isn't already being read
+        :return:
+        """
+        if self._profile_future is None:
+            self._profile_future = self.profile_key.get_async()
+
+    @property
+    def profile(self):
+        """
+        The user's Profile, creating and storing a new one if non-existent.
+
+        Inside a transaction the prefetched value can't be trusted for writes,
+        so the Profile is re-read transactionally instead.
+        :return: Profile
+        """
+        if ndb.in_transaction():
+            return self.profile_key.get() or self.new_profile()
+
+        if self._profile is None:
+            self.prefetch_profile()
+            profile = self._profile_future.get_result()
+            if not profile:
+                profile = self.new_profile()
+                profile.put()
+            self._profile = profile
+
+        return self._profile
+
+    def migrate_registrations(self):
+        """
+        Move any Registrations still held in the Profile's legacy
+        conferencesToAttend list into Registration entities, which is where
+        Registration queries look. A no-op, beyond loading the Profile, once
+        they've moved.
+        :return: Profile
+        """
+        profile = self.profile
+        if profile.conferencesToAttend:
+            profile = Registration.migrate(self.profile_key)
+            if not ndb.in_transaction():
+                self._profile = profile
+        return profile
+
+    @property
+    def display_name(self):
+        """
+        Display name of the user, as stored on their Profile
+        :return: string
+        """
+        return getattr(self.profile, 'displayName')
+
+
+def require_oauth(func):
+    """
+    Decorator to check if a user is executing the request with OAuth. The
+    wrapped method receives the resolved UserContext as the 'ctx' keyword.
+    :param func: wrapping func
+    :return:
+    """
+
+    def func_wrapper(*args, **kwargs):
+        kwargs['ctx'] = UserContext.current()
+        return func(*args, **kwargs)
+
+    return func_wrapper
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+counters.py -- sharded counters with a cached aggregate
+
+Each named counter is spread over NUM_SHARDS CounterShard entities, each its
+own entity group, so concurrent increments rarely collide. Totals are summed
+from the shards on a cache miss and kept in memcache. Commits delete the
+cached totals they change, locking them against add() for a few seconds so
+a total summed from shards read before the commit can't be cached over it.
+
+"""
+
+import json
+import random
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import CounterShard
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+NUM_SHARDS = 20
+MEMCACHE_KEY = 'COUNTER-{name}'
+CACHE_TIME = 600  # seconds
+DELETE_LOCK = 10  # seconds a deleted total can't be re-added
+MAX_GROUPS = 25  # entity groups a single xg transaction may touch
+
+
+def _shard_key(name, index):
+    """
+    Key of one shard of a counter
+    :param name: counter name
+    :param index: shard number
+    :return: ndb.Key
+    """
+    return ndb.Key(CounterShard, '%s-%d' % (name, index))
+
+
+def shard_keys(name):
+    """
+    Keys of every shard of a counter
+    :param name: counter name
+    :return: list of ndb.Key
+    """
+    return [_shard_key(name, i) for i in range(NUM_SHARDS)]
+
+
+def get_counts(names):
+    """
+    Totals for many counters, read from memcache with one batched shard read
+    for any that aren't cached
+    :param names: iterable of counter names
+    :return: dict of name -> total
+    """
+    names = list(set(names))
+    client = memcache.Client()
+    cache_keys = dict((name, MEMCACHE_KEY.format(name=name)) for name in names)
+    cached = client.get_multi(cache_keys.values())
+
+    counts = {}
+    missing = []
+    for name in names:
+        if cache_keys[name] in cached:
+            counts[name] = cached[cache_keys[name]]
+        else:
+            missing.append(name)
+
+    if missing:
+        shards = ndb.get_multi([key for name in missing
+                                for key in shard_keys(name)])
+        for i, name in enumerate(missing):
+            counts[name] = sum(shard.count for shard in
+                               shards[i * NUM_SHARDS:(i + 1) * NUM_SHARDS]
+                               if shard)
+        client.add_multi(dict((cache_keys[name], counts[name])
+                              for name in missing), time=CACHE_TIME)
+
+    return counts
+
+
+def get_count(name):
+    """
+    Total for a single counter
+    :param name: counter name
+    :return: int
+    """
+    return get_counts([name])[name]
+
+
+def increment_multi(deltas):
+    """
+    Apply deltas to many counters, one random shard each. Joins the current
+    transaction if there is one, so the counts commit with the caller's
+    writes.
+    :param deltas: dict of counter name -> delta
+    :return:
+    """
+    deltas = [(name, delta) for name, delta in deltas.items() if delta]
+    if not deltas:
+        return
+
+    if ndb.in_transaction():
+        _apply(deltas)
+    else:
+        ndb.transaction(lambda: _apply(deltas), xg=True)
+
+
+def queue_increments(deltas):
+    """
+    Enqueue, with the current transaction, tasks applying deltas to many
+    counters. Each task moves at most MAX_GROUPS counters, so it fits in one
+    xg transaction however many counters change.
+    :param deltas: dict of counter name -> delta
+    :return:
+    """
+    deltas = [(name, delta) for name, delta in deltas.items() if delta]
+    for i in range(0, len(deltas), MAX_GROUPS):
+        taskqueue.add(
+            params={'deltas': json.dumps(dict(deltas[i:i + MAX_GROUPS]))},
+            url='/tasks/counters', transactional=True)
+
+
+def increment(name, delta=1):
+    """
+    Apply a delta to a single counter
+    :param name: counter name
+    :param delta: amount to add (may be negative)
+    :return:
+    """
+    increment_multi({name: delta})
+
+
+def _apply(deltas):
+    """
+    Transactional body of increment_multi()
+    :param deltas: list of (counter name, delta)
+    :return:
+    """
+    keys = [_shard_key(name, random.randint(0, NUM_SHARDS - 1))
+            for name, _ in deltas]
+    shards = ndb.get_multi(keys)
+    for i, key in enumerate(keys):
+        if shards[i] is None:
+            shards[i] = CounterShard(key=key)
+        shards[i].count += deltas[i][1]
+    ndb.put_multi(shards)
+    names = [name for name, _ in deltas]
+    ndb.get_context().call_on_commit(lambda: _invalidate(names))
+
+
+def _invalidate(names):
+    """
+    Drop cached totals after a commit, so the next read sums the shards
+    :param names: counter names
+    :return:
+    """
+    memcache.Client().delete_multi(
+        [MEMCACHE_KEY.format(name=name) for name in names],
+        seconds=DELETE_LOCK)
+
+
+def reset(name, count=0):
+    """
+    Overwrite a counter with an absolute value, e.g. when recomputing it.
+    Every shard is rewritten in one transaction, so an increment either
+    commits before the reset and is replaced or after it and is kept.
+    :param name: counter name
+    :param count: new total
+    :return:
+    """
+    @ndb.transactional(xg=True)
+    def txn():
+        keys = shard_keys(name)
+        ndb.get_multi(keys)  # so concurrent increments collide with us
+        CounterShard(key=keys[0], count=count).put()
+        ndb.delete_multi(keys[1:])
+        ndb.get_context().call_on_commit(lambda: _invalidate([name]))
+
+    txn()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- facet counts for the Conference filter panel
+
+Every facet value (a city, a topic, a month, a max attendees bucket, open or
+full) has its own sharded counter, moved by a task queued transactionally as
+Conferences are created, updated or fill up. The task re-reads the Conference
+and diffs its facet values against a compact row kept for it in one of
+NUM_SHARDS FacetShard entities. The new row and tasks applying the difference
+to the counters commit in one transaction, so a retried task never counts
+twice and a late one never writes an older row over a newer one.
+
+Unfiltered counts are read straight from the counters. Counts narrowed by
+equality filters fall back to scanning the rows. Both are cached per version
+of the facets, so answering never scans Conferences.
+
+"""
+
+import collections
+import hashlib
+import threading
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import cache
+import counters
+import versions
+from models import FacetShard, FacetValues
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+NUM_SHARDS = 16
+# rows per FacetShard, keeping each shard well below the 1MB entity limit;
+# 16 shards hold about 128,000 Conferences
+MAX_SHARD_ROWS = 8000
+
+# facet names, in the order their values are kept in a row
+FIELDS = ('CITY', 'TOPIC', 'MONTH', 'MAX_ATTENDEES', 'AVAILABILITY')
+
+# lower bounds of the max attendees buckets
+ATTENDEE_BUCKETS = (0, 10, 50, 100, 500, 1000)
+
+COUNTER_NAME = u'FACET|{field}|{value}'
+TOTAL_NAME = 'FACET|TOTAL'
+VALUES_KEY = ndb.Key(FacetValues, 1)
+
+_lock = threading.Lock()
+_rows = {'version': None, 'rows': []}
+
+
+def _shard_key(conf_key):
+    """
+    Key of the FacetShard holding a Conference's row
+    :param conf_key: Conference key
+    :return: ndb.Key
+    """
+    index = zlib.crc32(conf_key.urlsafe()) % NUM_SHARDS
+    return ndb.Key(FacetShard, index + 1)
+
+
+def row_for(conf):
+    """
+    Facet values of a Conference, in FIELDS order
+    :param conf: Conference
+    :return: list
+    """
+    return [conf.city, sorted(conf.topics or []), conf.month or 0,
+            max(conf.maxAttendees or 0, 0),
+            'OPEN' if conf.seatsAvailable > 0 else 'FULL']
+
+
+def attendee_bucket(max_attendees):
+    """
+    Label of the bucket a max attendees value falls in, e.g. '100-499'
+    :param max_attendees: int
+    :return: string
+    """
+    lower = [b for b in ATTENDEE_BUCKETS if b <= max_attendees][-1]
+    i = ATTENDEE_BUCKETS.index(lower)
+    if i + 1 == len(ATTENDEE_BUCKETS):
+        return '%d+' % lower
+    return '%d-%d' % (lower, ATTENDEE_BUCKETS[i + 1] - 1)
+
+
+def _values(row):
+    """
+    Facet values a row counts towards
+    :param row: facet row
+    :return: list of (field, value string)
+    """
+    city, topics, month, max_attendees, availability = row
+    pairs = [('CITY', city)]
+    pairs += [('TOPIC', topic) for topic in topics]
+    pairs += [('MONTH', unicode(month) if month else None),
+              ('MAX_ATTENDEES', attendee_bucket(max_attendees)),
+              ('AVAILABILITY', availability)]
+    return [(field, value) for field, value in pairs if value]
+
+
+def record(conf):
+    """
+    Queue a refresh of a Conference's facet counts. Joins the current
+    transaction if there is one, so the task only runs once the Conference
+    commits.
+    :param conf: Conference
+    :return:
+    """
+    taskqueue.add(params={'conf_key': conf.key.urlsafe()},
+                  url='/tasks/facets', transactional=ndb.in_transaction())
+
+
+def refresh(conf_key):
+    """
+    Bring a Conference's facet row, and the counters of the facet values it
+    gained or lost, up to date with the Conference as stored
+    :param conf_key: Conference key
+    :return:
+    :raises RuntimeError: if the Conference's FacetShard is full
+    """
+    @ndb.transactional(xg=True)
+    def txn():
+        key = _shard_key(conf_key)
+        conf, shard = ndb.get_multi([conf_key, key])
+        if not conf:
+            return
+        shard = shard or FacetShard(key=key, rows={})
+        wsck = conf_key.urlsafe()
+        old = shard.rows.get(wsck)
+        row = row_for(conf)
+        if old == row:
+            return
+        if old is None and len(shard.rows) >= MAX_SHARD_ROWS:
+            # fails the task, so it's retried and shows up in the logs
+            # until NUM_SHARDS is raised
+            raise RuntimeError('%s is full, cannot count Conference %s' %
+                               (key, wsck))
+
+        deltas = collections.Counter()
+        if old is None:
+            deltas[TOTAL_NAME] += 1
+        else:
+            for field, value in _values(old):
+                deltas[COUNTER_NAME.format(field=field, value=value)] -= 1
+        for field, value in _values(row):
+            deltas[COUNTER_NAME.format(field=field, value=value)] += 1
+
+        # remember values seen for the first time, so reads know which
+        # counters to sum
+        index = VALUES_KEY.get() or FacetValues(key=VALUES_KEY)
+        new_names = set(name for name in deltas if name != TOTAL_NAME) - \
+            set(index.names)
+        if new_names:
+            index.names.extend(sorted(new_names))
+            index.put()
+
+        shard.rows[wsck] = row
+        shard.put()
+        counters.queue_increments(deltas)
+        versions.bump(versions.FACETS_SCOPE)
+
+    txn()
+
+
+def _load_rows():
+    """
+    Every facet row, read once per version of the rows per instance
+    :return: list of rows
+    """
+    version = versions.get_version(versions.FACETS_SCOPE)
+    with _lock:
+        if _rows['version'] == version:
+            return _rows['rows']
+
+    rows = [row for shard in ndb.get_multi(
+        [ndb.Key(FacetShard, i + 1) for i in range(NUM_SHARDS)])
+            if shard for row in shard.rows.values()]
+    with _lock:
+        _rows['version'] = version
+        _rows['rows'] = rows
+    return rows
+
+
+def _matches(row, field, value):
+    """
+    Whether a facet row satisfies an equality filter
+    :param row: facet row
+    :param field: one of FIELDS
+    :param value: filter value string
+    :return: bool
+    """
+    got = row[FIELDS.index(field)]
+    if field == 'TOPIC':
+        return value in got
+    return unicode(got) == value
+
+
+def _count_counters():
+    """
+    Count facet values over every Conference, from the counters
+    :return: tuple of (total, dict of field -> dict of value -> count)
+    """
+    index = VALUES_KEY.get()
+    names = index.names if index else []
+    totals = counters.get_counts(names + [TOTAL_NAME])
+
+    counts = dict((field, {}) for field in FIELDS)
+    for name in names:
+        if totals[name] > 0:
+            _, field, value = name.split('|', 2)
+            counts[field][value] = totals[name]
+    return totals[TOTAL_NAME], counts
+
+
+def _count_rows(filters):
+    """
+    Count facet values over the rows matching every filter
+    :param filters: list of (field, value)
+    :return: tuple of (total, dict of field -> dict of value -> count)
+    """
+    counts = dict((field, {}) for field in FIELDS)
+    total = 0
+    for row in _load_rows():
+        if not all(_matches(row, field, value) for field, value in filters):
+            continue
+        total += 1
+        for field, value in _values(row):
+            counts[field][value] = counts[field].get(value, 0) + 1
+    return total, counts
+
+
+def facet_counts(filters=()):
+    """
+    Facet counts, through the hot cache, optionally narrowed by equality
+    filters
+    :param filters: iterable of (field, value), field one of FIELDS
+    :return: tuple of (total, dict of field -> dict of value -> count)
+    """
+    filters = sorted(set(filters))
+    signature = hashlib.sha1(repr(filters)).hexdigest()[:16]
+    key = '%s-%s-%s' % (versions.FACETS_SCOPE,
+                        versions.get_version(versions.FACETS_SCOPE),
+                        signature)
+    if filters:
+        loader = lambda: _count_rows(filters)
+    else:
+        loader = _count_counters
+    return cache.HOT.get(key, loader, versioned=True)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+idempotency.py -- replay-safe endpoints via client supplied idempotency keys
+
+A client that may retry a request sends the same idempotencyKey with every
+attempt. The first attempt runs and its response is stored, per user and
+operation, in memcache and in an IdempotencyRecord for TTL seconds; retries
+get the stored response back instead of running the operation again. A
+duplicate arriving while the first attempt is still running waits for it.
+Responses flagged queued are placeholders for work left to a task, not the
+outcome, so they aren't stored and a retry runs the operation again.
+
+"""
+
+import datetime
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+from models import IdempotencyRecord
+from utils import ConflictException
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+TTL = 24 * 60 * 60  # seconds
+MEMCACHE_KEY = 'IDEMPOTENCY-{id}'
+PENDING = 'PENDING'
+LOCK_TIME = 30  # seconds
+WAIT = 5.0  # seconds
+POLL_INTERVAL = 0.1  # seconds
+
+
+def _record_id(operation, ctx, idempotency_key):
+    """
+    Id of the stored response of an operation for a user and key
+    :param operation: operation name, e.g. the endpoint name
+    :param ctx: UserContext for the requesting user
+    :param idempotency_key: key supplied by the client
+    :return: string
+    """
+    return hashlib.sha1('%s|%s|%s' % (operation, ctx.user_id,
+                                      idempotency_key)).hexdigest()
+
+
+def _stored(record_id):
+    """
+    Stored response, from memcache or else the datastore
+    :param record_id: IdempotencyRecord id
+    :return: encoded response, PENDING, or None
+    """
+    client = memcache.Client()
+    m_key = MEMCACHE_KEY.format(id=record_id)
+    cached = client.get(m_key)
+    if cached is not None:
+        return cached
+
+    record = ndb.Key(IdempotencyRecord, record_id).get()
+    if record and record.expires > datetime.datetime.now():
+        client.set(m_key, record.response, time=TTL)
+        return record.response
+
+    return None
+
+
+def run(operation, ctx, idempotency_key, response_class, func):
+    """
+    Run func once per idempotency key, returning the stored response to
+    retries
+    :param operation: operation name, e.g. the endpoint name
+    :param ctx: UserContext for the requesting user
+    :param idempotency_key: key supplied by the client, or None to just run
+    func
+    :param response_class: messages.Message class func returns
+    :param func: callable performing the operation
+    :return: response_class instance
+    """
+    if not idempotency_key:
+        return func()
+
+    record_id = _record_id(operation, ctx, idempotency_key)
+    client = memcache.Client()
+    m_key = MEMCACHE_KEY.format(id=record_id)
+    deadline = time.time() + WAIT
+
+    while True:
+        stored = _stored(record_id)
+        if stored is None and client.add(m_key, PENDING, time=LOCK_TIME):
+            break
+
+        if stored is not None and stored != PENDING:
+            return protojson.decode_message(response_class, stored)
+
+        # a duplicate is still running; wait for its response
+        if time.time() > deadline:
+            raise ConflictException(
+                'A request with this idempotency key is still in progress')
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        response = func()
+    except Exception:
+        # let a retry run the operation again
+        client.delete(m_key)
+        raise
+
+    if getattr(response, 'queued', False):
+        client.delete(m_key)
+        return response
+
+    encoded = protojson.encode_message(response)
+    IdempotencyRecord(id=record_id, response=encoded,
+                      expires=datetime.datetime.now() +
+                      datetime.timedelta(seconds=TTL)).put()
+    client.set(m_key, encoded, time=TTL)
+    return response
@@ -2,7 +2,8 @@
 
 """
 main.py -- Udacity conference server-side Python App Engine
-    HTTP controller handlers for memcache & task queue access
+    Endpoints API server and instance warmup; the cron, task queue and
+    admin handlers live in tasks.py
 
 $Id$
 
@@ -14,13 +15,11 @@ modified by voutilad@gmail.com for Udacity FullStackDev Project 4
 
 import endpoints
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
-from google.appengine.api import memcache
-from google.appengine.ext import ndb
 
+import announcements
+import queryutil
+import views
 from conference import ConferenceApi
-from models import Session, SessionType
 from profile import ProfileApi
 from session import SessionApi
 
@@ -34,111 +33,29 @@ API_SERVER = endpoints.api_server(
 # - - - Backend Api - - -
 
 
-class SetAnnouncementHandler(webapp2.RequestHandler):
+class WarmupHandler(webapp2.RequestHandler):
     """
-    Handles creation of announcements
+    Warms up a new instance before it serves user traffic
     """
 
     def get(self):
         """
-        Set announcement values in Memcache.
+        The API modules are already imported along with this one; build the
+        query plans and pre-load the hot cache with the announcement and the
+        most viewed Conferences along with their featured speakers.
         :return:
         """
-        ConferenceApi.cache_announcement()
-        self.response.set_status(204)
+        queryutil.warm()
+        announcements.cached_announcement()
+        for conf_key in views.top_conferences():
+            try:
+                ConferenceApi.cached_conference(conf_key)
+                announcements.cached_featured(conf_key)
+            except endpoints.NotFoundException:
+                pass
+        self.response.set_status(200)
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
-    """
-    Handles Email confirmation tasks
-    """
-
-    def post(self):
-        """
-        Send email confirming Conference creation.
-        :return:
-        """
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),  # from
-            self.request.get('email'),  # to
-            'You created a new Conference!',  # subj
-            'Hi, you have created a following '  # body
-            'conference:\r\n\r\n%s' % self.request.get(
-                'conferenceInfo')
-        )
-
-
-class FeaturedSpeakersHandler(webapp2.RequestHandler):
-    """
-    Pick a Featured Speaker for a Conference when Sessions are created/changed
-    """
-
-    @staticmethod
-    def update(conf_key, speaker):
-        """
-        Update memcache with the new message for the conference
-        :param conf_key: Conference key
-        :param speaker: Speaker instance
-        :return: announcement
-        """
-        s = 'Featured Speaker: %s' % speaker.name
-        if speaker.title:
-            s += ', ' + speaker.title
-
-        m_key = ConferenceApi.FEATURED_KEY.format(conf_key=conf_key.urlsafe())
-
-        print 'Setting announcement (%s) with key (%s)' % (s, m_key)
-
-        memcache.Client().add(m_key, s)
-
-        return s
-
-    def post(self):
-        """
-        Expected to receive Postdata with a web-safe Conference key
-        :return:
-        """
-        wsck = self.request.get('conf_key')
-        if not wsck:
-            print 'Bad request to FeaturedSpeakersHandler'
-            self.response.set_status(204)  # bad request
-        else:
-            # do it
-            conf_key = ndb.Key(urlsafe=wsck)
-            keynotes = Session.query(ancestor=conf_key) \
-                .filter(Session.typeOfSession == SessionType.KEYNOTE) \
-                .fetch()
-            if keynotes:
-                # take the first keynote presenter and feature them
-                s_key = self.get_first_speaker(keynotes)
-                if s_key:
-                    self.update(conf_key, s_key.get())
-            else:
-                others = Session.query(ancestor=conf_key) \
-                    .filter(Session.typeOfSession != SessionType.KEYNOTE) \
-                    .fetch()
-                if others:
-                    # just grab the first for now...
-                    s_key = self.get_first_speaker(others)
-                    if s_key:
-                        self.update(conf_key, s_key.get())
-
-        self.response.set_status(204)
-
-    @staticmethod
-    def get_first_speaker(sessions):
-        """
-        Get the first available speaker in the given sessions
-        :param sessions:
-        :return:
-        """
-        for session in sessions:
-            if getattr(session, 'speakerKeys'):
-                return session.speakerKeys[0]
-
 APP = webapp2.WSGIApplication([
-    ('/crons/set_announcement', SetAnnouncementHandler),
-    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/update_featured_speaker', FeaturedSpeakersHandler)
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+mapper.py -- resumable, sharded mappers over every entity of a kind
+
+A Mapper walks its KIND with keys-only cursors, one task-queue slice of
+SLICE_SIZE entities at a time, hands each slice to map_batch() and writes the
+returned entities back in put_multi/delete_multi batches. Progress is
+checkpointed in a MapperShard entity after every slice, so a failed or
+retried task picks up where the last good slice left off.
+
+A job can be split into several shards by key range (sampled with the
+__scatter__ property) which then run in parallel.
+
+"""
+
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import MapperJob, MapperShard
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+SLICE_URL = '/admin/mappers/slice'
+WRITE_BATCH_SIZE = 100
+SCATTER_OVERSAMPLE = 32
+
+MAPPERS = {}
+
+
+def register(cls):
+    """
+    Class decorator making a Mapper runnable by NAME
+    :param cls: Mapper subclass
+    :return: cls
+    """
+    MAPPERS[cls.NAME] = cls
+    return cls
+
+
+class Mapper(object):
+    """
+    Mapper -- base class for mappers. Subclasses set NAME and KIND and
+    implement map() or, to work on a whole slice at once, map_batch().
+    """
+
+    NAME = None
+    KIND = None
+    KEYS_ONLY = False  # map keys instead of fetching entities
+    SLICE_SIZE = 100
+
+    def map(self, entity):
+        """
+        Process a single entity (or key, with KEYS_ONLY)
+        :param entity: ndb.Model instance or ndb.Key
+        :return: tuple of (entities to put, keys to delete)
+        """
+        return [], []
+
+    def map_batch(self, entities):
+        """
+        Process one slice of entities
+        :param entities: list of ndb.Model instances or ndb.Keys
+        :return: tuple of (entities to put, keys to delete)
+        """
+        to_put, to_delete = [], []
+        for entity in entities:
+            puts, deletes = self.map(entity)
+            to_put += puts
+            to_delete += deletes
+        return to_put, to_delete
+
+    def written(self, to_put, to_delete):
+        """
+        Called once a slice's writes are done, e.g. to invalidate caches
+        :param to_put: entities that were put
+        :param to_delete: keys that were deleted
+        :return:
+        """
+        pass
+
+    def query(self, start_key=None, end_key=None):
+        """
+        Query over the key range [start_key, end_key) of KIND
+        :param start_key: first key of the range, or None
+        :param end_key: key just past the range, or None
+        :return: ndb.Query
+        """
+        q = self.KIND.query()
+        if start_key:
+            q = q.filter(self.KIND.key >= start_key)
+        if end_key:
+            q = q.filter(self.KIND.key < end_key)
+        return q.order(self.KIND.key)
+
+
+def _split_points(kind, shards):
+    """
+    Pick keys splitting a kind into roughly even ranges, by sampling the
+    __scatter__ property
+    :param kind: ndb.Model subclass
+    :param shards: number of ranges wanted
+    :return: sorted list of at most shards - 1 keys
+    """
+    if shards <= 1:
+        return []
+
+    sample = kind.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_OVERSAMPLE, keys_only=True)
+    sample.sort()
+    points = set(sample[len(sample) * i / shards] for i in range(1, shards)
+                 if sample)
+    return sorted(points)
+
+
+def _enqueue(shard):
+    """
+    Queue the next slice of a shard
+    :param shard: MapperShard
+    :return:
+    """
+    taskqueue.add(url=SLICE_URL, params={'shard': shard.key.urlsafe(),
+                                         'slice': shard.slice})
+
+
+def start(name, shards=1):
+    """
+    Start a mapper job
+    :param name: NAME of a registered Mapper
+    :param shards: number of key ranges to process in parallel
+    :return: MapperJob
+    """
+    mapper = MAPPERS[name]()
+    splits = [None] + _split_points(mapper.KIND, shards) + [None]
+
+    job = MapperJob(name=name, shards=len(splits) - 1)
+    job.put()
+    states = [MapperShard(parent=job.key, id=i + 1, name=name,
+                          startKey=splits[i], endKey=splits[i + 1])
+              for i in range(len(splits) - 1)]
+    ndb.put_multi(states)
+    for state in states:
+        _enqueue(state)
+
+    return job
+
+
+def _chunks(items, size):
+    """
+    Split a list into lists of at most size items
+    :param items: list
+    :param size: max chunk size
+    :return: generator of lists
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def run_slice(shard_key, slice_number):
+    """
+    Process one slice of a shard and checkpoint it. Tasks for a slice that
+    was already checkpointed (e.g. task retries) are ignored.
+    :param shard_key: MapperShard key
+    :param slice_number: slice the task was queued for
+    :return:
+    """
+    state = shard_key.get()
+    if not state or state.done or state.slice != slice_number:
+        return
+
+    mapper = MAPPERS[state.name]()
+    cursor = ndb.Cursor(urlsafe=state.cursor) if state.cursor else None
+    keys, cursor, more = mapper.query(state.startKey, state.endKey) \
+        .fetch_page(mapper.SLICE_SIZE, start_cursor=cursor, keys_only=True)
+
+    if mapper.KEYS_ONLY:
+        items = keys
+    else:
+        items = [entity for entity in ndb.get_multi(keys) if entity]
+    to_put, to_delete = mapper.map_batch(items)
+
+    for batch in _chunks(to_put, WRITE_BATCH_SIZE):
+        ndb.put_multi(batch)
+    for batch in _chunks(to_delete, WRITE_BATCH_SIZE):
+        ndb.delete_multi(batch)
+    mapper.written(to_put, to_delete)
+
+    state.processed += len(keys)
+    state.puts += len(to_put)
+    state.deletes += len(to_delete)
+    state.done = not (more and cursor)
+    state.cursor = None if state.done else cursor.urlsafe()
+    state.slice += 1
+    state.put()
+
+    if not state.done:
+        _enqueue(state)
+
+
+def status(limit=20):
+    """
+    Progress and throughput of the most recent mapper jobs
+    :param limit: number of jobs to report on
+    :return: list of dicts, one per job
+    """
+    jobs = MapperJob.query().order(-MapperJob.started).fetch(limit)
+    shard_futures = [MapperShard.query(ancestor=job.key).fetch_async()
+                     for job in jobs]
+
+    report = []
+    now = datetime.datetime.now()
+    for job, future in zip(jobs, shard_futures):
+        shards = future.get_result()
+        processed = sum(shard.processed for shard in shards)
+        done = all(shard.done for shard in shards)
+        end = max([shard.updated for shard in shards] or [now]) \
+            if done else now
+        elapsed = max((end - job.started).total_seconds(), 1)
+        report.append({
+            'job': job.key.urlsafe(),
+            'name': job.name,
+            'started': job.started.isoformat(),
+            'shards': job.shards,
+            'shardsDone': len([shard for shard in shards if shard.done]),
+            'done': done,
+            'processed': processed,
+            'puts': sum(shard.puts for shard in shards),
+            'deletes': sum(shard.deletes for shard in shards),
+            'elapsedSeconds': elapsed,
+            'entitiesPerSecond': processed / elapsed,
+        })
+    return report
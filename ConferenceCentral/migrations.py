@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""
+migrations.py -- backfills and schema migrations run through mapper.py
+
+Start one from /admin/mappers/start?name=<NAME>&shards=<N> as an admin and
+follow its progress on /admin/mappers.
+
+"""
+
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import counters
+import facets
+import stats
+import sync
+import versions
+from mapper import MAPPERS, Mapper, register
+from models import Conference
+from models import ConferenceStats
+from models import ConferenceWishlist
+from models import IdempotencyRecord
+from models import Profile
+from models import Registration
+from models import Session
+from models import SessionName
+from models import Speaker
+from models import Tombstone
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+@register
+class RegistrationsMigration(Mapper):
+    """
+    Moves legacy Profile.conferencesToAttend lists into Registration
+    entities. Each Profile is re-read and written in its own transaction, so
+    a user unregistering meanwhile isn't undone. Registration keys are
+    deterministic so re-running is harmless.
+    """
+
+    NAME = 'registrations'
+    KIND = Profile
+
+    def map(self, prof):
+        if prof.conferencesToAttend:
+            Registration.migrate(prof.key)
+        return [], []
+
+
+@register
+class SessionKeysMigration(Mapper):
+    """
+    Re-keys Sessions still keyed by their name onto allocated ids, building
+    the SessionName index. Each Session moves in a transaction on its
+    Conference's entity group, along with its SessionName, Tombstone and
+    wishlist count, so a re-run skips Sessions already moved and reuses any
+    id their SessionName already maps them to. ConferenceWishlist references
+    are fixed up by a task enqueued with the move.
+    """
+
+    NAME = 'session_keys'
+    KIND = Session
+    SLICE_SIZE = 50
+
+    def map_batch(self, sessions):
+        # only name-keyed Sessions need migrating
+        legacy = [session.key for session in sessions
+                  if isinstance(session.key.id(), basestring)]
+        id_futures = [Session.allocate_ids_async(size=1, parent=key.parent())
+                      for key in legacy]
+        for old_key, ids in zip(legacy, id_futures):
+            self.rekey(old_key, ids.get_result()[0])
+        return [], []
+
+    @staticmethod
+    @ndb.transactional()
+    def rekey(old_key, allocated_id):
+        """
+        Move a name-keyed Session onto an allocated id
+        :param old_key: name-keyed Session key
+        :param allocated_id: id to use unless the SessionName already maps
+        the Session to one
+        :return:
+        """
+        conf_key = old_key.parent()
+        session = old_key.get()
+        if not session:
+            return  # moved by an earlier run
+        n_key = SessionName.key_for(conf_key, session.name)
+        index = n_key.get()
+        if index and index.sessionKey != old_key:
+            new_key = index.sessionKey
+        else:
+            new_key = ndb.Key(Session, allocated_id, parent=conf_key)
+
+        to_put = [SessionName(key=n_key, sessionKey=new_key),
+                  # syncing clients need to drop the old key
+                  Tombstone.for_key(old_key)]
+        if not new_key.get():
+            session.key = new_key
+            to_put.append(session)
+        ndb.put_multi(to_put)
+        old_key.delete()
+        stats.rekey_session(old_key, new_key)
+        taskqueue.add(params={'old_key': old_key.urlsafe(),
+                              'new_key': new_key.urlsafe()},
+                      url='/tasks/rekey_wishlists', transactional=True)
+        versions.bump(versions.sessions_scope(conf_key))
+        versions.bump(versions.kind_scope(Session))
+
+
+@register
+class SpeakerCountsMigration(Mapper):
+    """
+    Recomputes the sharded Session counters of Speakers from the Sessions
+    that reference them. Speakers whose count changes are re-put so syncing
+    clients see the new count.
+    """
+
+    NAME = 'speaker_counts'
+    KIND = Speaker
+    KEYS_ONLY = True
+    SLICE_SIZE = 50
+
+    def map_batch(self, keys):
+        futures = [Session.query(Session.speakerKeys == key).count_async()
+                   for key in keys]
+        current = counters.get_counts(Speaker.counter_name(key)
+                                      for key in keys)
+        changed = []
+        for key, future in zip(keys, futures):
+            name = Speaker.counter_name(key)
+            counters.reset(name, future.get_result())
+            if current[name] != future.get_result():
+                changed.append(key)
+        return [speaker for speaker in ndb.get_multi(changed) if speaker], []
+
+
+@register
+class ConferenceMonthMigration(Mapper):
+    """
+    Backfills Conference.month from Conference.startDate
+    """
+
+    NAME = 'conference_month'
+    KIND = Conference
+
+    def map(self, conf):
+        month = conf.startDate.month if conf.startDate else 0
+        if conf.month == month:
+            return [], []
+
+        conf.month = month
+        return [conf], []
+
+    def written(self, to_put, to_delete):
+        for conf in to_put:
+            versions.bump(versions.conference_scope(conf.key))
+        if to_put:
+            versions.bump(versions.kind_scope(Conference))
+
+
+@register
+class ConferenceStatsMigration(Mapper):
+    """
+    Recomputes ConferenceStats from the Sessions, Registrations and
+    wishlists of each Conference. Run daily from cron.yaml to correct drift.
+    Also deletes the stats kept in the Conference's entity group before
+    they moved to a root entity.
+    """
+
+    NAME = 'conference_stats'
+    KIND = Conference
+    KEYS_ONLY = True
+    SLICE_SIZE = 20
+
+    def map(self, conf_key):
+        stats.reconcile(conf_key)
+        return [], [ndb.Key(ConferenceStats, 'stats', parent=conf_key)]
+
+
+@register
+class ConferenceFacetsMigration(Mapper):
+    """
+    Backfills the facet rows and counters of Conferences created before facet
+    counts
+    """
+
+    NAME = 'conference_facets'
+    KIND = Conference
+    KEYS_ONLY = True
+
+    def map(self, conf_key):
+        facets.refresh(conf_key)
+        return [], []
+
+
+@register
+class WishlistKeysMigration(Mapper):
+    """
+    Re-keys ConferenceWishlists with allocated ids onto
+    ConferenceWishlist.key_for, merging into a re-keyed one if the user has
+    since changed the wishlist
+    """
+
+    NAME = 'wishlist_keys'
+    KIND = ConferenceWishlist
+
+    def map(self, wishlist):
+        key = ConferenceWishlist.key_for(wishlist.key.parent(),
+                                         wishlist.conferenceKey)
+        if wishlist.key == key:
+            return [], []
+
+        current = key.get()
+        if current:
+            current.sessionKeys += [s_key for s_key in wishlist.sessionKeys
+                                    if s_key not in current.sessionKeys]
+        else:
+            current = ConferenceWishlist(key=key,
+                                         conferenceKey=wishlist.conferenceKey,
+                                         sessionKeys=wishlist.sessionKeys)
+        return [current], [wishlist.key]
+
+
+@register
+class IdempotencyPurge(Mapper):
+    """
+    Deletes expired IdempotencyRecords. Run daily from cron.yaml.
+    """
+
+    NAME = 'idempotency_purge'
+    KIND = IdempotencyRecord
+
+    def map(self, record):
+        if record.expires > datetime.datetime.now():
+            return [], []
+
+        return [], [record.key]
+
+
+class ModifiedBackfill(Mapper):
+    """
+    Sets the modified timestamp of entities written before there was one, so
+    delta syncs (see sync.py) pick them up
+    """
+
+    def map(self, entity):
+        if entity.modified:
+            return [], []
+
+        return [entity], []  # modified is auto_now
+
+
+@register
+class ConferenceModifiedBackfill(ModifiedBackfill):
+    """
+    Backfills Conference.modified
+    """
+
+    NAME = 'conference_modified'
+    KIND = Conference
+
+
+@register
+class SessionModifiedBackfill(ModifiedBackfill):
+    """
+    Backfills Session.modified
+    """
+
+    NAME = 'session_modified'
+    KIND = Session
+
+
+@register
+class SpeakerModifiedBackfill(ModifiedBackfill):
+    """
+    Backfills Speaker.modified
+    """
+
+    NAME = 'speaker_modified'
+    KIND = Speaker
+
+
+@register
+class SessionDateTimesBackfill(Mapper):
+    """
+    Stores Session.startDateTime and endDateTime on Sessions written before
+    they existed, so START and END filters find them. Sessions already
+    storing the right values are left alone, since every put moves modified
+    and makes syncing clients download the Session again.
+    """
+
+    NAME = 'session_datetimes'
+    KIND = Session
+
+    def map(self, session):
+        if not session.date or not session.startTime:
+            return [], []
+
+        # computed properties read as their computed value, so compare it
+        # with the raw value loaded from the datastore
+        stored = [getattr(session._values.get(name), 'b_val', None)
+                  for name in ('startDateTime', 'endDateTime')]
+        if stored == [session.startDateTime, session.endDateTime]:
+            return [], []
+
+        return [session], []  # computed properties are stored on put
+
+
+@register
+class TombstonePurge(Mapper):
+    """
+    Deletes Tombstones older than sync.TOMBSTONE_TTL. Run daily from
+    cron.yaml.
+    """
+
+    NAME = 'tombstone_purge'
+    KIND = Tombstone
+
+    def map(self, tombstone):
+        if tombstone.modified > datetime.datetime.now() - sync.TOMBSTONE_TTL:
+            return [], []
+
+        return [], [tombstone.key]
+
+
+def rekey_wishlists(old_key, new_key):
+    """
+    Replace a re-keyed Session's old key in every ConferenceWishlist, each
+    wishlist re-read and written in its own transaction so concurrent
+    wishlist changes aren't lost
+    :param old_key: Session key before re-keying
+    :param new_key: Session key after re-keying
+    :return:
+    """
+    @ndb.transactional()
+    def txn(w_key):
+        wishlist = w_key.get()
+        if wishlist and old_key in wishlist.sessionKeys:
+            wishlist.sessionKeys = [new_key if key == old_key else key
+                                    for key in wishlist.sessionKeys]
+            wishlist.put()
+
+    for w_key in ConferenceWishlist.query(
+            ConferenceWishlist.sessionKeys == old_key).fetch(keys_only=True):
+        txn(w_key)
+
+
+def names():
+    """
+    Names of every migration mapper registered above
+    :return: sorted list of names
+    """
+    return sorted(MAPPERS)
@@ -10,30 +10,24 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 modified by voutilad@gmail.com for Udacity FullStackDev Project 4
 """
-import httplib
-import endpoints
-from datetime import datetime
+from datetime import datetime, timedelta
 from protorpc import messages
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 
 
-class ConflictException(endpoints.ServiceException):
-    """ConflictException -- exception mapped to HTTP 409 response"""
-    http_status = httplib.CONFLICT
-
-
-# - - - - - - - -
-
-
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
+    # wishlist change accepted (data=True) but left to a task
+    queued = messages.BooleanField(2)
 
 
 # - - - - - - - -
@@ -43,24 +37,85 @@ class Profile(ndb.Model):
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy: replaced by Registration entities, emptied by
+    # Registration.migrate() when the user's registrations are next read or
+    # changed, or by the 'registrations' mapper
     conferencesToAttend = ndb.KeyProperty(kind='Conference', repeated=True)
 
-    def to_form(self):
+    def to_form(self, conference_keys=None):
         """
         Creates ProfileForm from the Profile model instance
+        :param conference_keys: keys of the Conferences the user is attending
         :return: ProfileForm
         """
         pf = ProfileForm()
         pf.displayName = self.displayName
         pf.mainEmail = self.mainEmail
         pf.conferenceKeysToAttend = [
-            key.urlsafe() for key in self.conferencesToAttend
+            key.urlsafe() for key in conference_keys or []
             ]
         pf.teeShirtSize = TeeShirtSize.lookup_by_name(self.teeShirtSize)
 
         return pf
 
 
+class Registration(ndb.Model):
+    """Registration -- a Profile attending a Conference. Keyed under the
+    attendee's Profile by the web-safe key of the Conference so membership
+    checks are a single get."""
+    conferenceKey = ndb.KeyProperty(kind='Conference', required=True)
+
+    @staticmethod
+    def key_for(profile_key, conf_key):
+        """
+        Deterministic key of the Registration of a Profile for a Conference
+        :param profile_key: attendee Profile key
+        :param conf_key: Conference key
+        :return: ndb.Key
+        """
+        return ndb.Key(Registration, conf_key.urlsafe(), parent=profile_key)
+
+    @staticmethod
+    def from_legacy(prof):
+        """
+        Registrations for a Profile's legacy conferencesToAttend list, which is
+        emptied; the caller puts them and the Profile in one transaction
+        :param prof: attendee Profile
+        :return: list of Registration
+        """
+        registrations = [Registration(key=Registration.key_for(prof.key, key),
+                                      conferenceKey=key)
+                         for key in prof.conferencesToAttend]
+        prof.conferencesToAttend = []
+        return registrations
+
+    @staticmethod
+    @ndb.transactional()
+    def migrate(profile_key):
+        """
+        Move a Profile's legacy conferencesToAttend into Registrations, in a
+        transaction on the Profile's entity group so it can't race a register
+        or unregister
+        :param profile_key: attendee Profile key
+        :return: the Profile as stored afterwards, or None if there isn't one
+        """
+        prof = profile_key.get()
+        if prof and prof.conferencesToAttend:
+            ndb.put_multi(Registration.from_legacy(prof) + [prof])
+        return prof
+
+    @staticmethod
+    def attending_async(profile_key):
+        """
+        Keys-only, strongly consistent lookup of the Conferences a Profile is
+        registered for
+        :param profile_key: attendee Profile key
+        :return: Future resolving to a list of Conference keys
+        """
+        return Registration.query(ancestor=profile_key).map_async(
+            lambda key: ndb.Key(urlsafe=key.id()), keys_only=True)
+
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -90,15 +145,19 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    modified = ndb.DateTimeProperty(auto_now=True)
 
-    def to_form(self, display_name=None):
+    def to_form(self, display_name=None, fields=None):
         """
         Creates RPC Message ConferenceForm representation of a Conference
         :param display_name: Optional display name string for the ConferenceForm
+        :param fields: Optional field mask; only these form fields are set
         :return: ConferenceForm
         """
         cf = ConferenceForm()
         for field in cf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if hasattr(self, field.name):
                 # convert Date to date string; just copy others
                 if field.name.endswith('Date'):
@@ -107,7 +166,7 @@ class Conference(ndb.Model):
                     setattr(cf, field.name, getattr(self, field.name))
             elif field.name == "websafeKey":
                 setattr(cf, field.name, self.key.urlsafe())
-        if display_name:
+        if display_name and (not fields or 'organizerDisplayName' in fields):
             setattr(cf, 'organizerDisplayName', display_name)
         cf.check_initialized()
         return cf
@@ -127,11 +186,115 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)  # DateTimeField()
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag = messages.StringField(13)
+    notModified = messages.BooleanField(14)
+    notFound = messages.BooleanField(15)
+    idempotencyKey = messages.StringField(16)
+
+
+class SortPath(messages.Enum):
+    """SortPath -- how a query's results were sorted: by the datastore, from
+    an index, or in memory over a capped scan"""
+    DATASTORE = 1
+    IN_MEMORY = 2
 
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sortPath = messages.EnumField(SortPath, 2)
+    capped = messages.BooleanField(3)  # sorted in memory over a capped scan
+
+
+class QueryCountForm(messages.Message):
+    """QueryCountForm -- number of entities matching a query"""
+    count = messages.IntegerField(1)
+    capped = messages.BooleanField(2)
+
+
+class ConferenceKeysForm(messages.Message):
+    """ConferenceKeysForm -- inbound list of web-safe Conference keys"""
+    websafeConferenceKeys = messages.StringField(1, repeated=True)
+
+
+class ConferenceStats(ndb.Model):
+    """ConferenceStats -- running totals for a Conference, a root entity keyed
+    by the web-safe Conference key and adjusted by deltas as Sessions,
+    Registrations and wishlists change (see stats.py)"""
+    sessionTypes = ndb.JsonProperty()  # SessionType name -> Sessions
+    minutes = ndb.IntegerProperty(default=0, indexed=False)
+    speakers = ndb.JsonProperty()  # web-safe Speaker key -> Sessions
+    registrations = ndb.IntegerProperty(default=0, indexed=False)
+    wishlists = ndb.JsonProperty()  # web-safe Session key -> wishlists
+    reconciled = ndb.DateTimeProperty(indexed=False)
+
+    @staticmethod
+    def key_for(conf_key):
+        """
+        Key of the stats of a Conference
+        :param conf_key: Conference key
+        :return: ndb.Key
+        """
+        return ndb.Key(ConferenceStats, conf_key.urlsafe())
+
+    def to_form(self):
+        """
+        Creates the ConferenceStatsForm representation of the stats
+        :return: ConferenceStatsForm
+        """
+        session_types = self.sessionTypes or {}
+        return ConferenceStatsForm(
+            websafeConferenceKey=self.key.id(),
+            sessions=sum(session_types.values()),
+            sessionTypes=[CountForm(name=name, count=count) for name, count
+                          in sorted(session_types.items())],
+            minutes=self.minutes,
+            speakers=len(self.speakers or {}),
+            registrations=self.registrations,
+            wishlists=[CountForm(name=name, count=count) for name, count
+                       in sorted((self.wishlists or {}).items(),
+                                 key=lambda item: item[1], reverse=True)])
+
+
+class CountForm(messages.Message):
+    """CountForm -- a named count"""
+    name = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class FacetForm(messages.Message):
+    """FacetForm -- counts of the values of one Conference facet"""
+    field = messages.StringField(1)
+    values = messages.MessageField(CountForm, 2, repeated=True)
+
+
+class FacetForms(messages.Message):
+    """FacetForms -- Conference facet counts outbound form message"""
+    total = messages.IntegerField(1)
+    items = messages.MessageField(FacetForm, 2, repeated=True)
+
+
+class FacetShard(ndb.Model):
+    """FacetShard -- facet values of a share of the Conferences, keyed by
+    web-safe Conference key (see facets.py)"""
+    rows = ndb.JsonProperty(compressed=True)
+
+
+class FacetValues(ndb.Model):
+    """FacetValues -- names of the counters of every facet value seen so far
+    (see facets.py)"""
+    names = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class ConferenceStatsForm(messages.Message):
+    """ConferenceStatsForm -- Conference statistics outbound form message"""
+    websafeConferenceKey = messages.StringField(1)
+    sessions = messages.IntegerField(2)
+    sessionTypes = messages.MessageField(CountForm, 3, repeated=True)
+    minutes = messages.IntegerField(4)
+    speakers = messages.IntegerField(5)
+    registrations = messages.IntegerField(6)
+    wishlists = messages.MessageField(CountForm, 7, repeated=True)
 
 
 # - - - - - - - - - - - - - - - - - - - -
@@ -143,6 +306,18 @@ class ConferenceWishlist(ndb.Model):
     conferenceKey = ndb.KeyProperty(kind='Conference', required=True)
     sessionKeys = ndb.KeyProperty(kind='Session', repeated=True)
 
+    @staticmethod
+    def key_for(profile_key, conf_key):
+        """
+        Key of a user's wishlist for a Conference, so it can be read with a
+        get inside a transaction instead of an ancestor query
+        :param profile_key: Profile key
+        :param conf_key: Conference key
+        :return: ndb.Key
+        """
+        return ndb.Key(ConferenceWishlist, conf_key.urlsafe(),
+                       parent=profile_key)
+
     def to_form(self):
         """
         Creates the ConferenceWishlistForm representation of the model object
@@ -176,18 +351,89 @@ class SessionType(messages.Enum):
     WORKSHOP = 3
 
 
+class IdempotencyRecord(ndb.Model):
+    """IdempotencyRecord -- stored response of a request made with an
+    idempotency key (see idempotency.py)"""
+    response = ndb.TextProperty()
+    expires = ndb.DateTimeProperty()
+
+
+class Tombstone(ndb.Model):
+    """Tombstone -- marks a deleted Conference, Session or Speaker for
+    clients syncing changes (see sync.py), keyed by its web-safe key under
+    the deleted entity's parent, so writing it adds no entity group to the
+    delete"""
+    kind = ndb.StringProperty(indexed=False)
+    modified = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def for_key(key):
+        """
+        Tombstone of a deleted entity
+        :param key: key of the deleted entity
+        :return: Tombstone
+        """
+        return Tombstone(id=key.urlsafe(), kind=key.kind(),
+                         parent=key.parent())
+
+
+class CatalogueBlob(ndb.Model):
+    """CatalogueBlob -- one gzipped file of the public catalogue snapshot,
+    keyed by file name (see catalogue.py)"""
+    content = ndb.BlobProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class CounterShard(ndb.Model):
+    """CounterShard -- one shard of a sharded counter (see counters.py)"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class MapperJob(ndb.Model):
+    """MapperJob -- one run of a mapper over a kind (see mapper.py)"""
+    name = ndb.StringProperty(required=True)
+    shards = ndb.IntegerProperty()
+    started = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class MapperShard(ndb.Model):
+    """MapperShard -- progress checkpoint of one key range of a MapperJob"""
+    name = ndb.StringProperty(required=True)
+    startKey = ndb.KeyProperty(indexed=False)
+    endKey = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    slice = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    puts = ndb.IntegerProperty(default=0, indexed=False)
+    deletes = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
 class Speaker(ndb.Model):
     """Speaker -- Session speaker"""
     name = ndb.StringProperty(required=True)
     title = ndb.StringProperty()
+    # legacy: session counts now live in sharded counters, see counter_name()
     numSessions = ndb.IntegerProperty(default=0)
+    modified = ndb.DateTimeProperty(auto_now=True)
 
-    def to_form(self):
+    def to_form(self, num_sessions=None):
         """ Converts Speaker to SpeakerForm messages
+        :param num_sessions: number of Sessions the Speaker is presenting
         :return: SpeakerForm
         """
         return SpeakerForm(name=self.name, title=self.title,
-                           numSessions=self.numSessions)
+                           numSessions=num_sessions)
+
+    @staticmethod
+    def counter_name(key):
+        """ Name of the sharded counter tracking a Speaker's Session count
+        :param key: Speaker key
+        :return: string
+        """
+        return 'speaker-sessions-%s' % key.urlsafe()
 
     @staticmethod
     def from_form(form):
@@ -200,8 +446,16 @@ class Speaker(ndb.Model):
 
         return Speaker(name=form.name,
                        title=form.title,
-                       numSessions=form.numSessions,
-                       key=ndb.Key(Speaker, form.name + form.title))
+                       key=Speaker.key_for(form.name, form.title))
+
+    @staticmethod
+    def key_for(name, title):
+        """ Deterministic Speaker key built from the name and title
+        :param name: Speaker name
+        :param title: Speaker title
+        :return: ndb.Key
+        """
+        return ndb.Key(Speaker, name + title)
 
 
 class SpeakerForm(messages.Message):
@@ -222,15 +476,41 @@ class Session(ndb.Model):
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
     conferenceKey = ndb.KeyProperty(kind='Conference')
+    modified = ndb.DateTimeProperty(auto_now=True)
+    # date and time combined, so a time window is a single range filter
+    startDateTime = ndb.ComputedProperty(lambda self: self._start_datetime())
+    endDateTime = ndb.ComputedProperty(lambda self: self._end_datetime())
+
+    def _start_datetime(self):
+        """
+        When the Session starts
+        :return: datetime, or None without both a date and a start time
+        """
+        if not self.date or not self.startTime:
+            return None
+        return datetime.combine(self.date, self.startTime)
 
-    def to_form(self, speaker_forms=None):
+    def _end_datetime(self):
+        """
+        When the Session ends, i.e. its start plus its duration in minutes
+        :return: datetime, or None without both a date and a start time
+        """
+        start = self._start_datetime()
+        if not start:
+            return None
+        return start + timedelta(minutes=self.duration or 0)
+
+    def to_form(self, speaker_forms=None, fields=None):
         """
         Create the corresponding SessionForm RPC message
         :param speaker_forms:
+        :param fields: Optional field mask; only these form fields are set
         :return: SessionForm
         """
         sf = SessionForm()
         for field in sf.all_fields():
+            if fields and field.name not in fields:
+                continue
             if hasattr(self, field.name):
                 # matching/common fields between classes
                 if field.name == 'date' and self.date:
@@ -241,7 +521,8 @@ class Session(ndb.Model):
                     setattr(sf, field.name, getattr(self, field.name))
             elif field.name == 'websafeConfKey':
                 setattr(sf, field.name, self.conferenceKey.urlsafe())
-        setattr(sf, 'websafeKey', self.key.urlsafe())
+        if not fields or 'websafeKey' in fields:
+            setattr(sf, 'websafeKey', self.key.urlsafe())
 
         if speaker_forms:
             sf.speakers = speaker_forms
@@ -253,7 +534,8 @@ class Session(ndb.Model):
         """
         Creates a new Session object from the given SessionForm.
 
-        Note: does not set conferenceKey or speakerKeys or even the Session key
+        Note: does not set speakerKeys or the Session key; Session ids are
+        allocated (see allocate_key) and name uniqueness is kept by SessionName
         :param form: SessionForm
         :return: Session
         """
@@ -278,10 +560,34 @@ class Session(ndb.Model):
         if form.date:
             s.date = datetime.strptime(form.date[:10], '%Y-%m-%d').date()
 
-        s.key = ndb.Key(Session, s.name, parent=conf_key)
-
         return s
 
+    @staticmethod
+    def allocate_key(conf_key):
+        """
+        Allocate a new Session key under the given Conference
+        :param conf_key: Conference key
+        :return: ndb.Key
+        """
+        s_id = Session.allocate_ids(size=1, parent=conf_key)[0]
+        return ndb.Key(Session, s_id, parent=conf_key)
+
+
+class SessionName(ndb.Model):
+    """SessionName -- per-Conference index of Session names, keeping them
+    unique. Lives in the Conference's entity group alongside the Sessions."""
+    sessionKey = ndb.KeyProperty(kind='Session', required=True)
+
+    @staticmethod
+    def key_for(conf_key, name):
+        """
+        Key of the index entry for a Session name within a Conference
+        :param conf_key: Conference key
+        :param name: Session name
+        :return: ndb.Key
+        """
+        return ndb.Key(SessionName, name, parent=conf_key)
+
 
 class SessionForm(messages.Message):
     """SessionForm -- RPC message containing details about a Session"""
@@ -294,11 +600,36 @@ class SessionForm(messages.Message):
     startTime = messages.StringField(7)
     websafeConfKey = messages.StringField(8)
     websafeKey = messages.StringField(9)
+    idempotencyKey = messages.StringField(10)
 
 
 class SessionForms(messages.Message):
     """SessionForms -- multiple SessionForm's"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+    sortPath = messages.EnumField(SortPath, 4)
+    capped = messages.BooleanField(5)  # sorted in memory over a capped scan
+
+
+class SessionsAtForm(messages.Message):
+    """SessionsAtForm -- the Sessions of a Conference on at a time, and those
+    starting next"""
+    time = messages.StringField(1)
+    now = messages.MessageField(SessionForm, 2, repeated=True)
+    next = messages.MessageField(SessionForm, 3, repeated=True)
+
+
+class ChangesForm(messages.Message):
+    """ChangesForm -- a page of the Conferences, Sessions and Speakers
+    changed since a sync token"""
+    conferences = messages.MessageField(ConferenceForm, 1, repeated=True)
+    sessions = messages.MessageField(SessionForm, 2, repeated=True)
+    speakers = messages.MessageField(SpeakerForm, 3, repeated=True)
+    deleted = messages.StringField(4, repeated=True)
+    nextToken = messages.StringField(5)
+    more = messages.BooleanField(6)
+    reset = messages.BooleanField(7)
 
 
 class TeeShirtSize(messages.Enum):
@@ -339,9 +670,13 @@ class ConferenceQueryForm(messages.Message):
     field = messages.StringField(1)
     operator = messages.StringField(2)
     value = messages.StringField(3)
+    values = messages.StringField(4, repeated=True)  # for the IN operator
 
 
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form
     message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    fields = messages.StringField(2, repeated=True)
+    sortBy = messages.StringField(3)  # e.g. 'START_DATE' or '-SEATS_AVAILABLE'
+    numResults = messages.IntegerField(4)  # every match if not given
@@ -7,16 +7,16 @@ profile.py -- Udacity conference server-side Python App Engine API;
 """
 
 import endpoints
-from google.appengine.ext import ndb
 from protorpc import remote
 from protorpc.message_types import VoidMessage
 
-from models import Profile
+import versions
+from context import UserContext, require_oauth
+from models import Conference
 from models import ProfileForm
 from models import ProfileMiniForm
-from models import TeeShirtSize
+from models import Registration
 from settings import API
-from utils import get_user_id, require_oauth
 
 __author__ = 'voutilad@gmail.com (Dave Voutila)'
 
@@ -32,72 +32,60 @@ class ProfileApi(remote.Service):
     @endpoints.method(VoidMessage, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
     @require_oauth
-    def get(self, request):
+    def get(self, request, ctx=None):
         """
         Return user Profile
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
         if not isinstance(request, VoidMessage):
             raise endpoints.BadRequestException()
 
-        return self._do_profile()
+        return self._do_profile(ctx)
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
     @require_oauth
-    def save(self, request):
+    def save(self, request, ctx=None):
         """
         Update & return user profile.
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
 
-        return self._do_profile(request)
+        return self._do_profile(ctx, request)
 
     #
     # - - - Profile Public Methods - - - - - - - - - - - - - - - - - - -
     #
 
     @staticmethod
-    def profile_from_user():
+    def profile_from_user(ctx=None):
         """
         Return user Profile from datastore, creating new one if non-existent.
+        :param ctx: (optional) UserContext already resolved for the request
         :return: Profile model for the current endpoint user
         """
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # get Profile from datastore
-        user_id = get_user_id(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile  # return Profile
+        return (ctx or UserContext.current()).profile
 
     #
     # - - - Profile Private Methods - - - - - - - - - - - - - - - - - - -
     #
 
-    def _do_profile(self, save_request=None):
+    def _do_profile(self, ctx, save_request=None):
         """
         Get user Profile and return to user, possibly updating it first.
+        :param ctx: UserContext for the requesting user
         :param save_request: ProfileForm with updates (if any) for the Profile
         :return: ProfileForm for the current endpoints user
         """
-        # get user Profile
-        prof = self.profile_from_user()
+        # get user Profile, then their registrations; any still in the
+        # legacy conferencesToAttend list are migrated first so the query
+        # finds them
+        prof = ctx.migrate_registrations()
+        attending = Registration.attending_async(ctx.profile_key)
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
@@ -112,5 +100,11 @@ class ProfileApi(remote.Service):
                         #    setattr(prof, field, val)
                         prof.put()
 
+            if save_request.displayName:
+                # organiser name is part of the user's ConferenceForms
+                for c_key in Conference.query(ancestor=prof.key) \
+                        .fetch(keys_only=True):
+                    versions.bump(versions.conference_scope(c_key))
+
         # return ProfileForm
-        return prof.to_form()
+        return prof.to_form(attending.get_result())
@@ -5,15 +5,24 @@
 Logic related to querying the ConferenceCentral object model.
 
 """
+import hashlib
+import heapq
+import itertools
+import logging
+import os
 from datetime import datetime
 
 import endpoints
+import yaml
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 from protorpc import messages
 from protorpc.messages import FieldList
 
+import cache
+import versions
 from models import Conference, Session, Profile, ConferenceWishlist
+from models import SortPath
 
 __author__ = 'voutilad@gmail.com (Dave Voutila)'
 
@@ -35,7 +44,9 @@ FIELD_MAP = {
         'DATE': 'date',
         'START_TIME': 'startTime',
         'DURATION': 'duration',
-        'HIGHLIGHTS': 'highlights'
+        'HIGHLIGHTS': 'highlights',
+        'START': 'startDateTime',
+        'END': 'endDateTime'
     },
     ConferenceWishlist: {
         'CONF_KEY': 'conferenceKeys',
@@ -49,6 +60,72 @@ SORT_MAP = {
     Profile: Profile.displayName
 }
 
+# Fields a QueryForm can sort_by, prefixed with '-' for descending
+SORT_FIELDS = {
+    Conference: {
+        'NAME': 'name',
+        'CITY': 'city',
+        'START_DATE': 'startDate',
+        'END_DATE': 'endDate',
+        'MONTH': 'month',
+        'MAX_ATTENDEES': 'maxAttendees',
+        'SEATS_AVAILABLE': 'seatsAvailable',
+    },
+    Session: {
+        'NAME': 'name',
+        'DATE': 'date',
+        'START_TIME': 'startTime',
+        'DURATION': 'duration',
+        'START': 'startDateTime',
+        'END': 'endDateTime',
+    },
+    Profile: {
+        'NAME': 'displayName',
+    },
+}
+
+# Form fields a projection query can fill in, with the model property each
+# needs (None when the key alone is enough)
+PROJECTION_MAP = {
+    Conference: {
+        'name': 'name',
+        'organizerUserId': 'organizerUserId',
+        'city': 'city',
+        'startDate': 'startDate',
+        'month': 'month',
+        'maxAttendees': 'maxAttendees',
+        'seatsAvailable': 'seatsAvailable',
+        'endDate': 'endDate',
+        'websafeKey': None,
+    },
+    Session: {
+        'name': 'name',
+        'duration': 'duration',
+        'typeOfSession': 'typeOfSession',
+        'date': 'date',
+        'startTime': 'startTime',
+        'websafeConfKey': 'conferenceKey',
+        'websafeKey': None,
+    },
+}
+
+# Counts stop at this many matches
+MAX_COUNT = 1000
+
+# Most subqueries IN filters and OR groups may expand into
+MAX_SUBQUERIES = 30
+
+# Queries sorted in memory read at most this many entities per subquery
+MAX_SCAN = 1000
+
+INDEX_YAML = os.path.join(os.path.dirname(__file__), 'index.yaml')
+
+# Memoized kind name -> list of (ancestor, ((property, descending), ...))
+_INDEXES = {}
+
+# Memoized (kind, model field name) -> (property, enum values or None)
+_FIELD_PLANS = {}
+
 
 class QueryOperator(messages.Enum):
     """QueryOperator -- enum of valid filter operators for query"""
@@ -58,6 +135,7 @@ class QueryOperator(messages.Enum):
     LT = 4
     LTEQ = 5
     NE = 6
+    IN = 7
 
 
 class QueryTarget(messages.Enum):
@@ -69,56 +147,262 @@ class QueryTarget(messages.Enum):
 
 class QueryFilter(messages.Message):
     """
-    Query object containing target field, operator, and value
+    Query object containing target field, operator, and value (or values, for
+    the IN operator)
     """
     field = messages.StringField(1, required=True)
     operator = messages.EnumField(QueryOperator, 2, required=True)
-    value = messages.StringField(3, required=True)
+    value = messages.StringField(3)
+    values = messages.StringField(4, repeated=True)
+
+
+class QueryGroup(messages.Message):
+    """
+    QueryGroup -- filters AND-ed together as one alternative of an OR
+    """
+    filters = messages.MessageField(QueryFilter, 1, repeated=True)
 
 
 class QueryForm(messages.Message):
     """
     QueryForm containing one or many QueryMessages as query filters, target kind
      (e.g. 'Conference'), and the
-    max number of results to return.
+    max number of results to return (every match if not given). Results must
+    also match at least one of the anyOf groups, if given.
     """
     target = messages.EnumField(QueryTarget, 1, required=True)
     filters = messages.MessageField(QueryFilter, 2, repeated=True)
-    num_results = messages.IntegerField(3, default=20)
+    num_results = messages.IntegerField(3)
     sort_by = messages.StringField(4)
     ancestorWebSafeKey = messages.StringField(5)
+    fields = messages.StringField(6, repeated=True)
+    anyOf = messages.MessageField(QueryGroup, 7, repeated=True)
 
 
-def query(query_form, ancestor=None):
+class _Descending(object):
     """
-    Return formatted query from the submitted filters.
+    Wraps a value so that it sorts in reverse
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _sort_key(orders):
+    """
+    Sort key function for entities
+    :param orders: list of (model property name, descending)
+    :return: function of an entity
+    """
+    def key(entity):
+        return tuple(_Descending(getattr(entity, name)) if descending
+                     else getattr(entity, name)
+                     for name, descending in orders)
+    return key
+
+
+class MergedQuery(object):
+    """
+    MergedQuery -- the union of queries sharing a sort order. The queries
+    run concurrently, each reading at most limit results, and are k-way
+    merged on the sort order, dropping duplicates.
+    """
+
+    sort_path = SortPath.DATASTORE
+    capped = False
+
+    def __init__(self, queries, orders, limit=None):
+        """
+        :param queries: list of ndb.Query, each sorted on orders
+        :param orders: list of (model property name, descending) the queries
+        sort on
+        :param limit: max results, or None for every match
+        """
+        self.queries = queries
+        self.orders = orders
+        self.limit = limit
+        self._results = None
+
+    def fetch(self):
+        """
+        Run the queries and merge their results
+        :return: list of at most limit entities (all if limit is None), in
+        sort order
+        """
+        if self._results is not None:
+            return self._results
+
+        # issue every query before waiting on any
+        futures = [q.fetch_async(self.limit) for q in self.queries]
+        key = _sort_key(self.orders)
+        streams = [((key(entity), i, n, entity)
+                    for n, entity in enumerate(future.get_result()))
+                   for i, future in enumerate(futures)]
+
+        results = []
+        seen = set()
+        for _, _, _, entity in heapq.merge(*streams):
+            if entity.key in seen:
+                continue
+            seen.add(entity.key)
+            results.append(entity)
+            if len(results) == self.limit:
+                break
+
+        self._results = results
+        return results
+
+    def count(self, limit=MAX_COUNT):
+        """
+        Keys-only count of the distinct entities the queries match
+        :param limit: max count
+        :return: int count, at most limit
+        """
+        futures = [q.fetch_async(limit, keys_only=True) for q in self.queries]
+        keys = set()
+        for future in futures:
+            keys.update(future.get_result())
+        return min(len(keys), limit)
+
+    def __iter__(self):
+        return iter(self.fetch())
+
+    def __str__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(str(q) for q in self.queries))
+
+
+class TopKQuery(MergedQuery):
+    """
+    TopKQuery -- queries whose sort order no index serves. Each runs
+    unsorted, reading at most MAX_SCAN results, and the top limit of their
+    union are selected in memory with a heap. If any query hit MAX_SCAN the
+    results are only the top of what was read, so capped is set.
+    """
+
+    sort_path = SortPath.IN_MEMORY
+
+    def fetch(self):
+        """
+        Run the queries and select the first results in sort order
+        :return: list of at most limit entities (all read if limit is None),
+        in sort order
+        """
+        if self._results is not None:
+            return self._results
+
+        futures = [q.fetch_async(MAX_SCAN) for q in self.queries]
+        entities = {}
+        for future in futures:
+            results = future.get_result()
+            if len(results) == MAX_SCAN:
+                self.capped = True
+            for entity in results:
+                entities[entity.key] = entity
+        if self.capped:
+            logging.warning('Sort scan capped at %d: %s', MAX_SCAN, self)
+
+        key = _sort_key(self.orders)
+        if self.limit is None:
+            self._results = sorted(entities.values(), key=key)
+        else:
+            self._results = heapq.nsmallest(self.limit, entities.values(),
+                                            key=key)
+        return self._results
+
+
+def sort_path(q):
+    """
+    How the results of a query built by query() get sorted
+    :param q: ndb.Query, MergedQuery or TopKQuery
+    :return: SortPath
+    """
+    return getattr(q, 'sort_path', SortPath.DATASTORE)
+
+
+def capped(q):
+    """
+    Whether the results of a query built by query() may be missing matches
+    that sort before them, because an in-memory sort stopped reading at
+    MAX_SCAN. Only known once the query has been iterated.
+    :param q: ndb.Query, MergedQuery or TopKQuery
+    :return: bool
+    """
+    return getattr(q, 'capped', False)
+
+
+def query(query_form, ancestor=None, fields=None):
+    """
+    Return formatted query from the submitted filters. IN filters and anyOf
+    groups are expanded into one subquery per combination, run as a
+    MergedQuery. A sort_by that no index can serve makes it a TopKQuery,
+    sorted in memory. Whichever is returned, it yields at most num_results
+    entities if the form sets it and every match otherwise.
     :param query_form: QueryForm message
     :param ancestor: ancestor Key
-    :return: reference to ndb entity query object
+    :param fields: optional field mask of the forms that will be built from the
+    results; if a projection query can serve it, one is used
+    :return: reference to ndb entity query object, MergedQuery or TopKQuery
     """
     if not isinstance(query_form, QueryForm):
         raise TypeError('Expected %s but got %s' % (QueryForm, query_form))
 
     # get a reference to the proper model class and use it to format the filters
     kind = __get_kind(query_form.target)
-    inequality_filter, filters = __format_filters(query_form.filters, kind)
-
-    # If exists, sort on inequality filter first
-    q = kind(parent=ancestor).query(ancestor=ancestor)
-    if not inequality_filter:
-        q = q.order(SORT_MAP[kind])
+    inequality_filter, branches = __expand(query_form, kind)
+
+    sort = __get_sort(kind, query_form.sort_by)
+    if not sort:
+        # If exists, sort on inequality filter first
+        orders = [(SORT_MAP[kind]._name, False)]
+        if inequality_filter:
+            orders.insert(0, (inequality_filter, False))
+    elif __indexed(kind, ancestor, inequality_filter, branches, sort):
+        orders = [sort]
     else:
-        q = q.order(ndb.GenericProperty(inequality_filter))
-        q = q.order(SORT_MAP[kind])
+        # no index for the sort, so only keep the order the inequality needs
+        orders = [(inequality_filter, False)] if inequality_filter else []
+        queries = [__build_query(kind, ancestor, fields, filters, orders,
+                                 extra=[sort[0]]) for filters in branches]
+        return TopKQuery(queries, [sort], query_form.num_results)
+
+    queries = [__build_query(kind, ancestor, fields, filters, orders)
+               for filters in branches]
+    if len(queries) == 1 and not query_form.num_results:
+        return queries[0]
+    return MergedQuery(queries, orders, query_form.num_results)
+
+
+def __build_query(kind, ancestor, fields, filters, orders, extra=()):
+    """
+    Build the query for one conjunction of formatted filters
+    :param kind: model class
+    :param ancestor: ancestor Key
+    :param fields: optional field mask, see query()
+    :param filters: formatted filters (as list of dicts)
+    :param orders: list of (model property name, descending) to sort on
+    :param extra: model property names a projection also needs, e.g. to sort
+    in memory
+    :return: ndb.Query
+    """
+    props = projection(kind, fields,
+                       filters=[f['field'] for f in filters
+                                if f['operator'] in ('=', 'in')],
+                       orders=orders, extra=extra, ancestor=ancestor)
+
+    q = kind(parent=ancestor).query(ancestor=ancestor, projection=props)
+    for name, descending in orders:
+        prop = ndb.GenericProperty(name)
+        q = q.order(-prop if descending else prop)
 
     for f in filters:
-        # current casting logic.
-        if f["field"] in ["month", "maxAttendees"]:
-            f["value"] = int(f["value"])
-        elif f['field'] in ['startTime']:
-            # need to pass build time object
-            filter_time = __parse_time(f['value'], '%H:%M')
-            f['value'] = filter_time
         formatted_query = ndb.query.FilterNode(f['field'], f['operator'],
                                                f['value'])
         q = q.filter(formatted_query)
@@ -127,6 +411,215 @@ def query(query_form, ancestor=None):
     return q
 
 
+def __get_sort(kind, sort_by):
+    """
+    Parse a QueryForm sort_by, e.g. 'START_DATE' or '-SEATS_AVAILABLE'
+    :param kind: model class
+    :param sort_by: string, or None
+    :return: tuple of (model property name, descending), or None
+    """
+    if not sort_by:
+        return None
+
+    descending = sort_by.startswith('-')
+    field = SORT_FIELDS.get(kind, {}).get(sort_by.lstrip('-'))
+    if not field:
+        raise endpoints.BadRequestException(
+            'Cannot sort by %s, choose one of: %s' % (
+                sort_by, ', '.join(sorted(SORT_FIELDS.get(kind, {})))))
+    return field, descending
+
+
+def __indexed(kind, ancestor, inequality_filter, branches, sort):
+    """
+    Whether every subquery can be sorted by the datastore: the sort has to
+    follow any inequality filter's property, and a built-in or index.yaml
+    index has to cover the filters and sort
+    :param kind: model class
+    :param ancestor: ancestor Key, or None
+    :param inequality_filter: model property with an inequality filter, or
+    None
+    :param branches: conjunctions of formatted filters, see __expand()
+    :param sort: tuple of (model property name, descending)
+    :return: bool
+    """
+    if inequality_filter and inequality_filter != sort[0]:
+        return False
+
+    for filters in branches:
+        equalities = set(f['field'] for f in filters if f['operator'] == '=')
+        if not equalities and not ancestor:
+            continue  # a single property index serves it
+
+        served = False
+        for index_ancestor, props in __get_indexes(kind):
+            if index_ancestor != bool(ancestor) or \
+                    len(props) != len(equalities) + 1:
+                continue
+            # equality properties first, in any order, then the sort
+            if set(name for name, _ in props[:-1]) == equalities and \
+                    props[-1] == sort:
+                served = True
+                break
+        if not served:
+            return False
+    return True
+
+
+def __get_indexes(kind):
+    """
+    Composite indexes of a kind, as listed in index.yaml
+    :param kind: model class
+    :return: list of (ancestor, tuple of (property name, descending))
+    """
+    if not _INDEXES:
+        _INDEXES.update(__load_indexes())
+    return _INDEXES.get(kind._get_kind(), [])
+
+
+def __load_indexes():
+    """
+    Parse the composite indexes out of index.yaml
+    :return: dict of kind name -> list of (ancestor, tuple of (property name,
+    descending)), plus a None entry marking it loaded
+    """
+    indexes = {None: []}
+    try:
+        with open(INDEX_YAML) as f:
+            config = yaml.safe_load(f) or {}
+    except IOError:
+        logging.warning('No %s, assuming no composite indexes', INDEX_YAML)
+        config = {}
+
+    for index in config.get('indexes') or []:
+        props = tuple((prop['name'], prop.get('direction') == 'desc')
+                      for prop in index.get('properties', []))
+        indexes.setdefault(index['kind'], []).append(
+            (index.get('ancestor') in (True, 'yes'), props))
+    return indexes
+
+
+def count(query_form, ancestor=None, limit=MAX_COUNT):
+    """
+    Keys-only count of the entities matching a QueryForm, up to limit. Counts
+    are cached by the normalized filters and invalidated by the kind's
+    version, which is bumped on writes.
+    :param query_form: QueryForm message
+    :param ancestor: ancestor Key
+    :param limit: max count
+    :return: int count, at most limit
+    """
+    scope = versions.kind_scope(__get_kind(query_form.target))
+
+    def normalized(filters):
+        return sorted((f.field, str(f.operator), f.value, sorted(f.values))
+                      for f in filters)
+
+    shape = repr((normalized(query_form.filters),
+                  sorted(normalized(g.filters) for g in query_form.anyOf),
+                  ancestor.urlsafe() if ancestor else None, limit))
+    key = '%s-%s-%s' % (scope, versions.get_version(scope),
+                        hashlib.sha1(shape).hexdigest()[:16])
+    return cache.HOT.get(
+        key, lambda: query(query_form, ancestor=ancestor).count(limit=limit),
+        versioned=True)
+
+
+def projection(kind, fields, filters=(), orders=(), extra=(), ancestor=None):
+    """
+    Properties to project to serve a field mask, if a projection query can.
+    Repeated properties would duplicate results and properties with equality
+    or membership filters can't be projected, so either rules it out. So does
+    the lack of an index serving the projection: callers then fetch whole
+    entities and the forms leave out the unwanted fields.
+    :param kind: model class
+    :param fields: set of form field names, or None for every field
+    :param filters: model properties with equality or membership filters
+    :param orders: list of (model property name, descending) the datastore
+    sorts on, any inequality filter's property first
+    :param extra: model properties also needed, e.g. to sort in memory
+    :param ancestor: ancestor Key, or None
+    :return: sorted list of property names, or None
+    """
+    field_map = PROJECTION_MAP.get(kind)
+    if not fields or not field_map or not set(fields) <= set(field_map):
+        return None
+
+    props = set(field_map[field] for field in fields if field_map[field])
+    props.update(name for name, _ in orders)
+    props.update(extra)
+    if not props or props & set(filters):
+        return None
+    if any(getattr(kind, prop)._repeated for prop in props):
+        return None
+    if not __projection_indexed(kind, props, set(filters), list(orders),
+                                bool(ancestor)):
+        return None
+
+    return sorted(props)
+
+
+def __projection_indexed(kind, props, equalities, orders, ancestor):
+    """
+    Whether an index serves a projection query: a built-in one for a single
+    property with no filters or ancestor, otherwise an index.yaml index
+    listing the equality filters' properties (in any order), then the sort
+    orders, then the rest of the projected properties (in any order)
+    :param kind: model class
+    :param props: set of projected model property names
+    :param equalities: set of model properties with equality filters
+    :param orders: list of (model property name, descending)
+    :param ancestor: whether the query has an ancestor
+    :return: bool
+    """
+    if len(props) == 1 and not equalities and not ancestor:
+        return True
+
+    rest = props - set(name for name, _ in orders)
+    for index_ancestor, index_props in __get_indexes(kind):
+        if index_ancestor != ancestor or \
+                len(index_props) != len(equalities) + len(props):
+            continue
+        head = index_props[:len(equalities)]
+        middle = index_props[len(equalities):len(equalities) + len(orders)]
+        tail = index_props[len(equalities) + len(orders):]
+        if set(name for name, _ in head) == equalities and \
+                list(middle) == orders and \
+                set(name for name, _ in tail) == rest:
+            return True
+    return False
+
+
+def warm():
+    """
+    Build the field plans for every queriable field and load the index list
+    up front, e.g. from the warmup handler
+    :return:
+    """
+    for kind, field_map in FIELD_MAP.items():
+        for field in field_map.values():
+            __get_field_plan(kind, field)
+    __get_indexes(Conference)
+
+
+def __get_field_plan(kind, field):
+    """
+    Resolve how filters on a field of a kind are built: the model property
+    and, for EnumProperty fields, the enum's name -> value map
+    :param kind: model class
+    :param field: model field name
+    :return: tuple of (property or None, dict of enum values or None)
+    """
+    plan = _FIELD_PLANS.get((kind, field))
+    if plan is None:
+        prop = getattr(kind, str(field), None)
+        enum_values = None
+        if isinstance(prop, msgprop.EnumProperty):
+            enum_values = prop._enum_type.to_dict()
+        plan = _FIELD_PLANS[(kind, field)] = (prop, enum_values)
+    return plan
+
+
 def __get_operator(enum):
     """
     Get the appropriate query filter operator corresponding to the Enum value
@@ -149,6 +642,8 @@ def __get_operator(enum):
         return '<='
     elif enum == QueryOperator.NE:
         return '!='
+    elif enum == QueryOperator.IN:
+        return 'in'
 
 
 def __get_kind(enum):
@@ -203,7 +698,7 @@ def __format_filters(query_filters, kind):
         if not isinstance(qf, QueryFilter):
             raise TypeError('expected %s, but got %s' % (QueryFilter, qf))
 
-        filtr = {'value': qf.value}
+        filtr = {}
 
         try:
             filtr['field'] = __get_field(kind, qf.field)
@@ -211,43 +706,125 @@ def __format_filters(query_filters, kind):
         except KeyError:
             raise endpoints.BadRequestException(
                 "Filter contains invalid field or operator.")
+        if not filtr['field']:
+            raise endpoints.BadRequestException(
+                "Filter contains invalid field or operator.")
 
-        # Every operation except "=" is an inequality
-        if filtr["operator"] != "=":
-            # TODO: handle operator of != on a finite field aka our enum fields!
-            # Remember that you need to do
-            # ndb.query.FilterNode('typeOfSession', 'in', [1, 2])
-
+        enum_values = __get_field_plan(kind, filtr['field'])[1]
+        if filtr['operator'] == 'in':
+            if not qf.values:
+                raise endpoints.BadRequestException(
+                    'IN filter on %s needs values' % qf.field)
+            filtr['value'] = [__cast(filtr['field'], qf.field, value,
+                                     enum_values) for value in qf.values]
+        elif qf.value is None:
+            raise endpoints.BadRequestException(
+                'Filter on %s needs a value' % qf.field)
+        elif filtr['operator'] == '=':
+            filtr['value'] = __cast(filtr['field'], qf.field, qf.value,
+                                    enum_values)
+        elif enum_values is not None:
+            # enums are finite, so the inequality can be rewritten as an IN of
+            # every other value instead of using up the inequality filter
+            filtr['operator'] = 'in'
+            if qf.value not in enum_values:
+                raise endpoints.BadRequestException(
+                    'Unknown value for %s: %s' % (qf.field, qf.value))
+
+            # build the filter values (ints) from every other enum value
+            # since our FilterNode needs to use the underlying ints
+            filtr['value'] = [value for name, value in enum_values.items()
+                              if name != qf.value]
+        else:
             # check if inequality operation has been used in previous filters
             # disallow the filter if inequality was performed on a different
             # field before track the field on which the inequality operation
             # is performed
-            if isinstance(getattr(kind, str(filtr['field'])),
-                          msgprop.EnumProperty):
-                # we need to convert these to 'in' query filters
-                filtr['operator'] = 'in'
-
-                # get dict representation of the Enum, delete the key we want
-                # to exclude
-                # TODO: This is super hacky...gotta be a better way.
-                enum_dict = getattr(kind, str(filtr['field'])).\
-                    _enum_type.to_dict()
-                del enum_dict[filtr['value']]
-
-                # build the filter values (ints) since our FilterNode needs to
-                # use the underlying ints
-                filtr['value'] = enum_dict.values()
-            else:
-                if inequality_field and inequality_field != filtr['field']:
-                    raise endpoints.BadRequestException(
-                        'Inequality filter is allowed on only one field.')
-                else:
-                    inequality_field = filtr['field']
+            if inequality_field and inequality_field != filtr['field']:
+                raise endpoints.BadRequestException(
+                    'Inequality filter is allowed on only one field.')
+            inequality_field = filtr['field']
+            filtr['value'] = __cast(filtr['field'], qf.field, qf.value,
+                                    enum_values)
 
         formatted_filters.append(filtr)
     return inequality_field, formatted_filters
 
 
+def __cast(field, client_field, value, enum_values=None):
+    """
+    Convert a filter value string to the type of the model field
+    :param field: model field name
+    :param client_field: field name the client used, for error messages
+    :param value: string value
+    :param enum_values: the field's enum name -> value map, if it's an enum
+    :return: value to filter on
+    """
+    if enum_values is not None:
+        if value not in enum_values:
+            raise endpoints.BadRequestException(
+                'Unknown value for %s: %s' % (client_field, value))
+        return enum_values[value]
+
+    try:
+        if field in ['month', 'maxAttendees']:
+            return int(value)
+        elif field in ['startTime']:
+            # need to pass build time object
+            return __parse_time(value, '%H:%M')
+        elif field in ['startDateTime', 'endDateTime']:
+            # e.g. '2016-05-24 10:00' or '2016-05-24T10:00'
+            return datetime.strptime(value[:16].replace('T', ' '),
+                                     '%Y-%m-%d %H:%M')
+    except ValueError:
+        raise endpoints.BadRequestException(
+            'Invalid value for %s: %s' % (client_field, value))
+    return value
+
+
+def __expand(query_form, kind):
+    """
+    Expand a QueryForm's filters, IN filters and anyOf groups into a
+    disjunction of conjunctions of equality and inequality filters, one per
+    subquery
+    :param query_form: QueryForm message
+    :param kind: entity kind the query is targeting
+    :return: tuple of (inequality filter shared by every conjunction,
+    list of conjunctions of formatted filters)
+    """
+    inequality_field, filters = __format_filters(query_form.filters, kind)
+    groups = [__format_filters(group.filters, kind)
+              for group in query_form.anyOf] or [(None, [])]
+
+    branches = []
+    inequality_fields = set()
+    for group_inequality, group_filters in groups:
+        if inequality_field and group_inequality and \
+                inequality_field != group_inequality:
+            raise endpoints.BadRequestException(
+                'Inequality filter is allowed on only one field.')
+        inequality_fields.add(inequality_field or group_inequality)
+
+        # one alternative per value of each IN filter
+        alternatives = [[dict(f, operator='=', value=value)
+                         for value in f['value']]
+                        if f['operator'] == 'in' else [f]
+                        for f in filters + group_filters]
+        size = reduce(lambda n, values: n * len(values), alternatives, 1)
+        if len(branches) + size > MAX_SUBQUERIES:
+            raise endpoints.BadRequestException(
+                'IN filters and OR groups may expand into at most %d '
+                'queries' % MAX_SUBQUERIES)
+        branches += [list(branch)
+                     for branch in itertools.product(*alternatives)]
+
+    # merging needs every subquery in the same order
+    if len(inequality_fields) > 1:
+        raise endpoints.BadRequestException(
+            'Every OR group must filter inequalities on the same field.')
+    return inequality_fields.pop(), branches
+
+
 def __parse_time(time_string, time_format):
     """
     Parses a time string in HH:MM format and properly sets the year to the
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+schedule.py -- per-Conference interval index answering "what's on now/next"
+
+Each instance keeps, per Conference, its Sessions' start and end times in
+sorted arrays alongside their ready-built SessionForms. A lookup checks the
+Conference's Sessions version (see versions.py) and then bisects the arrays,
+so a warm instance answers without reading the datastore. The index is
+rebuilt whenever the version moves on, and also records whether the
+Conference exists at all.
+
+"""
+
+import bisect
+import collections
+import datetime
+import threading
+
+import versions
+from models import Session
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+MAX_CONFERENCES = 100  # indexes kept per instance
+
+_lock = threading.Lock()
+_indexes = collections.OrderedDict()  # web-safe Conference key -> index
+
+
+class ScheduleIndex(object):
+    """
+    ScheduleIndex -- a Conference's scheduled Sessions as intervals
+    """
+
+    def __init__(self, version, intervals, found=True):
+        """
+        :param version: Sessions version the index was built from
+        :param intervals: list of (start, end, SessionForm)
+        :param found: whether the Conference exists
+        """
+        self.version = version
+        self.found = found
+        self.intervals = sorted(intervals, key=lambda i: i[0])
+        self.starts = [start for start, _, _ in self.intervals]
+        self.ends = sorted(end for _, end, _ in self.intervals)
+        self.max_duration = max([end - start for start, end, _
+                                 in self.intervals] or
+                                [datetime.timedelta(0)])
+
+    def now(self, at):
+        """
+        Sessions on at a point in time, i.e. started and not yet ended
+        :param at: datetime
+        :return: list of SessionForm, by start time
+        """
+        # started minus ended is how many are on, without looking at any
+        if bisect.bisect_right(self.starts, at) == \
+                bisect.bisect_right(self.ends, at):
+            return []
+
+        # anything on started no longer ago than the longest Session
+        lo = bisect.bisect_left(self.starts, at - self.max_duration)
+        hi = bisect.bisect_right(self.starts, at)
+        return [form for start, end, form in self.intervals[lo:hi]
+                if end > at]
+
+    def upcoming(self, at):
+        """
+        Sessions starting soonest after a point in time
+        :param at: datetime
+        :return: list of SessionForm, all with the same start time
+        """
+        lo = bisect.bisect_right(self.starts, at)
+        if lo == len(self.starts):
+            return []
+        hi = bisect.bisect_right(self.starts, self.starts[lo])
+        return [form for _, _, form in self.intervals[lo:hi]]
+
+
+def _build(conf_key, version, to_forms):
+    """
+    Build the index of a Conference's Sessions
+    :param conf_key: Conference key
+    :param version: current Sessions version
+    :param to_forms: function turning Sessions into SessionForms
+    :return: ScheduleIndex
+    """
+    conf = conf_key.get_async()
+    sessions = [session for session in Session.query(ancestor=conf_key)
+                if session.startDateTime]
+    return ScheduleIndex(version, zip(
+        [session.startDateTime for session in sessions],
+        [session.endDateTime for session in sessions],
+        to_forms(sessions)), found=conf.get_result() is not None)
+
+
+def index(conf_key, to_forms):
+    """
+    The index of a Conference's Sessions, built once per Sessions version per
+    instance
+    :param conf_key: Conference key
+    :param to_forms: function turning Sessions into SessionForms, used when
+    the index has to be (re)built
+    :return: ScheduleIndex
+    """
+    wsck = conf_key.urlsafe()
+    version = versions.get_version(versions.sessions_scope(conf_key))
+    with _lock:
+        current = _indexes.get(wsck)
+        if current and current.version == version:
+            _indexes[wsck] = _indexes.pop(wsck)  # most recently used last
+            return current
+
+    current = _build(conf_key, version, to_forms)
+    with _lock:
+        _indexes.pop(wsck, None)
+        _indexes[wsck] = current
+        while len(_indexes) > MAX_CONFERENCES:
+            _indexes.popitem(last=False)
+    return current
+
+
+def sessions_at(conf_key, at, to_forms):
+    """
+    Sessions of a Conference on at, and those on next
+    :param conf_key: Conference key
+    :param at: datetime
+    :param to_forms: function turning Sessions into SessionForms
+    :return: tuple of (list of SessionForm on now, list of SessionForm on
+    next), or None if there's no such Conference
+    """
+    schedule = index(conf_key, to_forms)
+    if not schedule.found:
+        return None
+    return schedule.now(at), schedule.upcoming(at)
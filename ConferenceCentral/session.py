@@ -6,6 +6,11 @@ session.py -- ConferenceCentral Session methods;
 
 """
 
+import collections
+import json
+import logging
+from datetime import datetime
+
 import endpoints
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
@@ -13,20 +18,31 @@ from protorpc import messages
 from protorpc import remote
 from protorpc.message_types import VoidMessage
 
+import cache
+import counters
+import idempotency
 import queryutil
+import schedule
+import stats
+import transactions
+import versions
+from context import UserContext, require_oauth
 from models import BooleanMessage
+from models import QueryCountForm
 from models import ConferenceWishlist
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionName
+from models import SessionsAtForm
 from models import SessionType
 from models import SessionTypeQueryForm, SpeakerQueryForm
 from models import Speaker
 from models import SpeakerForm
+from models import Tombstone
 from models import WishlistForms
-from profile import ProfileApi
 from settings import API
-from utils import get_user_id, get_from_webkey, require_oauth
+from utils import ConflictException, field_mask
 
 __author__ = 'voutilad@gmail.com (Dave Voutila)'
 
@@ -50,6 +66,70 @@ SESSION_DELETE_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1)
 )
 
+SESSIONS_AT_REQUEST = endpoints.ResourceContainer(
+    VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    time=messages.StringField(2, required=True)  # venue's local time
+)
+
+
+def _wishlist_group(api, s_key, ctx, add=True):
+    """
+    Contended entity group of a wishlist change: the user's Profile
+    :param api: SessionApi
+    :param s_key: Session key
+    :param ctx: UserContext for the requesting user
+    :param add: whether to add to or remove from the wishlist
+    :return: web-safe Profile key
+    """
+    return ctx.profile_key.urlsafe()
+
+
+def _queue_speaker_counts(deltas):
+    """
+    Enqueue, with the current transaction, a task applying changes in the
+    number of Sessions of Speakers to their sharded counters. The counters'
+    shards are entity groups of their own, so Session writes leave them to
+    the task rather than joining them.
+    :param deltas: dict of Speaker key -> change in the number of Sessions
+    :return:
+    """
+    deltas = dict((key.urlsafe(), delta) for key, delta in deltas.items()
+                  if delta)
+    if deltas:
+        taskqueue.add(params={'deltas': json.dumps(deltas)},
+                      url='/tasks/speaker_counts', transactional=True)
+
+
+def _put_new_speakers(speakers):
+    """
+    Put Speakers within the current transaction, skipping any created since
+    they were found missing
+    :param speakers: list of Speaker
+    :return:
+    """
+    if speakers:
+        existing = ndb.get_multi([speaker.key for speaker in speakers])
+        ndb.put_multi([speaker for speaker, found in zip(speakers, existing)
+                       if not found])
+
+
+def _queue_wishlist(api, s_key, ctx, add=True):
+    """
+    Fallback for wishlist changes that keep colliding: retry them from a task
+    :param api: SessionApi
+    :param s_key: Session key
+    :param ctx: UserContext for the requesting user
+    :param add: whether to add to or remove from the wishlist
+    :return: BooleanMessage flagged queued; data is True since the change
+    was accepted, so clients only reading data see it as done
+    """
+    taskqueue.add(params={'email': ctx.user.email(),
+                          'session_key': s_key.urlsafe(),
+                          'add': int(add)},
+                  url='/tasks/wishlist')
+    return BooleanMessage(data=True, queued=True)
+
 
 @API.api_class(resource_name='sessions')
 class SessionApi(remote.Service):
@@ -70,25 +150,27 @@ class SessionApi(remote.Service):
                       path='wishlist/{websafeSessionKey}',
                       http_method='PUT', name='addSessionToWishlist')
     @require_oauth
-    def add_to_wishlist(self, request):
+    def add_to_wishlist(self, request, ctx=None):
         """
         Add a Session to a ConferenceWishlist
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
-        return self._wishlist(request, True)
+        return self._wishlist(request, ctx, True)
 
     @endpoints.method(WISHLIST_REQUEST, BooleanMessage,
                       path='wishlist/{websafeSessionKey}',
                       http_method='DELETE', name='removeSessionFromWishlist')
     @require_oauth
-    def remove_from_wishlist(self, request):
+    def remove_from_wishlist(self, request, ctx=None):
         """
         Remove a Session from a ConferenceWishlist
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
-        return self._wishlist(request, False)
+        return self._wishlist(request, ctx, False)
 
     @endpoints.method(VoidMessage, WishlistForms, path='wishlists',
                       http_method='GET', name='getWishlists')
@@ -101,8 +183,8 @@ class SessionApi(remote.Service):
         if not isinstance(request, VoidMessage):
             raise endpoints.BadRequestException()
 
-        prof = ProfileApi.profile_from_user()  # get user Profile
-        wishlists = ConferenceWishlist.query(ancestor=prof.key).fetch()
+        ctx = UserContext.current()
+        wishlists = ConferenceWishlist.query(ancestor=ctx.profile_key).fetch()
 
         return WishlistForms(
             items=[wishlist.to_form() for wishlist in wishlists]
@@ -140,15 +222,72 @@ class SessionApi(remote.Service):
         """
         Queries Session objects in datastore
         :param request:
-        :return:
+        :return: SessionForms, flagged capped if an in-memory sort stopped
+        reading at queryutil.MAX_SCAN matches
         """
         ancestor = None
         if request.ancestorWebSafeKey:
             ancestor = ndb.Key(urlsafe=request.ancestorWebSafeKey)
 
-        sessions = queryutil.query(request, ancestor=ancestor)
+        fields = field_mask(request.fields, SessionForm)
+        sessions = queryutil.query(request, ancestor=ancestor, fields=fields)
+        items = self.populate_forms(sessions, fields)
 
-        return SessionForms(items=self.populate_forms(sessions))
+        return SessionForms(items=items,
+                            sortPath=queryutil.sort_path(sessions),
+                            capped=queryutil.capped(sessions))
+
+    @endpoints.method(queryutil.QueryForm, QueryCountForm,
+                      path='sessions/count',
+                      http_method='POST', name='countSessions')
+    def count(self, request):
+        """
+        Counts Session objects matching the query, up to queryutil.MAX_COUNT
+        :param request:
+        :return: QueryCountForm, flagged capped if there may be more matches
+        """
+        ancestor = None
+        if request.ancestorWebSafeKey:
+            ancestor = ndb.Key(urlsafe=request.ancestorWebSafeKey)
+
+        n = queryutil.count(request, ancestor=ancestor)
+        return QueryCountForm(count=n, capped=n >= queryutil.MAX_COUNT)
+
+    @endpoints.method(SESSIONS_AT_REQUEST, SessionsAtForm,
+                      path='conference/{websafeConferenceKey}/sessions/at',
+                      http_method='GET', name='getSessionsAt')
+    def get_sessions_at(self, request):
+        """
+        What's on at a Conference at a given time, and what's on next. Served
+        from this instance's interval index of the Conference's Sessions.
+        :param request: Conference key and time, e.g. '2016-05-24 10:00'.
+        Session times are the venue's local time, which the server doesn't
+        know, so the caller has to give the time in it.
+        :return: SessionsAtForm with the Sessions on at the time and the
+        Sessions starting soonest after it
+        """
+        try:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        except Exception:  # bad base64 or protocol buffer
+            conf_key = None
+        if not conf_key or conf_key.kind() != 'Conference':
+            raise endpoints.NotFoundException('Not a valid conference')
+
+        try:
+            at = datetime.strptime((request.time or '')[:16].replace('T', ' '),
+                                   '%Y-%m-%d %H:%M')
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Time must look like '2016-05-24 10:00'")
+
+        found = schedule.sessions_at(conf_key, at, self.populate_forms)
+        if found is None:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        now, upcoming = found
+        return SessionsAtForm(time=at.strftime('%Y-%m-%d %H:%M'), now=now,
+                              next=upcoming)
 
     @endpoints.method(SessionTypeQueryForm, SessionForms,
                       path='sessions/filter/type',
@@ -205,44 +344,26 @@ class SessionApi(remote.Service):
     @endpoints.method(SessionForm, SessionForm, path='session',
                       http_method='POST', name='create')
     @require_oauth
-    def create(self, request):
+    def create(self, request, ctx=None):
         """
         Creates a new Session. Only available to the organizer of the conference
-        :param request: SessionForm
+        :param request: SessionForm, with an optional idempotencyKey
+        :param ctx: UserContext for the requesting user
         :return: SessionForm
         """
-        if not request.websafeConfKey:
-            raise endpoints.BadRequestException('Conference key required.')
-
-        # try to prepare the Session instance
-        session = self.__prep_new_session(request)
-
-        # see if it exists already
-        if session.key.get():
-            raise endpoints.ConflictException(
-                'Session with key %s already exists' % session.key.urlsafe()
-            )
-
-        # deal with Speaker creation/updating
-        speakers = [self.__prepare_speaker(form) for form in request.speakers]
-
-        # try the transaction
-        request.websafeKey = self._create(session, speakers).urlsafe()
-
-        # Add a task to the queue for getting featured speaker changes
-        taskqueue.add(params={'conf_key': request.websafeConfKey},
-                      url='/tasks/update_featured_speaker')
-
-        return request
+        return idempotency.run('createSession', ctx, request.idempotencyKey,
+                               SessionForm,
+                               lambda: self.__create_session(request, ctx))
 
     @endpoints.method(SESSION_PUT_REQUEST, SessionForm,
                       path='session/{websafeSessionKey}',
                       http_method='PUT', name='update')
     @require_oauth
-    def update(self, request):
+    def update(self, request, ctx=None):
         """
         Attempts to update an existing Session
         :param request: SESSION_GET_REQUEST
+        :param ctx: UserContext for the requesting user
         :return: SessionForm
         """
         # first look up current (old) Session and sanity check it
@@ -264,13 +385,13 @@ class SessionApi(remote.Service):
                 if attr:
                     setattr(new_form, field.name, attr)
 
-        # deal with Speaker creation/updating
-        new_speakers = [self.__prepare_speaker(form) for form in
-                        new_form.speakers]
+        # deal with Speaker creation
+        speaker_keys, new_speakers = self.__prepare_speakers(new_form.speakers)
 
         # the transaction
         session = self._update(old_session, new_form,
-                               speakers=new_speakers)
+                               speaker_keys=speaker_keys,
+                               new_speakers=new_speakers)
 
         # Add a task to the queue for getting featured speaker changes
         taskqueue.add(params={'conf_key': session.conferenceKey.urlsafe()},
@@ -282,10 +403,11 @@ class SessionApi(remote.Service):
                       path='session/{websafeSessionKey}',
                       http_method='DELETE', name='delete')
     @require_oauth
-    def delete(self, request):
+    def delete(self, request, ctx=None):
         """
         Deletes a given Session cleaning up Speakers if needed
         :param request:
+        :param ctx: UserContext for the requesting user
         :return:
         """
         session = ndb.Key(urlsafe=request.websafeSessionKey).get()
@@ -293,55 +415,80 @@ class SessionApi(remote.Service):
         if not session:
             return BooleanMessage(data=False)
 
-        speakers = ndb.get_multi(session.speakerKeys)
-
-        return BooleanMessage(data=self._delete(session, speakers))
+        return BooleanMessage(data=self._delete(session))
 
     #
     # - - - Session Private Methods - - - - - - - - - - - - - - - - - - -
     #
 
-    @ndb.transactional(xg=True)
-    def _wishlist(self, request, add=True):
+    def _wishlist(self, request, ctx, add=True):
         """
-        Transaction to add or remove Session from a ConferenceWishlist given by
-         a WishlistRequest
+        Add or remove Session from a ConferenceWishlist given by a
+        WishlistRequest. The Session is validated up front, through the hot
+        cache, so the transaction only touches the user's entity group.
         :param request: Wishlist RPC Request [VoidMessage, session key in query
          string]
+        :param ctx: UserContext for the requesting user
         :param add: whether to add (True) to the wishlist or remove from a
         wishlist (False)
         :return: BooleanMessage - True if successful, False if failure
         """
-        prof = ProfileApi.profile_from_user()  # get user Profile
-        session = get_from_webkey(request.websafeSessionKey)  # get session
+        try:
+            s_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        except Exception:  # bad base64 or protocol buffer
+            s_key = None
 
-        if not session or not isinstance(session, Session):
+        if not s_key or not self.session_exists(s_key):
             raise endpoints.NotFoundException('Not a valid session')
 
+        return self._update_wishlist(s_key, ctx, add)
+
+    @transactions.transactional(name='wishlist', group=_wishlist_group,
+                                fallback=_queue_wishlist)
+    def _update_wishlist(self, s_key, ctx, add=True):
+        """
+        Transaction adding or removing a Session key on the user's
+        ConferenceWishlist. Wishlist counts in the Conference's stats are
+        adjusted by a task enqueued with the transaction.
+        :param s_key: key of an existing Session
+        :param ctx: UserContext for the requesting user
+        :param add: whether to add (True) to the wishlist or remove from a
+        wishlist (False)
+        :return: BooleanMessage - True if successful, False if failure
+        """
+        p_key = ctx.profile_key  # wishlists only need the Profile key
+        conf_key = s_key.parent()
+
         # see if the wishlist exists
-        wishlist = ConferenceWishlist().query(ancestor=prof.key) \
-            .filter(ConferenceWishlist.conferenceKey == session.conferenceKey) \
-            .get()
+        w_key = ConferenceWishlist.key_for(p_key, conf_key)
+        wishlist = w_key.get()
+        legacy = None
+        if not wishlist:
+            # wishlists used to get allocated ids; move one over if found
+            legacy = ConferenceWishlist.query(ancestor=p_key) \
+                .filter(ConferenceWishlist.conferenceKey == conf_key) \
+                .get()
+            if legacy:
+                wishlist = ConferenceWishlist(key=w_key, conferenceKey=conf_key,
+                                              sessionKeys=legacy.sessionKeys)
 
         # User requested to add to the wishlist, so create if needed
         if not wishlist:
             if add:
                 # need to create the wishlist first
-                conf_key = session.key.parent()
-                wishlist = ConferenceWishlist(conferenceKey=conf_key,
-                                              parent=prof.key)
+                wishlist = ConferenceWishlist(key=w_key, conferenceKey=conf_key)
             else:
                 # remove request, but no wishlist!
                 raise endpoints.NotFoundException(
                     'Nothing wishlisted for Conference')
 
         # update wishlist by adding/removing session key
-        s_key = session.key
         if s_key not in wishlist.sessionKeys:
             if add:
                 # add the key
                 wishlist.sessionKeys.append(s_key)
                 wishlist.put()
+                delta = 1
             else:
                 # can't remove a nonexistant key
                 raise endpoints.NotFoundException(
@@ -360,68 +507,114 @@ class SessionApi(remote.Service):
                     wishlist.key.delete()
                 else:
                     wishlist.put()
+                delta = -1
+
+        if legacy:
+            legacy.key.delete()
 
+        taskqueue.add(params={'session_key': s_key.urlsafe(), 'delta': delta},
+                      url='/tasks/wishlist_stats', transactional=True)
         return BooleanMessage(data=True)
 
-    @ndb.transactional(xg=True)
-    def _delete(self, session, speakers=None):
+    @ndb.transactional()
+    def _delete(self, session):
         """
-        Delete a session and clean up Speakers, decrementing or removing if
-        needed.
+        Delete a session, leaving a Tombstone for syncing clients. Its
+        Speakers' session counts are decremented by a task enqueued with the
+        transaction.
         :param session:
-        :param speakers:
         :return: True on success, False on failure
         """
         try:
-            if speakers:
-                for speaker in speakers:
-                    speaker.numSessions -= 1
-
-                    if speaker.numSessions < 1:
-                        speaker.key.delete()
-                    else:
-                        speaker.put()
-
-            session.key.delete()
+            _queue_speaker_counts(dict(
+                (key, -1) for key in session.speakerKeys))
+
+            conf_key = session.key.parent()
+            n_key = SessionName.key_for(conf_key, session.name)
+            ndb.delete_multi([session.key, n_key])
+            Tombstone.for_key(session.key).put()
+            stats.record_session(conf_key, old=session)
+            versions.bump(versions.sessions_scope(session.key.parent()))
+            versions.bump(versions.kind_scope(Session))
             return True
         except ndb.datastore_errors.Error:
-            print '!!! error deleting session'
+            logging.exception('Error deleting Session %s', session.key)
 
         return False
 
     @ndb.transactional(xg=True)
-    def _create(self, session, speakers=None):
-        """
-        Transaction for persisting session and speaker changes
-        :param session: Session
-        :param speakers: Speaker
+    def _create(self, session, speaker_keys=None, new_speakers=()):
+        """
+        Transaction for persisting a session, along with any Speakers it
+        introduces (each their own entity group); speaker counts follow in a
+        task enqueued with it
+        :param session: Session with an allocated key
+        :param speaker_keys: keys of the Session's Speakers
+        :param new_speakers: Speakers to create, see __prepare_speakers()
         :return: Session Key
+        :raises InternalServerErrorException: if the datastore write fails
         """
+        # session names are unique per conference
+        n_key = SessionName.key_for(session.key.parent(), session.name)
+        if n_key.get():
+            raise ConflictException(
+                'Session named %s already exists' % session.name)
+
         try:
-            if speakers:
-                for speaker in speakers:
-                    session.speakerKeys.append(speaker.put())
+            _put_new_speakers(new_speakers)
+            if speaker_keys:
+                session.speakerKeys = speaker_keys
+                _queue_speaker_counts(dict((key, 1) for key in speaker_keys))
+            stats.record_session(session.key.parent(), new=session)
+            versions.bump(versions.sessions_scope(session.key.parent()))
+            versions.bump(versions.kind_scope(Session))
+            SessionName(key=n_key, sessionKey=session.key).put()
             return session.put()
 
         except ndb.datastore_errors.Error:
-            print '!!! failed to create Session'
+            logging.exception('Failed to create Session %s', session.key)
+            raise endpoints.InternalServerErrorException(
+                'Failed to create Session')
 
-        return None
+    def __create_session(self, request, ctx):
+        """
+        Create a Session from a SessionForm
+        :param request: SessionForm
+        :param ctx: UserContext for the requesting user
+        :return: SessionForm
+        """
+        if not request.websafeConfKey:
+            raise endpoints.BadRequestException('Conference key required.')
+
+        # try to prepare the Session instance
+        session = self.__prep_new_session(request, ctx)
+        session.key = Session.allocate_key(session.conferenceKey)
+
+        # deal with Speaker creation
+        speaker_keys, new_speakers = self.__prepare_speakers(request.speakers)
+
+        # try the transaction
+        request.websafeKey = self._create(
+            session, speaker_keys, new_speakers=new_speakers).urlsafe()
+
+        # Add a task to the queue for getting featured speaker changes
+        taskqueue.add(params={'conf_key': request.websafeConfKey},
+                      url='/tasks/update_featured_speaker')
+
+        return request
 
     @staticmethod
-    def __prep_new_session(session_form):
+    def __prep_new_session(session_form, ctx):
         """
         Prepare a new Session instance, validating Conference and User details
         :param session_form:
+        :param ctx: UserContext for the requesting user
         :return: Session ready for processing of speakers
         """
         if not isinstance(session_form, SessionForm):
             raise TypeError('expected SessionForm')
 
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = get_user_id(user)
+        user_id = ctx.user_id
 
         if not session_form.name:
             raise endpoints.BadRequestException("Session 'name' field required")
@@ -443,62 +636,100 @@ class SessionApi(remote.Service):
         return Session.from_form(session_form)
 
     @ndb.transactional(xg=True)
-    def _update(self, old_session, session_form, speakers=None):
+    def _update(self, old_session, session_form, speaker_keys=None,
+                new_speakers=()):
         """
-        Update an existing Session using the new SessionForm message
+        Update an existing Session using the new SessionForm message, creating
+        any Speakers it introduces. Speakers added or dropped have their counts
+        adjusted by a task enqueued with the transaction.
         :param old_session: old Session instance
         :param session_form: SessionForm with updates
-        :param speakers:
+        :param speaker_keys: keys of the Session's Speakers after the update
+        :param new_speakers: Speakers to create, see __prepare_speakers()
         :return: updated Session
         """
         if not isinstance(old_session, Session):
             raise TypeError('expecting %s but got %s' % (Session, old_session))
 
+        _put_new_speakers(new_speakers)
+
+        # keep the Session's identity; only its properties change
         new_session = Session.from_form(session_form)
+        new_session.key = old_session.key
+        new_session.conferenceKey = old_session.conferenceKey
+
+        # move the name index entry if the Session was renamed
+        if new_session.name != old_session.name:
+            conf_key = old_session.key.parent()
+            n_key = SessionName.key_for(conf_key, new_session.name)
+            if n_key.get():
+                raise ConflictException(
+                    'Session named %s already exists' % new_session.name)
+            SessionName(key=n_key, sessionKey=new_session.key).put()
+            SessionName.key_for(conf_key, old_session.name).delete()
 
         # deal with decrementing the old ones that aren't on the session anymore
-        new_keys = [speaker.key for speaker in speakers]
-        for old_key in old_session.speakerKeys:
-            if old_key not in new_keys:
-                # decrement old speaker's sesssion count. if 0, just delete.
-                old_speaker = old_key.get()
-                old_speaker.numSessions -= 1
-                if old_speaker.numSessions == 0:
-                    old_key.delete()
-                else:
-                    old_speaker.put()
+        # only speakers added or dropped by the update change their counts
+        speaker_keys = speaker_keys or []
+        deltas = dict((key, 1) for key in speaker_keys
+                      if key not in old_session.speakerKeys)
+        deltas.update((key, -1) for key in old_session.speakerKeys
+                      if key not in speaker_keys)
+        _queue_speaker_counts(deltas)
+        new_session.speakerKeys = speaker_keys
 
-        # put speaker changes for new ones and append their keys
-        for speaker in speakers:
-            new_session.speakerKeys.append(speaker.put())
-
-        # since session key's use the session name, need to delete the old one
-        old_session.key.delete()
         new_session.put()
+        stats.record_session(new_session.key.parent(), old=old_session,
+                             new=new_session)
+        versions.bump(versions.sessions_scope(new_session.key.parent()))
+        versions.bump(versions.kind_scope(Session))
 
         return new_session
 
     @staticmethod
-    def __prepare_speaker(speaker_form):
+    def __prepare_speakers(speaker_forms):
+        """
+        Work out which Speakers the given forms need created. Speakers are
+        read in a single batch by their deterministic keys, so there's one
+        read however many co-presenters a Session has. New ones are put by
+        the Session's transaction, so a failed Session write leaves none
+        behind. Session counts are kept separately in sharded counters, so
+        existing Speakers aren't written at all.
+        :param speaker_forms: list of SpeakerForm
+        :return: tuple of (list of Speaker keys, list of Speakers to create)
+        """
+        forms = collections.OrderedDict()
+        for speaker_form in speaker_forms:
+            if not isinstance(speaker_form, SpeakerForm):
+                raise TypeError(
+                    'expected %s, but got %s' % (SpeakerForm, speaker_form))
+            # a speaker listed twice only counts once
+            key = Speaker.key_for(speaker_form.name, speaker_form.title)
+            forms[key] = speaker_form
+
+        new_speakers = [Speaker.from_form(speaker_form)
+                        for speaker_form, speaker in
+                        zip(forms.values(), ndb.get_multi(forms.keys()))
+                        if not speaker]
+
+        return forms.keys(), new_speakers
+
+    @staticmethod
+    def session_exists(s_key):
         """
-        Handle updating Speaker records and their session counts
-        :param speaker_form: SpeakerForm
-        :return: Speaker with updates ready to be put()
+        Whether a Session exists. The keys of a Conference's Sessions are
+        cached together in the hot cache and invalidated along with them.
+        :param s_key: ndb.Key
+        :return: bool
         """
-        if not isinstance(speaker_form, SpeakerForm):
-            raise TypeError(
-                'expected %s, but got %s' % (SpeakerForm, speaker_form))
+        conf_key = s_key.parent()
+        if s_key.kind() != Session.__name__ or not conf_key:
+            return False
 
-        speaker = Speaker.query(Speaker.name == speaker_form.name) \
-            .filter(Speaker.title == speaker_form.title) \
-            .get()
-        if speaker:
-            speaker.numSessions += 1
-        else:
-            speaker = Speaker.from_form(speaker_form)
-            speaker.numSessions = 1
-
-        return speaker
+        scope = versions.sessions_scope(conf_key)
+        return s_key in cache.HOT.get(
+            scope, lambda: frozenset(
+                Session.query(ancestor=conf_key).fetch(keys_only=True)))
 
     @staticmethod
     def populate_form(session):
@@ -507,22 +738,36 @@ class SessionApi(remote.Service):
         :param session:
         :return:
         """
-        speakers = ndb.get_multi(session.speakerKeys)
-        return session.to_form([speaker.to_form() for speaker in speakers])
+        return SessionApi.populate_forms([session])[0]
 
     @staticmethod
-    def populate_forms(sessions):
+    def populate_forms(sessions, fields=None):
         """
         Since I separated out Speakers from Sessions, need to fetch those back
         onto Sesssions
         when creating forms.
         :param sessions:
+        :param fields: optional SessionForm field mask; Speakers are only
+        fetched if it includes them
         :return:
         """
-        session_forms = []
+        sessions = [session for session in sessions if session]
 
+        if fields and 'speakers' not in fields:
+            return [session.to_form(fields=fields) for session in sessions]
+
+        # resolve every speaker and their session counts in one batch each
+        speaker_keys = list(set(key for session in sessions
+                                for key in session.speakerKeys))
+        speakers = dict(zip(speaker_keys, ndb.get_multi(speaker_keys)))
+        counts = counters.get_counts(
+            Speaker.counter_name(key) for key in speaker_keys)
+
+        session_forms = []
         for session in sessions:
-            form = SessionApi.populate_form(session)
+            form = session.to_form([
+                speakers[key].to_form(counts[Speaker.counter_name(key)])
+                for key in session.speakerKeys if speakers[key]], fields)
             session_forms.append(form)
 
         return session_forms
@@ -249,7 +249,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, $http, $q, oauth2Provider, HTTP_ERRORS) {
 
     /**
      * Holds the status if the query is being executed.
@@ -273,6 +273,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         {enumValue: 'MAX_ATTENDEES', displayName: 'Max Attendees'}
     ]
 
+    /**
+     * Holds the facet counts of the conferences matching the equality filters.
+     * @type {Array}
+     */
+    $scope.facets = [];
+
     /**
      * Possible operators.
      *
@@ -424,7 +430,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Loads all the conferences, from the static catalogue snapshot when no filters are applied
+     * and from the conference.queryConferences API otherwise.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
@@ -440,6 +447,54 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
+        if (sendFilters.filters.length == 0) {
+            $scope.getCatalogue(sendFilters);
+        } else {
+            $scope.queryConferencesLive(sendFilters);
+        }
+        $scope.getConferenceFacets(sendFilters);
+    };
+
+    /**
+     * Loads the catalogue snapshot's manifest and then all of its pages. Falls back to the
+     * conference.queryConferences API if the snapshot can't be loaded.
+     *
+     * @param sendFilters the (empty) filters to query the API with on fallback
+     */
+    $scope.getCatalogue = function (sendFilters) {
+        $scope.loading = true;
+        $http.get('/catalogue/manifest.json').
+            then(function (manifest) {
+                return $q.all(manifest.data.pages.map(function (page) {
+                    return $http.get('/catalogue/' + page, {cache: true});
+                }));
+            }).
+            then(function (pages) {
+                $scope.loading = false;
+                $scope.submitted = false;
+                $scope.messages = 'Query succeeded : conference catalogue';
+                $scope.alertStatus = 'success';
+                $log.info($scope.messages);
+
+                $scope.conferences = [];
+                angular.forEach(pages, function (page) {
+                    angular.forEach(page.data.items, function (conference) {
+                        $scope.conferences.push(conference);
+                    });
+                });
+                $scope.submitted = true;
+            }, function () {
+                $log.info('Conference catalogue unavailable, querying the API');
+                $scope.queryConferencesLive(sendFilters);
+            });
+    };
+
+    /**
+     * Invokes the conference.queryConferences API.
+     *
+     * @param sendFilters the filters to query with
+     */
+    $scope.queryConferencesLive = function (sendFilters) {
         $scope.loading = true;
         gapi.client.conferenceCentral.conferences.queryConferences(sendFilters).
             execute(function (resp) {
@@ -466,7 +521,23 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                     $scope.submitted = true;
                 });
             });
-    }
+    };
+
+    /**
+     * Invokes the conference.getConferenceFacets API; only the EQ filters narrow the counts.
+     */
+    $scope.getConferenceFacets = function (sendFilters) {
+        gapi.client.conferenceCentral.conferences.getConferenceFacets(sendFilters).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    if (resp.error) {
+                        $log.error('Failed to get conference facets : ' + (resp.error.message || ''));
+                    } else {
+                        $scope.facets = resp.items || [];
+                    }
+                });
+            });
+    };
 
     /**
      * Invokes the conference.getConferencesCreated method.
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+stats.py -- incrementally maintained Conference statistics
+
+Each Conference's ConferenceStats is a root entity of its own, so keeping it
+up to date never contends with registrations on the Conference's entity
+group. Write paths describe their change as a delta; inside a transaction
+the delta is handed to a task enqueued with it, so it's applied only once
+the change has committed, and reading the stats is still a single get. The
+conference_stats mapper (see migrations.py) periodically recounts them from
+scratch and applies the difference, to correct any drift.
+
+"""
+
+import datetime
+import json
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import ConferenceStats
+from models import ConferenceWishlist
+from models import Registration
+from models import Session
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+# ConferenceStats properties holding dicts of name -> count
+COUNT_FIELDS = ('sessionTypes', 'speakers', 'wishlists')
+
+
+def _tally(counts, name, delta):
+    """
+    Apply a delta to one entry of a dict of counts, dropping it at zero
+    :param counts: dict of name -> count
+    :param name: entry to change
+    :param delta: amount to add (may be negative)
+    :return:
+    """
+    count = counts.get(name, 0) + delta
+    if count > 0:
+        counts[name] = count
+    else:
+        counts.pop(name, None)
+
+
+def _add(changes, name, change):
+    """
+    Add to one entry of a dict of changes, which unlike counts may go
+    negative
+    :param changes: dict of name -> change
+    :param name: entry to change
+    :param change: amount to add
+    :return:
+    """
+    changes[name] = changes.get(name, 0) + change
+
+
+def _apply(stats, delta):
+    """
+    Apply a delta to a ConferenceStats in place
+    :param stats: ConferenceStats
+    :param delta: dict with any of COUNT_FIELDS (dicts of name -> change),
+    'minutes' and 'registrations' (changes), 'rekeyWishlists' (dict of old ->
+    new web-safe Session key) and 'dropWishlists' (web-safe Session keys)
+    :return:
+    """
+    wishlists = dict(stats.wishlists or {})
+    for old, new in delta.get('rekeyWishlists', {}).items():
+        _tally(wishlists, new, wishlists.pop(old, 0))
+    for wssk in delta.get('dropWishlists', []):
+        wishlists.pop(wssk, None)
+    stats.wishlists = wishlists
+
+    for field in COUNT_FIELDS:
+        counts = dict(getattr(stats, field) or {})
+        for name, change in delta.get(field, {}).items():
+            _tally(counts, name, change)
+        setattr(stats, field, counts)
+
+    stats.minutes += delta.get('minutes', 0)
+    stats.registrations = max(
+        stats.registrations + delta.get('registrations', 0), 0)
+
+
+def apply_delta(conf_key, delta):
+    """
+    Apply a delta to the stats of a Conference in a transaction on them
+    :param conf_key: Conference key
+    :param delta: see _apply()
+    :return:
+    """
+    @ndb.transactional()
+    def txn():
+        key = ConferenceStats.key_for(conf_key)
+        stats = key.get() or ConferenceStats(key=key)
+        _apply(stats, delta)
+        stats.put()
+
+    txn()
+
+
+def _record(conf_key, delta):
+    """
+    Apply a delta to the stats of a Conference. Inside a transaction it's
+    left to a task enqueued with it, so the stats' entity group stays out of
+    the caller's transaction and the delta only counts if it commits.
+    :param conf_key: Conference key
+    :param delta: see _apply()
+    :return:
+    """
+    if ndb.in_transaction():
+        taskqueue.add(params={'conf_key': conf_key.urlsafe(),
+                              'delta': json.dumps(delta)},
+                      url='/tasks/stats', transactional=True)
+    else:
+        apply_delta(conf_key, delta)
+
+
+def _session_delta(delta, session, sign):
+    """
+    Add (sign=1) or remove (sign=-1) a Session's contribution to a delta
+    :param delta: dict, see _apply()
+    :param session: Session
+    :param sign: 1 or -1
+    :return:
+    """
+    _add(delta.setdefault('sessionTypes', {}), str(session.typeOfSession),
+         sign)
+    delta['minutes'] = delta.get('minutes', 0) + sign * (session.duration or 0)
+    speakers = delta.setdefault('speakers', {})
+    for key in session.speakerKeys:
+        _add(speakers, key.urlsafe(), sign)
+
+
+def record_session(conf_key, old=None, new=None):
+    """
+    Account for a Session being created (old=None), updated or deleted
+    (new=None)
+    :param conf_key: Conference key
+    :param old: Session before the change, or None
+    :param new: Session after the change, or None
+    :return:
+    """
+    delta = {}
+    if old:
+        _session_delta(delta, old, -1)
+    if new:
+        _session_delta(delta, new, 1)
+    elif old:
+        delta['dropWishlists'] = [old.key.urlsafe()]
+    _record(conf_key, delta)
+
+
+def rekey_session(old_key, new_key):
+    """
+    Move a re-keyed Session's wishlist count over to its new key
+    :param old_key: Session key before re-keying
+    :param new_key: Session key after re-keying
+    :return:
+    """
+    _record(old_key.parent(),
+            {'rekeyWishlists': {old_key.urlsafe(): new_key.urlsafe()}})
+
+
+def record_registration(conf_key, delta):
+    """
+    Account for attendees registering (delta > 0) or unregistering
+    :param conf_key: Conference key
+    :param delta: change in the number of Registrations
+    :return:
+    """
+    _record(conf_key, {'registrations': delta})
+
+
+def record_wishlist(session_key, delta):
+    """
+    Account for a Session being added to (delta > 0) or removed from wishlists
+    :param session_key: Session key
+    :param delta: change in the number of wishlists holding the Session
+    :return:
+    """
+    _record(session_key.parent(),
+            {'wishlists': {session_key.urlsafe(): delta}})
+
+
+def _difference(fresh, current):
+    """
+    Delta turning one ConferenceStats into another
+    :param fresh: ConferenceStats to end up with
+    :param current: ConferenceStats to start from
+    :return: dict, see _apply()
+    """
+    delta = {}
+    for field in COUNT_FIELDS:
+        want = getattr(fresh, field) or {}
+        have = getattr(current, field) or {}
+        delta[field] = dict((name, want.get(name, 0) - have.get(name, 0))
+                            for name in set(want) | set(have)
+                            if want.get(name, 0) != have.get(name, 0))
+    delta['minutes'] = fresh.minutes - current.minutes
+    delta['registrations'] = fresh.registrations - current.registrations
+    return delta
+
+
+def reconcile(conf_key):
+    """
+    Recount the stats of a Conference from scratch and apply the difference
+    to the stored stats. The stored stats are read just before counting and
+    the difference is applied in a transaction, so deltas committing after
+    the count are kept rather than overwritten.
+    :param conf_key: Conference key
+    :return: ConferenceStats
+    """
+    key = ConferenceStats.key_for(conf_key)
+    current = key.get() or ConferenceStats(key=key)
+
+    registrations = Registration.query(
+        Registration.conferenceKey == conf_key).count_async()
+    wishlists = ConferenceWishlist.query(
+        ConferenceWishlist.conferenceKey == conf_key).fetch_async()
+    sessions = Session.query(ancestor=conf_key).fetch()
+
+    fresh = ConferenceStats(key=key, registrations=registrations.get_result())
+    delta = {}
+    for session in sessions:
+        _session_delta(delta, session, 1)
+    _apply(fresh, delta)
+    live = set(session.key.urlsafe() for session in sessions)
+    wishlisted = {}
+    for wishlist in wishlists.get_result():
+        for s_key in wishlist.sessionKeys:
+            if s_key.urlsafe() in live:
+                _tally(wishlisted, s_key.urlsafe(), 1)
+    fresh.wishlists = wishlisted
+
+    correction = _difference(fresh, current)
+
+    @ndb.transactional()
+    def txn():
+        stats = key.get() or ConferenceStats(key=key)
+        _apply(stats, correction)
+        stats.reconciled = datetime.datetime.now()
+        stats.put()
+        return stats
+
+    return txn()
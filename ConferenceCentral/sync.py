@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+sync.py -- changes since a client's last sync, for delta syncing clients
+
+Conferences, Sessions and Speakers carry an auto-updated modified timestamp
+and deletes leave a Tombstone, so the changes since a point in time are a
+range query per kind. A sync token records where a client got to: while a
+sync is paging, which kind and cursor to continue from; once it's complete,
+the time to look for changes after next time. Tokens are opaque to clients.
+
+"""
+
+import base64
+import datetime
+import json
+
+from google.appengine.datastore.datastore_query import Cursor
+
+from models import Conference
+from models import Session
+from models import Speaker
+from models import Tombstone
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+KINDS = (Conference, Session, Speaker, Tombstone)
+PAGE_SIZE = 100
+
+# changes are looked for from a little before the previous sync started, so
+# writes committing while it ran aren't missed; clients de-duplicate by key
+SKEW = datetime.timedelta(seconds=60)
+
+# Tombstones are purged after this long (see migrations.py), so clients that
+# haven't synced since have to start over
+TOMBSTONE_TTL = datetime.timedelta(days=30)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _micros(dt):
+    """
+    Microseconds since the epoch
+    :param dt: datetime
+    :return: int
+    """
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def _datetime(micros):
+    """
+    Datetime from microseconds since the epoch
+    :param micros: int
+    :return: datetime
+    """
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def encode_token(state):
+    """
+    Opaque sync token for a sync state
+    :param state: dict
+    :return: string
+    """
+    return base64.urlsafe_b64encode(json.dumps(state, sort_keys=True))
+
+
+def decode_token(token):
+    """
+    Sync state from a sync token
+    :param token: string from encode_token
+    :return: dict
+    :raises ValueError: if the token is malformed
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):  # bad base64 or JSON
+        raise ValueError('Invalid sync token')
+    if not isinstance(state, dict):
+        raise ValueError('Invalid sync token')
+    return state
+
+
+def _query(kind, since):
+    """
+    Query for the entities of a kind changed after a point in time; every
+    live entity if since is None
+    :param kind: one of KINDS
+    :param since: datetime, or None
+    :return: ndb.Query
+    """
+    if since is None:
+        return kind.query().order(kind.key)
+    return kind.query(kind.modified > since).order(kind.modified)
+
+
+def changes(token=None, page_size=PAGE_SIZE):
+    """
+    A page of the entities changed since a sync token. Without a token, or
+    with one older than TOMBSTONE_TTL, every live entity is returned and
+    reset is set.
+    :param token: sync token from a previous call, or None
+    :param page_size: max entities to return
+    :return: tuple of (list of entities, next token, more, reset)
+    :raises ValueError: if the token is malformed
+    """
+    now = datetime.datetime.now()
+    state = decode_token(token) if token else {}
+
+    if 'until' not in state:
+        # starting a new sync; a full one if the token is missing or too old
+        since = state.get('since')
+        if since is not None and _datetime(since) < now - TOMBSTONE_TTL:
+            since = None
+        state = {'since': since, 'until': _micros(now), 'kind': 0}
+    since = _datetime(state['since']) if state['since'] is not None else None
+    reset = since is None
+
+    kinds = KINDS if since else KINDS[:-1]  # nothing to delete on a reset
+    entities = []
+    cursor = Cursor(urlsafe=state['cursor']) if state.get('cursor') else None
+    kind = state['kind']
+    while kind < len(kinds) and len(entities) < page_size:
+        page, cursor, more = _query(kinds[kind], since).fetch_page(
+            page_size - len(entities), start_cursor=cursor)
+        entities += page
+        if more and cursor:
+            break
+        kind += 1
+        cursor = None
+
+    if kind < len(kinds):
+        state.update(kind=kind, cursor=cursor.urlsafe() if cursor else None)
+        return entities, encode_token(state), True, reset
+
+    # done; next time look for changes from just before this sync started
+    next_state = {'since': _micros(_datetime(state['until']) - SKEW)}
+    return entities, encode_token(next_state), False, reset
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+tasks.py -- HTTP controller handlers for cron jobs, task queue, admin
+    pages and the static catalogue snapshot
+
+Deliberately imports nothing from the Endpoints API modules at module level,
+so instances that only run background work don't pay for loading them.
+
+"""
+
+import json
+import logging
+
+import webapp2
+from google.appengine.api import app_identity
+from google.appengine.api import mail
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+import announcements
+import cache
+import catalogue
+import counters
+import facets
+import mapper
+import migrations
+import stats
+import transactions
+from models import Session, SessionType, Speaker
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class SetAnnouncementHandler(webapp2.RequestHandler):
+    """
+    Handles creation of announcements
+    """
+
+    def get(self):
+        """
+        Set announcement values in Memcache.
+        :return:
+        """
+        announcements.cache_announcement()
+        self.response.set_status(204)
+
+
+class RenderCatalogueHandler(webapp2.RequestHandler):
+    """
+    Handles rendering the public catalogue snapshot
+    """
+
+    def get(self):
+        """
+        Render the catalogue pages and manifest to the blob store.
+        :return:
+        """
+        catalogue.render()
+        self.response.set_status(204)
+
+
+class CatalogueHandler(webapp2.RequestHandler):
+    """
+    Serves the files of the public catalogue snapshot
+    """
+
+    def get(self, name):
+        """
+        Serve a catalogue page or the manifest, gzipped as stored if the
+        client accepts it
+        :param name: file name from the URL
+        :return:
+        """
+        content = catalogue.read(name)
+        if content is None:
+            self.response.set_status(404)
+            return
+
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = catalogue.cache_control(name)
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.write(content)
+        else:
+            self.response.write(catalogue.decompress(content))
+
+
+class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    """
+    Handles Email confirmation tasks
+    """
+
+    def post(self):
+        """
+        Send email confirming Conference creation.
+        :return:
+        """
+        mail.send_mail(
+            'noreply@%s.appspotmail.com' % (
+                app_identity.get_application_id()),  # from
+            self.request.get('email'),  # to
+            'You created a new Conference!',  # subj
+            'Hi, you have created a following '  # body
+            'conference:\r\n\r\n%s' % self.request.get(
+                'conferenceInfo')
+        )
+
+
+class FeaturedSpeakersHandler(webapp2.RequestHandler):
+    """
+    Pick a Featured Speaker for a Conference when Sessions are created/changed
+    """
+
+    def post(self):
+        """
+        Expected to receive Postdata with a web-safe Conference key
+        :return:
+        """
+        wsck = self.request.get('conf_key')
+        if not wsck:
+            logging.warning('Bad request to FeaturedSpeakersHandler')
+            self.response.set_status(204)  # bad request
+        else:
+            # do it
+            conf_key = ndb.Key(urlsafe=wsck)
+            keynotes = Session.query(ancestor=conf_key) \
+                .filter(Session.typeOfSession == SessionType.KEYNOTE) \
+                .fetch()
+            if keynotes:
+                # take the first keynote presenter and feature them
+                s_key = self.get_first_speaker(keynotes)
+                if s_key:
+                    announcements.set_featured(conf_key, s_key.get())
+            else:
+                others = Session.query(ancestor=conf_key) \
+                    .filter(Session.typeOfSession != SessionType.KEYNOTE) \
+                    .fetch()
+                if others:
+                    # just grab the first for now...
+                    s_key = self.get_first_speaker(others)
+                    if s_key:
+                        announcements.set_featured(conf_key, s_key.get())
+
+        self.response.set_status(204)
+
+    @staticmethod
+    def get_first_speaker(sessions):
+        """
+        Get the first available speaker in the given sessions
+        :param sessions:
+        :return:
+        """
+        for session in sessions:
+            if getattr(session, 'speakerKeys'):
+                return session.speakerKeys[0]
+
+
+class WishlistHandler(webapp2.RequestHandler):
+    """
+    Retries a wishlist change that kept colliding during the API request
+    """
+
+    def post(self):
+        """
+        Expects the user's email, the web-safe Session key and whether to add
+        (1) or remove (0) it. Errors other than contention are final, so
+        they're logged rather than retried.
+        :return:
+        """
+        # deferred so other background work doesn't load the Endpoints stack
+        import endpoints
+        from context import UserContext
+        from session import WISHLIST_REQUEST, SessionApi
+
+        request = WISHLIST_REQUEST.combined_message_class(
+            websafeSessionKey=self.request.get('session_key'))
+        ctx = UserContext(users.User(self.request.get('email')))
+        try:
+            SessionApi()._wishlist(request, ctx,
+                                   add=self.request.get('add') == '1')
+        except endpoints.ServiceException as e:
+            logging.error('Queued wishlist change failed: %s', e)
+        self.response.set_status(204)
+
+
+class WishlistStatsHandler(webapp2.RequestHandler):
+    """
+    Applies a wishlist change to the Conference's stats
+    """
+
+    def post(self):
+        """
+        Expects the web-safe Session key and the change in the number of
+        wishlists holding it. Enqueued by the wishlist transaction, so it
+        only runs once the change has committed.
+        :return:
+        """
+        stats.record_wishlist(ndb.Key(urlsafe=self.request.get('session_key')),
+                              int(self.request.get('delta')))
+        self.response.set_status(204)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    """
+    Applies a change to a Conference's stats
+    """
+
+    def post(self):
+        """
+        Expects the web-safe Conference key and a JSON delta (see
+        stats.apply_delta()). Enqueued by the transaction making the change,
+        so it only runs once the change has committed.
+        :return:
+        """
+        stats.apply_delta(ndb.Key(urlsafe=self.request.get('conf_key')),
+                          json.loads(self.request.get('delta')))
+        self.response.set_status(204)
+
+
+class SpeakerCountsHandler(webapp2.RequestHandler):
+    """
+    Applies a Session write to its Speakers' session counts
+    """
+
+    def post(self):
+        """
+        Expects a JSON object of web-safe Speaker key -> change in the number
+        of Sessions. Enqueued by the Session transaction, so it only runs once
+        the change has committed. The Speakers are re-put afterwards so their
+        modified time moves on and syncing clients pick up the new counts.
+        :return:
+        """
+        deltas = json.loads(self.request.get('deltas'))
+        keys = [ndb.Key(urlsafe=wsk) for wsk in deltas]
+        counters.increment_multi(dict(
+            (Speaker.counter_name(key), deltas[key.urlsafe()])
+            for key in keys))
+        ndb.put_multi([speaker for speaker in ndb.get_multi(keys) if speaker])
+        self.response.set_status(204)
+
+
+class FacetsHandler(webapp2.RequestHandler):
+    """
+    Applies a Conference write to the facet counts
+    """
+
+    def post(self):
+        """
+        Expects the web-safe Conference key. Enqueued by the Conference
+        transaction, so it only runs once the change has committed.
+        :return:
+        """
+        facets.refresh(ndb.Key(urlsafe=self.request.get('conf_key')))
+        self.response.set_status(204)
+
+
+class RekeyWishlistsHandler(webapp2.RequestHandler):
+    """
+    Points wishlists at a Session moved by the session_keys mapper
+    """
+
+    def post(self):
+        """
+        Expects the Session's old and new web-safe keys. Enqueued by the
+        re-keying transaction, so it only runs once the move has committed.
+        :return:
+        """
+        migrations.rekey_wishlists(
+            ndb.Key(urlsafe=self.request.get('old_key')),
+            ndb.Key(urlsafe=self.request.get('new_key')))
+        self.response.set_status(204)
+
+
+class CountersHandler(webapp2.RequestHandler):
+    """
+    Applies deltas to sharded counters
+    """
+
+    def post(self):
+        """
+        Expects a JSON object of counter name -> delta, enqueued by
+        counters.queue_increments() with the transaction that caused them
+        :return:
+        """
+        counters.increment_multi(json.loads(self.request.get('deltas')))
+        self.response.set_status(204)
+
+
+class TransactionStatsHandler(webapp2.RequestHandler):
+    """
+    Admin view of transaction attempts, collisions and aborts per entity group
+    """
+
+    def get(self):
+        """
+        Return transaction stats as JSON
+        :return:
+        """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(transactions.stats()))
+
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    """
+    Admin view of this instance's hot cache counters and hit ratios
+    """
+
+    def get(self):
+        """
+        Return hot cache stats as JSON
+        :return:
+        """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(cache.HOT.stats()))
+
+
+class MapperStartHandler(webapp2.RequestHandler):
+    """
+    Starts a registered mapper job
+    """
+
+    def get(self):
+        """
+        Start the mapper named by the 'name' parameter, split into 'shards'
+        key ranges
+        :return:
+        """
+        name = self.request.get('name')
+        if name not in migrations.names():
+            self.response.set_status(404)
+            self.response.write('Unknown mapper, choose one of: %s' %
+                                ', '.join(migrations.names()))
+            return
+
+        shards = int(self.request.get('shards') or 1)
+        job = mapper.start(name, shards=shards)
+        self.response.set_status(202)
+        self.response.write(job.key.urlsafe())
+
+
+class MapperSliceHandler(webapp2.RequestHandler):
+    """
+    Runs one slice of a mapper shard
+    """
+
+    def post(self):
+        """
+        Expects the shard key and slice number it was queued for
+        :return:
+        """
+        shard_key = ndb.Key(urlsafe=self.request.get('shard'))
+        mapper.run_slice(shard_key, int(self.request.get('slice')))
+        self.response.set_status(204)
+
+
+class MapperStatusHandler(webapp2.RequestHandler):
+    """
+    Admin view of mapper job progress and throughput
+    """
+
+    def get(self):
+        """
+        Return recent mapper jobs as JSON
+        :return:
+        """
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(mapper.status()))
+
+
+APP = webapp2.WSGIApplication([
+    ('/admin/mappers', MapperStatusHandler),
+    ('/admin/mappers/start', MapperStartHandler),
+    ('/admin/mappers/slice', MapperSliceHandler),
+    ('/admin/cache_stats', CacheStatsHandler),
+    ('/admin/txn_stats', TransactionStatsHandler),
+    ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/render_catalogue', RenderCatalogueHandler),
+    ('/catalogue/(.+)', CatalogueHandler),
+    ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
+    ('/tasks/update_featured_speaker', FeaturedSpeakersHandler),
+    ('/tasks/wishlist', WishlistHandler),
+    ('/tasks/wishlist_stats', WishlistStatsHandler),
+    ('/tasks/stats', StatsHandler),
+    ('/tasks/speaker_counts', SpeakerCountsHandler),
+    ('/tasks/facets', FacetsHandler),
+    ('/tasks/counters', CountersHandler),
+    ('/tasks/rekey_wishlists', RekeyWishlistsHandler)
+], debug=True)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+"""
+tests -- App Engine testbed tests for ConferenceCentral
+
+Run from the ConferenceCentral directory with the App Engine SDK on the
+path: python -m unittest discover tests
+
+"""
+
+import unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class TestbedCase(unittest.TestCase):
+    """
+    TestbedCase -- activates datastore, memcache and task queue stubs, with
+    strongly consistent queries so tests don't depend on replication timing
+    """
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def tasks(self, url):
+        """
+        Tasks queued on the default queue for a URL
+        :param url: task handler path
+        :return: list of taskqueue.Task
+        """
+        return self.taskqueue.get_filtered_tasks(url=url)
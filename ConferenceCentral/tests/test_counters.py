@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+test_counters.py -- sharded counter deltas, cached totals and resets
+"""
+
+import json
+import unittest
+
+from google.appengine.ext import ndb
+
+import counters
+from tests import TestbedCase
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class CountersTest(TestbedCase):
+
+    def test_increment_multi_applies_every_delta(self):
+        counters.increment_multi({'a': 3, 'b': -1, 'c': 0})
+        counters.increment_multi({'a': 2})
+
+        self.assertEqual({'a': 5, 'b': -1, 'c': 0},
+                         counters.get_counts(['a', 'b', 'c']))
+
+    def test_increment_invalidates_cached_total(self):
+        counters.increment('a', 1)
+        self.assertEqual(1, counters.get_count('a'))  # now cached
+
+        counters.increment('a', 4)
+
+        self.assertEqual(5, counters.get_count('a'))
+
+    def test_increment_joins_transaction(self):
+        @ndb.transactional(xg=True)
+        def txn():
+            counters.increment('a', 1)
+            raise ndb.Rollback()
+
+        txn()
+
+        self.assertEqual(0, counters.get_count('a'))
+
+    def test_reset_replaces_shards(self):
+        for _ in range(10):
+            counters.increment('a', 1)
+        self.assertEqual(10, counters.get_count('a'))
+
+        counters.reset('a', 3)
+
+        self.assertEqual(3, counters.get_count('a'))
+        shards = [shard for shard in ndb.get_multi(counters.shard_keys('a'))
+                  if shard]
+        self.assertEqual([3], [shard.count for shard in shards])
+
+    def test_queue_increments_chunks_tasks(self):
+        deltas = dict(('c%d' % i, 1) for i in range(counters.MAX_GROUPS + 5))
+        deltas['zero'] = 0
+
+        @ndb.transactional()
+        def txn():
+            counters.queue_increments(deltas)
+
+        txn()
+
+        tasks = self.tasks('/tasks/counters')
+        self.assertEqual(2, len(tasks))
+        queued = {}
+        for task in tasks:
+            chunk = json.loads(task.extract_params()['deltas'])
+            self.assertTrue(len(chunk) <= counters.MAX_GROUPS)
+            queued.update(chunk)
+        del deltas['zero']
+        self.assertEqual(deltas, queued)
+
+    def test_queue_increments_needs_commit(self):
+        @ndb.transactional()
+        def txn():
+            counters.queue_increments({'a': 1})
+            raise ndb.Rollback()
+
+        txn()
+
+        self.assertEqual([], self.tasks('/tasks/counters'))
+
+
+if __name__ == '__main__':
+    unittest.main()
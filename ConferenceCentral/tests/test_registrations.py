@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+test_registrations.py -- moving legacy conferencesToAttend lists into
+Registration entities
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Profile
+from models import Registration
+from tests import TestbedCase
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class RegistrationMigrationTest(TestbedCase):
+
+    def setUp(self):
+        super(RegistrationMigrationTest, self).setUp()
+        self.conf_keys = ndb.put_multi([
+            Conference(name='PyCon', seatsAvailable=10),
+            Conference(name='JSConf', seatsAvailable=10)])
+        self.profile_key = Profile(id='user-1', displayName='User',
+                                   conferencesToAttend=self.conf_keys).put()
+
+    def attending(self):
+        return sorted(Registration.attending_async(
+            self.profile_key).get_result())
+
+    def test_migrate_moves_legacy_list(self):
+        prof = Registration.migrate(self.profile_key)
+
+        self.assertEqual([], prof.conferencesToAttend)
+        self.assertEqual([], self.profile_key.get().conferencesToAttend)
+        self.assertEqual(sorted(self.conf_keys), self.attending())
+
+    def test_migrate_is_idempotent(self):
+        Registration.migrate(self.profile_key)
+        Registration.migrate(self.profile_key)
+
+        self.assertEqual(2, Registration.query(
+            ancestor=self.profile_key).count())
+
+    def test_migrate_keeps_existing_registrations(self):
+        other = Conference(name='Strange Loop', seatsAvailable=10).put()
+        Registration(key=Registration.key_for(self.profile_key, other),
+                     conferenceKey=other).put()
+
+        Registration.migrate(self.profile_key)
+
+        self.assertEqual(sorted(self.conf_keys + [other]), self.attending())
+
+    def test_migrate_without_profile(self):
+        self.assertIsNone(Registration.migrate(ndb.Key(Profile, 'nobody')))
+
+    def test_from_legacy_empties_the_list(self):
+        prof = self.profile_key.get()
+        registrations = Registration.from_legacy(prof)
+
+        self.assertEqual([], prof.conferencesToAttend)
+        self.assertEqual(
+            sorted(Registration.key_for(self.profile_key, key)
+                   for key in self.conf_keys),
+            sorted(r.key for r in registrations))
+
+
+if __name__ == '__main__':
+    unittest.main()
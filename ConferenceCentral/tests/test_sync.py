@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+test_sync.py -- delta sync of deleted entities through Tombstones
+"""
+
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+import migrations
+import sync
+from models import Conference
+from models import Session
+from models import SessionType
+from models import Tombstone
+from tests import TestbedCase
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+
+class SyncTombstoneTest(TestbedCase):
+
+    def setUp(self):
+        super(SyncTombstoneTest, self).setUp()
+        self.conf_key = Conference(name='PyCon', seatsAvailable=10).put()
+        self.session_key = Session(parent=self.conf_key, name='Keynote',
+                                   typeOfSession=SessionType.KEYNOTE,
+                                   conferenceKey=self.conf_key).put()
+
+    def full_sync(self):
+        entities, token, more, reset = sync.changes(None)
+        self.assertTrue(reset)
+        self.assertFalse(more)
+        return entities, token
+
+    def delete_session(self):
+        @ndb.transactional()
+        def txn():
+            self.session_key.delete()
+            Tombstone.for_key(self.session_key).put()
+
+        txn()
+
+    def test_full_sync_returns_live_entities(self):
+        entities, _ = self.full_sync()
+
+        self.assertEqual(set([self.conf_key, self.session_key]),
+                         set(entity.key for entity in entities))
+
+    def test_tombstone_shares_entity_group(self):
+        tombstone = Tombstone.for_key(self.session_key)
+
+        self.assertEqual(self.conf_key, tombstone.key.parent())
+        self.assertEqual('Session', tombstone.kind)
+
+    def test_delta_sync_returns_tombstone(self):
+        _, token = self.full_sync()
+        self.delete_session()
+
+        entities, _, more, reset = sync.changes(token)
+
+        self.assertFalse(reset)
+        self.assertFalse(more)
+        tombstones = [entity for entity in entities
+                      if isinstance(entity, Tombstone)]
+        self.assertEqual([self.session_key.urlsafe()],
+                         [tombstone.key.id() for tombstone in tombstones])
+        self.assertNotIn(self.session_key,
+                         [entity.key for entity in entities])
+
+    def test_full_sync_skips_tombstones(self):
+        self.delete_session()
+
+        entities, _ = self.full_sync()
+
+        self.assertEqual([self.conf_key], [entity.key for entity in entities])
+
+    def test_expired_token_resets(self):
+        since = datetime.datetime.now() - sync.TOMBSTONE_TTL - \
+            datetime.timedelta(days=1)
+        token = sync.encode_token({'since': sync._micros(since)})
+
+        _, _, _, reset = sync.changes(token)
+
+        self.assertTrue(reset)
+
+    def test_purge_keeps_recent_tombstones(self):
+        self.delete_session()
+        tombstone = Tombstone.query().get()
+        purge = migrations.TombstonePurge()
+
+        self.assertEqual(([], []), purge.map(tombstone))
+
+        tombstone.modified -= sync.TOMBSTONE_TTL + datetime.timedelta(days=1)
+        self.assertEqual(([], [tombstone.key]), purge.map(tombstone))
+
+
+if __name__ == '__main__':
+    unittest.main()
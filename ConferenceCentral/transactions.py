@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""
+transactions.py -- transactions with a contention-aware retry policy
+
+The transactional() decorator runs a function in a datastore transaction and
+retries collisions and timeouts itself, with jittered exponential backoff and
+an overall deadline, instead of relying on ndb's fixed retries. Attempts,
+commits, collisions, timeouts and abort reasons are counted per transaction
+name and entity group, tallied in instance memory and flushed to memcache
+counters every FLUSH_INTERVAL seconds, like views.py. When contention
+outlasts the retry policy an optional fallback can take over, e.g. to queue
+the operation as a task.
+
+"""
+
+import collections
+import functools
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+RETRIES = 3
+BACKOFF = 0.05  # seconds, doubled on every retry
+MAX_BACKOFF = 1.0  # seconds
+DEADLINE = 10.0  # seconds
+
+STAT_KEY = 'TXN-{group}-{stat}'
+GROUPS_KEY = 'TXN-GROUPS'
+MAX_GROUPS = 200
+FLUSH_INTERVAL = 10  # seconds
+STATS = ('attempts', 'commits', 'collisions', 'timeouts', 'exhausted',
+         'fallbacks')
+
+_lock = threading.Lock()
+_pending = collections.Counter()
+_last_flush = {'time': time.time()}
+
+
+def _in_task():
+    """
+    Whether the current request is a task queue task, where failing and
+    letting the queue retry beats falling back
+    :return: bool
+    """
+    return bool(os.environ.get('HTTP_X_APPENGINE_TASKNAME'))
+
+
+def transactional(name=None, group=None, xg=False, retries=RETRIES,
+                  backoff=BACKOFF, max_backoff=MAX_BACKOFF, deadline=DEADLINE,
+                  fallback=None):
+    """
+    Decorator running a function in a transaction under a retry policy
+    :param name: name to record stats under; defaults to the function name
+    :param group: callable taking the function's arguments and returning a
+    label for the contended entity group, e.g. a web-safe key
+    :param xg: whether the transaction is cross-group
+    :param retries: max retries after the first attempt
+    :param backoff: base delay before the first retry, in seconds
+    :param max_backoff: max delay between attempts, in seconds
+    :param deadline: seconds after which no further attempt is started
+    :param fallback: callable taking the function's arguments, called with
+    them instead of failing once the retries or deadline are used up
+    :return: decorator
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if ndb.in_transaction():
+                return func(*args, **kwargs)
+
+            key = '%s:%s' % (label, group(*args, **kwargs) if group else '')
+            started = time.time()
+            attempt = 0
+            while True:
+                attempt += 1
+                record(key, 'attempts')
+                try:
+                    result = ndb.transaction(lambda: func(*args, **kwargs),
+                                             retries=0, xg=xg)
+                except (ndb.datastore_errors.TransactionFailedError,
+                        ndb.datastore_errors.Timeout) as e:
+                    if isinstance(e, ndb.datastore_errors.Timeout):
+                        record(key, 'timeouts')
+                    else:
+                        record(key, 'collisions')
+
+                    # full jitter: anywhere up to the exponential delay
+                    delay = random.uniform(
+                        0, min(max_backoff, backoff * 2 ** (attempt - 1)))
+                    if attempt > retries or \
+                            time.time() + delay - started > deadline:
+                        record(key, 'exhausted')
+                        if fallback and not _in_task():
+                            record(key, 'fallbacks')
+                            return fallback(*args, **kwargs)
+                        raise
+                    time.sleep(delay)
+                except Exception as e:
+                    # the function aborted the transaction itself
+                    record(key, 'abort-%s' % type(e).__name__)
+                    raise
+                else:
+                    record(key, 'commits')
+                    return result
+
+        return wrapper
+
+    return decorator
+
+
+def record(group, stat):
+    """
+    Count an event for a transaction's entity group
+    :param group: 'name:group label' string
+    :param stat: name of the counter
+    :return:
+    """
+    now = time.time()
+    with _lock:
+        _pending[(group, stat)] += 1
+        if now - _last_flush['time'] < FLUSH_INTERVAL:
+            return
+        _last_flush['time'] = now
+        pending = dict(_pending)
+        _pending.clear()
+
+    _flush(pending)
+
+
+def _flush(pending):
+    """
+    Add pending counts to memcache and remember which stats each group has
+    :param pending: dict of (group, stat) -> count
+    :return:
+    """
+    client = memcache.Client()
+    client.offset_multi(
+        dict((STAT_KEY.format(group=group, stat=stat), n)
+             for (group, stat), n in pending.items()),
+        initial_value=0)
+
+    # most recently active groups first, each with the stats it has
+    groups = collections.OrderedDict(client.get(GROUPS_KEY) or [])
+    flushed = collections.OrderedDict()
+    for group, stat in pending:
+        flushed.setdefault(group, set(groups.pop(group, []))).add(stat)
+    recent = [(group, sorted(seen)) for group, seen in flushed.items()]
+    client.set(GROUPS_KEY, (recent + groups.items())[:MAX_GROUPS])
+
+
+def stats():
+    """
+    Counters of the most recently active transaction groups, as flushed to
+    memcache
+    :return: list of dicts, one per group
+    """
+    client = memcache.Client()
+    groups = client.get(GROUPS_KEY) or []
+    values = client.get_multi([STAT_KEY.format(group=group, stat=stat)
+                               for group, names in groups for stat in names])
+
+    report = []
+    for group, names in groups:
+        entry = dict.fromkeys(STATS, 0)
+        for stat in names:
+            entry[stat] = values.get(STAT_KEY.format(group=group, stat=stat), 0)
+        entry['group'] = group
+        report.append(entry)
+    return report
@@ -2,6 +2,7 @@
 Utility functions for Conference Central
 """
 
+import httplib
 import json
 import os
 import time
@@ -62,19 +63,29 @@ def get_user_id(user, id_type="email"):
 # --- Added by Dave Voutila <voutilad@gmail.com>
 
 
-def require_oauth(func):
+class ConflictException(endpoints.ServiceException):
+    """ConflictException -- exception mapped to HTTP 409 response"""
+    http_status = httplib.CONFLICT
+
+
+def field_mask(fields, form_class):
     """
-    Decorator to check if a user is executing the request with OAuth
-    :param func: wrapping func
-    :return:
+    Validate a partial response field mask against a form class
+
+    :param fields: list of form field names; empty means every field
+    :param form_class: messages.Message subclass the mask applies to
+    :return: frozenset of field names, or None for every field
     """
+    if not fields:
+        return None
 
-    def func_wrapper(*args, **kwargs):
-        if not endpoints.get_current_user():
-            raise endpoints.UnauthorizedException('Authorization required')
-        return func(*args, **kwargs)
+    unknown = set(fields) - set(field.name for field in
+                                form_class.all_fields())
+    if unknown:
+        raise endpoints.BadRequestException(
+            'Unknown fields: %s' % ', '.join(sorted(unknown)))
 
-    return func_wrapper
+    return frozenset(fields)
 
 
 def get_from_webkey(websafe_key, model=None):
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+versions.py -- memcache version counters backing ETags for read endpoints
+
+Every cacheable resource (a Conference, its Sessions, its featured speaker,
+the announcement) has a version counter in memcache that is bumped whenever
+the underlying data is written. Read endpoints derive their ETag from it, so
+checking whether a client's copy is still fresh costs a single memcache read.
+
+"""
+
+import hashlib
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import cache
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+VERSION_KEY = 'VERSION-{scope}'
+
+ANNOUNCEMENT_SCOPE = 'announcement'
+FACETS_SCOPE = 'facets'
+CONFERENCE_SCOPE = 'conference-{conf_key}'
+SESSIONS_SCOPE = 'sessions-{conf_key}'
+FEATURED_SCOPE = 'featured-{conf_key}'
+KIND_SCOPE = 'kind-{kind}'
+
+
+def _seed():
+    """
+    Starting value for a counter that isn't in memcache. Seeding from the
+    clock means a counter that got evicted never comes back with a value a
+    client could already be holding.
+    :return: int
+    """
+    return int(time.time() * 1000)
+
+
+def conference_scope(conf_key):
+    """
+    Version scope for a single Conference
+    :param conf_key: Conference ndb.Key
+    :return: string
+    """
+    return CONFERENCE_SCOPE.format(conf_key=conf_key.urlsafe())
+
+
+def sessions_scope(conf_key):
+    """
+    Version scope for the Sessions of a Conference
+    :param conf_key: Conference ndb.Key
+    :return: string
+    """
+    return SESSIONS_SCOPE.format(conf_key=conf_key.urlsafe())
+
+
+def featured_scope(conf_key):
+    """
+    Version scope for the featured speaker of a Conference
+    :param conf_key: Conference ndb.Key
+    :return: string
+    """
+    return FEATURED_SCOPE.format(conf_key=conf_key.urlsafe())
+
+
+def kind_scope(kind):
+    """
+    Version scope covering every entity of a kind, e.g. for query counts
+    :param kind: ndb.Model subclass
+    :return: string
+    """
+    return KIND_SCOPE.format(kind=kind._get_kind())
+
+
+def get_version(scope):
+    """
+    Current version of the scope, initialising it if needed
+    :param scope: string scope
+    :return: int version
+    """
+    key = VERSION_KEY.format(scope=scope)
+    client = memcache.Client()
+    version = client.get(key)
+    if version is None:
+        client.add(key, _seed())
+        version = client.get(key)
+    return version
+
+
+def bump(scope):
+    """
+    Increment the version for the given scope and invalidate any cached copy
+    of it. Inside a transaction the bump is deferred until the transaction
+    commits so readers never see a new version paired with old data.
+    :param scope: string scope
+    :return:
+    """
+    key = VERSION_KEY.format(scope=scope)
+
+    def on_commit():
+        memcache.Client().incr(key, initial_value=_seed())
+        cache.invalidate(scope)
+
+    ndb.get_context().call_on_commit(on_commit)
+
+
+def etag(scope, variant=None):
+    """
+    Build the ETag for the current version of the scope
+    :param scope: string scope
+    :param variant: optional string telling apart representations of the same
+    version, e.g. a field mask
+    :return: quoted ETag string
+    """
+    tag = '%s:%s' % (scope, get_version(scope))
+    if variant:
+        tag += ':' + variant
+    digest = hashlib.sha1(tag).hexdigest()
+    return '"%s"' % digest[:16]
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+views.py -- approximate view counts of Conferences
+
+Views are tallied in instance memory and flushed to memcache counters at
+most once every FLUSH_INTERVAL seconds, so recording a view costs no RPC.
+Each flush folds the new totals into a shared top-N list, which the warmup
+handler uses to pre-load the most viewed Conferences on new instances.
+
+"""
+
+import collections
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+__author__ = 'voutilad@gmail.com (Dave Voutila)'
+
+VIEWS_KEY = 'VIEWS-{conf_key}'
+TOP_KEY = 'VIEWS-TOP'
+TOP_N = 10
+FLUSH_INTERVAL = 10  # seconds
+
+_lock = threading.Lock()
+_pending = collections.Counter()
+_last_flush = {'time': time.time()}
+
+
+def record(conf_key):
+    """
+    Count a view of a Conference
+    :param conf_key: Conference key
+    :return:
+    """
+    now = time.time()
+    with _lock:
+        _pending[conf_key.urlsafe()] += 1
+        if now - _last_flush['time'] < FLUSH_INTERVAL:
+            return
+        _last_flush['time'] = now
+        pending = dict(_pending)
+        _pending.clear()
+
+    _flush(pending)
+
+
+def _flush(pending):
+    """
+    Add pending view counts to memcache and fold them into the top-N list
+    :param pending: dict of web-safe Conference key -> views
+    :return:
+    """
+    client = memcache.Client()
+    totals = client.offset_multi(
+        dict((VIEWS_KEY.format(conf_key=k), n) for k, n in pending.items()),
+        initial_value=0)
+
+    top = dict(client.get(TOP_KEY) or [])
+    for wsck in pending:
+        total = totals.get(VIEWS_KEY.format(conf_key=wsck))
+        if total is not None:
+            top[wsck] = total
+    ranked = sorted(top.items(), key=lambda item: item[1], reverse=True)
+    client.set(TOP_KEY, ranked[:TOP_N])
+
+
+def top_conferences(n=TOP_N):
+    """
+    Keys of the most viewed Conferences
+    :param n: max number of keys
+    :return: list of Conference keys
+    """
+    ranked = memcache.Client().get(TOP_KEY) or []
+    return [ndb.Key(urlsafe=wsck) for wsck, _ in ranked[:n]]